@@ -0,0 +1,199 @@
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+
+from .db_router import primary_reads
+from .models import QuestionMeta
+from .versions import cbt_cache, exam_version
+
+# Integer codes for the question type mask
+MCQ, MSQ, NAT = 1, 2, 3
+TYPE_CODES = {'MCQ': MCQ, 'MSQ': MSQ, 'NAT': NAT}
+
+# Key value that awards full marks to every response of a question (dropped or ambiguous questions)
+BONUS_KEY = 'BONUS'
+
+
+def is_bonus_key(correct_val):
+    return correct_val.strip().upper() == BONUS_KEY
+
+
+def to_cents(value):
+    # Marks are DecimalFields with 2 decimal places, so integer hundredths are exact
+    return int((Decimal(value) * 100).to_integral_value())
+
+
+def from_cents(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def option_tokens(value, question_type, is_key=False):
+    """
+    Normalised option tokens for MCQ/MSQ values.
+    MCQ compares the whole string, MSQ compares sets of options.
+    """
+    if question_type == MCQ:
+        return [value.strip().upper()]
+    # Keys may use either ',' or ';' ("A;C" or "A,B,D"), candidates always send ','
+    if is_key:
+        value = value.replace(';', ',')
+    return [x.strip().upper() for x in value.split(',')]
+
+
+def parse_nat_key(correct_val):
+    # Returns (low, high, is_range); unparseable keys become NaN and never match
+    try:
+        if ':' in correct_val:
+            low, high = map(float, correct_val.split(':'))
+            return low, high, True
+        value = float(correct_val)
+        return value, value, False
+    except ValueError:
+        return float('nan'), float('nan'), ':' in correct_val
+
+
+def mask_array(masks):
+    # Option sets fit in int64 unless a key has more than 62 distinct options
+    if masks and max(masks) >= 2 ** 62:
+        return np.array(masks, dtype=object)
+    return np.array(masks, dtype=np.int64)
+
+
+class CompiledAnswerKey:
+    """
+    Pre-parsed answer key of one exam, stored column-wise and indexed by
+    question position (question_number order).
+    """
+    __slots__ = (
+        'exam_id', 'version', 'position', 'question_ids', 'numbers', 'types', 'answers',
+        'qtype', 'mask', 'option_bits', 'nat_low', 'nat_high', 'nat_is_range', 'bonus',
+        'positive', 'negative',
+    )
+
+    FIELDS = ('id', 'question_number', 'question_type', 'correct_answer',
+              'marks_positive', 'marks_negative')
+
+    def __init__(self, exam_id, version, rows):
+        self.exam_id = exam_id
+        self.version = version
+        self.position = {}
+        ids, numbers, types, answers, option_bits = [], [], [], [], []
+        qtypes, masks, lows, highs, ranges, bonus, positive, negative = [], [], [], [], [], [], [], []
+
+        for q_id, number, q_type, correct_val, marks_pos, marks_neg in rows:
+            self.position[q_id] = len(ids)
+            ids.append(q_id)
+            numbers.append(number)
+            types.append(q_type)
+            answers.append(correct_val)
+
+            code = TYPE_CODES.get(q_type, 0)
+            qtypes.append(code)
+            positive.append(to_cents(marks_pos))
+            negative.append(to_cents(marks_neg))
+
+            bits, mask = {}, 0
+            low, high, is_range = float('nan'), float('nan'), False
+            bonus.append(is_bonus_key(correct_val))
+            if code in (MCQ, MSQ):
+                for token in option_tokens(correct_val, code, is_key=True):
+                    bit = bits.setdefault(token, 1 << len(bits))
+                    mask |= bit
+            elif code == NAT:
+                low, high, is_range = parse_nat_key(correct_val)
+
+            option_bits.append(bits)
+            masks.append(mask)
+            lows.append(low)
+            highs.append(high)
+            ranges.append(is_range)
+
+        self.question_ids = np.array(ids, dtype=np.int64)
+        self.numbers = np.array(numbers, dtype=np.int64)
+        self.types = tuple(types)
+        self.answers = tuple(answers)
+        self.option_bits = tuple(option_bits)
+        self.qtype = np.array(qtypes, dtype=np.int8)
+        self.mask = mask_array(masks)
+        self.nat_low = np.array(lows, dtype=np.float64)
+        self.nat_high = np.array(highs, dtype=np.float64)
+        self.nat_is_range = np.array(ranges, dtype=bool)
+        self.bonus = np.array(bonus, dtype=bool)
+        self.positive = np.array(positive, dtype=np.int64)
+        self.negative = np.array(negative, dtype=np.int64)
+
+    @classmethod
+    def build(cls, exam_id, version=None):
+        rows = QuestionMeta.objects.filter(exam_id=exam_id).order_by('question_number').values_list(*cls.FIELDS)
+        return cls(exam_id, version, rows)
+
+    def __len__(self):
+        return len(self.question_ids)
+
+    def marks_positive(self, pos):
+        return from_cents(self.positive[pos])
+
+    def marks_negative(self, pos):
+        return from_cents(self.negative[pos])
+
+    def encode(self, pos, user_val):
+        """
+        Encodes one candidate input as (option mask, float value).
+        An option outside the key gives mask 0, which never equals a key mask.
+        """
+        code = self.qtype[pos]
+        if code in (MCQ, MSQ):
+            bits = self.option_bits[pos]
+            mask = 0
+            for token in option_tokens(user_val, code):
+                bit = bits.get(token)
+                if bit is None:
+                    return 0, np.nan
+                mask |= bit
+            return mask, np.nan
+        if code == NAT:
+            try:
+                return 0, float(user_val)
+            except ValueError:
+                return 0, np.nan
+        return 0, np.nan
+
+
+# Process-local LRU of compiled keys: exam_id -> CompiledAnswerKey
+_compiled_keys = OrderedDict()
+_compiled_keys_lock = threading.Lock()
+
+
+def _shared_key(exam_id, version):
+    return f'cbt:answer-key:{exam_id}:{version}'
+
+
+def get_compiled_key(exam_id):
+    """
+    Returns the compiled key for an exam, building it at most once per exam version.
+    Set CBT_ANSWER_KEY_SHARED to also keep compiled keys in the Django cache.
+    """
+    version = exam_version(exam_id)
+    with _compiled_keys_lock:
+        key = _compiled_keys.get(exam_id)
+        if key is not None and key.version == version:
+            _compiled_keys.move_to_end(exam_id)
+            return key
+
+    shared = getattr(settings, 'CBT_ANSWER_KEY_SHARED', False)
+    key = cbt_cache().get(_shared_key(exam_id, version)) if shared else None
+    if key is None:
+        with primary_reads():
+            key = CompiledAnswerKey.build(exam_id, version)
+        if shared:
+            cbt_cache().set(_shared_key(exam_id, version), key)
+
+    with _compiled_keys_lock:
+        _compiled_keys[exam_id] = key
+        _compiled_keys.move_to_end(exam_id)
+        while len(_compiled_keys) > getattr(settings, 'CBT_ANSWER_KEY_LRU_SIZE', 64):
+            _compiled_keys.popitem(last=False)
+    return key
@@ -6,4 +6,5 @@ class CbtConfig(AppConfig):
     name = 'cbt'
 
     def ready(self):
+        import cbt.checks
         import cbt.signals
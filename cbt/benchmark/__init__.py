@@ -0,0 +1,3 @@
+"""
+Load generation for the candidate workflow; run it with `manage.py benchmark`.
+"""
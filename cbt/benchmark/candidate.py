@@ -0,0 +1,114 @@
+import json
+import random
+import secrets
+import time
+import urllib.error
+import urllib.request
+
+from django.urls import reverse
+
+OPTIONS = ('A', 'B', 'C', 'D')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Candidate:
+    """
+    One simulated candidate driving the exam through its real URLs: start,
+    load the interface and manifest, sync changed answers periodically, then
+    submit at the shared deadline and open the result.
+    """
+
+    def __init__(self, base_url, session_key, slug, recorder, seed):
+        self.base_url = base_url.rstrip('/')
+        self.slug = slug
+        self.recorder = recorder
+        self.rng = random.Random(seed)
+        # Any well-formed token works as long as cookie and header agree
+        self.csrf_token = secrets.token_hex(16)
+        self.cookie = f'sessionid={session_key}; csrftoken={self.csrf_token}'
+        self.opener = urllib.request.build_opener(_NoRedirect)
+        self.responses = {}
+        self.dirty = set()
+        self.seq = 0
+        self.full_sync = False
+
+    def request(self, endpoint, path, method='GET', payload=None, expected=(200,)):
+        headers = {'Cookie': self.cookie, 'X-CSRFToken': self.csrf_token, 'Referer': self.base_url + '/'}
+        data = None
+        if payload is not None:
+            data = json.dumps(payload).encode()
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                status, location, body = response.status, response.headers.get('Location'), response.read()
+        except urllib.error.HTTPError as exc:
+            status, location, body = exc.code, exc.headers.get('Location'), exc.read()
+        except OSError:
+            status, location, body = None, None, b''
+        self.recorder.request(endpoint, time.perf_counter() - started, status in expected)
+        return status, location, body
+
+    def _answer(self, question):
+        if question['type'] == 'MCQ':
+            return self.rng.choice(OPTIONS)
+        if question['type'] == 'MSQ':
+            return ','.join(sorted(self.rng.sample(OPTIONS, self.rng.randint(1, 3))))
+        return f'{self.rng.uniform(0, 10):.1f}'
+
+    def _edit(self, questions):
+        # A few answers per interval: new ones, changed minds and review marks
+        for question in self.rng.sample(questions, min(len(questions), self.rng.randint(1, 3))):
+            q_id = str(question['id'])
+            status = 'ans_marked_for_review' if self.rng.random() < 0.1 else 'answered'
+            self.responses[q_id] = {'value': self._answer(question), 'status': status}
+            self.dirty.add(q_id)
+
+    def sync(self):
+        if self.full_sync:
+            payload = {'full': True, 'responses': self.responses}
+        else:
+            payload = {'base': self.seq, 'patch': {q_id: self.responses[q_id] for q_id in self.dirty}}
+        status, _, body = self.request(
+            'sync_attempt', reverse('sync_attempt', args=[self.attempt_id]), 'POST', payload, expected=(200, 409)
+        )
+        if status == 409:
+            self.full_sync = True
+        elif status == 200:
+            self.seq = json.loads(body)['seq']
+            self.dirty.clear()
+            self.full_sync = False
+
+    def run(self, start_at, submit_at, sync_interval):
+        time.sleep(max(0.0, start_at - time.time()))
+        status, location, _ = self.request(
+            'start_attempt', reverse('start_attempt', args=[self.slug]), 'POST', expected=(302,)
+        )
+        if status != 302:
+            return
+        self.attempt_id = int(location.rstrip('/').rsplit('/', 1)[-1])
+
+        self.request('exam_interface', location)
+        status, _, body = self.request('exam_manifest', reverse('exam_manifest', args=[self.slug]))
+        questions = json.loads(body)['questions'] if status == 200 else []
+
+        # Spread syncs so candidates who started together don't stay in lockstep
+        next_sync = time.time() + self.rng.uniform(0.5, 1.0) * sync_interval
+        while questions and next_sync < submit_at:
+            time.sleep(max(0.0, next_sync - time.time()))
+            self._edit(questions)
+            self.sync()
+            next_sync += sync_interval * self.rng.uniform(0.9, 1.1)
+
+        # Everyone submits at the deadline
+        time.sleep(max(0.0, submit_at - time.time()))
+        if self.dirty:
+            self.sync()
+        self.request('submit_attempt', reverse('submit_attempt', args=[self.attempt_id]), 'POST')
+        self.request('exam_result', reverse('exam_result', args=[self.attempt_id]))
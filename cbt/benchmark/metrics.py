@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+# Database errors that mean a write waited on a lock and gave up
+LOCK_ERROR_MARKERS = ('database is locked', 'lock timeout', 'lock wait timeout', 'deadlock')
+
+
+def is_lock_error(exc):
+    return any(marker in str(exc).lower() for marker in LOCK_ERROR_MARKERS)
+
+
+class Recorder:
+    """
+    Collects per-endpoint results from candidate threads (latency, status) and,
+    when the server runs in-process, from the server side (queries, exceptions).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.queries = defaultdict(list)
+        self.lock_errors = defaultdict(int)
+        self.server_side = False
+        self.started = self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def request(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def server_request(self, endpoint, queries, exception=None):
+        with self._lock:
+            self.queries[endpoint].append(queries)
+            if exception is not None and is_lock_error(exception):
+                self.lock_errors[endpoint] += 1
+
+    def _endpoint(self, name, elapsed):
+        latencies = np.array(self.latencies[name]) * 1000
+        requests = len(latencies)
+        summary = {
+            'requests': requests,
+            'errors': self.errors[name],
+            'error_rate': round(self.errors[name] / requests, 4) if requests else 0.0,
+            'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+            'latency_ms': {
+                **{f'p{p}': round(float(np.percentile(latencies, p)), 2) for p in PERCENTILES},
+                'mean': round(float(latencies.mean()), 2),
+                'max': round(float(latencies.max()), 2),
+            } if requests else None,
+            'queries_per_request': None,
+            'lock_errors': None,
+            'lock_error_rate': None,
+        }
+        if self.server_side and self.queries[name]:
+            queries = np.array(self.queries[name])
+            summary['queries_per_request'] = {'mean': round(float(queries.mean()), 2), 'max': int(queries.max())}
+            summary['lock_errors'] = self.lock_errors[name]
+            summary['lock_error_rate'] = round(self.lock_errors[name] / len(queries), 4)
+        return summary
+
+    def report(self):
+        """
+        JSON-serializable results: one entry per endpoint plus overall totals.
+        """
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        with self._lock:
+            endpoints = {name: self._endpoint(name, elapsed) for name in sorted(self.latencies)}
+        requests = sum(e['requests'] for e in endpoints.values())
+        errors = sum(e['errors'] for e in endpoints.values())
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'endpoints': endpoints,
+            'totals': {
+                'requests': requests,
+                'errors': errors,
+                'error_rate': round(errors / requests, 4) if requests else 0.0,
+                'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+                'lock_errors': sum(self.lock_errors.values()) if self.server_side else None,
+            },
+        }
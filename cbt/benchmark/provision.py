@@ -0,0 +1,88 @@
+import uuid
+from importlib import import_module
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+
+from ..image_pdf import write_pdf
+from ..models import Exam
+
+# Question types cycle through this pattern, roughly like a GATE paper
+TYPE_PATTERN = ('MCQ', 'MCQ', 'MCQ', 'MSQ', 'NAT')
+
+
+def _answer_key(questions):
+    rows = ["Section, Question No, Type, Key, Marks, Negative"]
+    for number in range(1, questions + 1):
+        q_type = TYPE_PATTERN[number % len(TYPE_PATTERN)]
+        key = {'MCQ': 'B', 'MSQ': 'A;C', 'NAT': '4.5:5.5'}[q_type]
+        section = 'General Aptitude' if number <= 10 else 'Core'
+        negative = '0.33' if q_type == 'MCQ' else '0'
+        rows.append(f"{section}, {number}, {q_type}, {key}, 1, {negative}")
+    return "\n".join(rows).encode()
+
+
+def _paper(pages):
+    page = BytesIO()
+    Image.new('L', (850, 1100), 255).save(page, format='JPEG')
+    pdf = BytesIO()
+    write_pdf([page.getvalue()] * pages, pdf)
+    return pdf.getvalue()
+
+
+class Fixture:
+    """
+    An exam plus candidate users with ready-made login sessions.
+    """
+
+    def __init__(self, exam, users, session_keys):
+        self.exam = exam
+        self.users = users
+        self.session_keys = session_keys
+
+    def delete(self):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        for key in self.session_keys:
+            store(session_key=key).delete()
+        User.objects.filter(id__in=[user.id for user in self.users]).delete()
+        self.exam.delete()
+
+
+def provision(candidates, questions, prefix='bench'):
+    """
+    Creates an exam with a generated paper and answer key, and logged-in
+    sessions for the given number of candidates. Sessions are written straight
+    to the session store, so no password hashing or login view is involved.
+    """
+    run = uuid.uuid4().hex[:8]
+    exam = Exam.objects.create(
+        title=f"Benchmark {run}",
+        slug=f'{prefix}-{run}',
+        duration_minutes=180,
+        question_paper=SimpleUploadedFile(f'{prefix}-{run}.pdf', _paper(max(1, questions // 5))),
+        answer_key_file=SimpleUploadedFile(f'{prefix}-{run}.csv', _answer_key(questions)),
+    )
+
+    password = make_password(None)
+    users = User.objects.bulk_create([
+        User(username=f'{prefix}-{run}-{i}', password=password) for i in range(candidates)
+    ])
+    if not all(user.pk for user in users):
+        # Backends that don't return ids from bulk inserts
+        users = list(User.objects.filter(username__startswith=f'{prefix}-{run}-').order_by('id'))
+
+    store = import_module(settings.SESSION_ENGINE).SessionStore
+    session_keys = []
+    for user in users:
+        session = store()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        session_keys.append(session.session_key)
+    return Fixture(exam, users, session_keys)
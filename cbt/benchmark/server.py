@@ -0,0 +1,78 @@
+import sys
+import threading
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.signals import got_request_exception
+from django.db import connection
+from django.urls import Resolver404, resolve
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class InstrumentedApp:
+    """
+    WSGI app that counts the database queries of each request and notes the
+    exception it failed with, per URL name, into a Recorder.
+    """
+
+    def __init__(self, recorder):
+        self.app = WSGIHandler()
+        self.recorder = recorder
+        self.local = threading.local()
+        got_request_exception.connect(self._exception, weak=False)
+
+    def _exception(self, sender, request=None, **kwargs):
+        self.local.exception = sys.exc_info()[1]
+
+    def __call__(self, environ, start_response):
+        try:
+            endpoint = resolve(environ.get('PATH_INFO', '/')).url_name
+        except Resolver404:
+            endpoint = 'not_found'
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        self.local.exception = None
+        # Connections are per thread, and each request runs in its own thread
+        with connection.execute_wrapper(count):
+            response = self.app(environ, start_response)
+        self.recorder.server_request(endpoint, queries, self.local.exception)
+        return response
+
+    def close(self):
+        got_request_exception.disconnect(self._exception)
+
+
+class BenchmarkServer:
+    """
+    The project's WSGI app on a threaded server in a background thread, bound
+    to a free local port.
+    """
+
+    def __init__(self, recorder, host='127.0.0.1', port=0):
+        self.app = InstrumentedApp(recorder)
+        self.httpd = ThreadedWSGIServer((host, port), QuietRequestHandler, allow_reuse_address=True)
+        self.httpd.set_app(self.app)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.app.close()
@@ -0,0 +1,104 @@
+import shutil
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import FILE_FIELDS, Blob, Exam
+from .page_images import pages_dir
+from .question_index import labels_path
+from .storage import blob_storage, digest_from_name
+
+# How long an unreferenced blob is kept, so an upload of the same content that
+# is being saved right now can still pick it up
+BLOB_GRACE = timedelta(hours=1)
+
+
+def acquire(name):
+    if not Blob.objects.filter(name=name).update(refs=F('refs') + 1, updated_at=timezone.now()):
+        blob, created = Blob.objects.get_or_create(name=name, defaults={'refs': 1})
+        if not created:
+            Blob.objects.filter(name=name).update(refs=F('refs') + 1, updated_at=timezone.now())
+
+
+def release(name):
+    Blob.objects.filter(name=name, refs__gt=0).update(refs=F('refs') - 1, updated_at=timezone.now())
+
+
+def update_blob_refs(exam, deleted=False):
+    """
+    Moves the exam's blob references from the files it was loaded (or last
+    saved) with to the ones it has now, or drops them once it is deleted.
+    """
+    before = getattr(exam, '_stored_files', {})
+    after = {} if deleted else {name: getattr(exam, name).name for name in FILE_FIELDS if getattr(exam, name)}
+    for name in FILE_FIELDS:
+        old, new = before.get(name), after.get(name)
+        if old != new:
+            if new:
+                acquire(new)
+            if old:
+                release(old)
+    exam._stored_files = after
+
+
+def _delete_derived(digest):
+    # Page images and question labels are shared by every exam with this paper
+    if Exam.objects.filter(paper_digest=digest).exists():
+        return
+    shutil.rmtree(pages_dir(digest), ignore_errors=True)
+    labels_path(digest).unlink(missing_ok=True)
+
+
+def collect_blobs(grace=BLOB_GRACE):
+    """
+    Deletes blobs no exam has referenced for `grace`, together with the page
+    images and question labels derived from them.
+    Returns the names deleted.
+    """
+    storage = blob_storage()
+    cutoff = timezone.now() - grace
+    deleted = []
+    for blob_id, name in Blob.objects.filter(refs=0, updated_at__lte=cutoff).values_list('id', 'name'):
+        refs = Exam.objects.filter(question_paper=name).count() + Exam.objects.filter(answer_key_file=name).count()
+        if refs:
+            # Assigned without going through Exam.save (e.g. a queryset update): recount instead
+            Blob.objects.filter(id=blob_id).update(refs=refs)
+            continue
+        # Re-checked in the DELETE, in case the blob was picked up or uploaded again meanwhile
+        if not Blob.objects.filter(id=blob_id, refs=0, updated_at__lte=cutoff).delete()[0]:
+            continue
+        storage.delete(name)
+        digest = digest_from_name(name)
+        if digest:
+            _delete_derived(digest)
+        deleted.append(name)
+    return deleted
+
+
+def adopt_exam_files():
+    """
+    Moves exam files stored before content addressing (test_0rFjfSz.pdf, ...)
+    into content-addressed storage, so duplicates collapse into one blob.
+    The old copies become unreferenced and are left to collect_blobs.
+    Returns the number of file fields moved.
+    """
+    storage = blob_storage()
+    moved = 0
+    for exam in Exam.objects.only('id', *FILE_FIELDS).iterator():
+        for name in FILE_FIELDS:
+            field_file = getattr(exam, name)
+            if not field_file or digest_from_name(field_file.name) or not storage.exists(field_file.name):
+                continue
+            with storage.open(field_file.name, 'rb') as f:
+                new_name = storage.save(field_file.name, f)
+            with transaction.atomic():
+                # update() rather than save(), which would re-import the key and re-render pages
+                Exam.objects.filter(id=exam.id).update(**{name: new_name})
+                acquire(new_name)
+                release(field_file.name)
+                # Files from before content addressing have no Blob row for collect_blobs to find
+                Blob.objects.get_or_create(name=field_file.name, defaults={'refs': 0})
+            moved += 1
+    return moved
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, register
+
+from .state_buffer import buffer_cache, write_behind_enabled
+from .sync_pacing import load_cache, pacing_enabled
+
+
+@register()
+def check_sync_buffer_cache(app_configs, **kwargs):
+    # Every worker must see the same buffered states and locks, or syncs served by
+    # different processes overwrite each other and flushes write stale states
+    if write_behind_enabled() and isinstance(buffer_cache(), (LocMemCache, DummyCache)):
+        alias = getattr(settings, 'CBT_SYNC_BUFFER_CACHE', getattr(settings, 'CBT_CACHE', 'default'))
+        return [Error(
+            f"CBT_SYNC_WRITE_BEHIND needs a cache shared by all workers, but CBT_SYNC_BUFFER_CACHE "
+            f"({alias!r}) is {type(buffer_cache()).__name__}.",
+            hint="Point CBT_SYNC_BUFFER_CACHE at a Redis, Memcached or database cache.",
+            id='cbt.E001',
+        )]
+    return []
+
+
+@register()
+def check_sync_load_cache(app_configs, **kwargs):
+    # Each worker would only see its own requests and pace syncs by a fraction of the load
+    if pacing_enabled() and isinstance(load_cache(), (LocMemCache, DummyCache)):
+        alias = getattr(settings, 'CBT_SYNC_LOAD_CACHE', getattr(settings, 'CBT_CACHE', 'default'))
+        return [Error(
+            f"CBT_SYNC_PACING needs a cache shared by all workers, but CBT_SYNC_LOAD_CACHE "
+            f"({alias!r}) is {type(load_cache()).__name__}.",
+            hint="Point CBT_SYNC_LOAD_CACHE at a Redis, Memcached or database cache.",
+            id='cbt.E002',
+        )]
+    return []
@@ -0,0 +1,99 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Cookie holding the time until which the client reads from the primary
+STICKY_COOKIE = 'cbt_primary_until'
+
+# Set while a view marked with replica_reads runs
+_read_intent = ContextVar('cbt_read_intent', default=False)
+
+
+def read_replicas():
+    return list(getattr(settings, 'CBT_READ_REPLICAS', ()))
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of views marked with replica_reads to one of
+    CBT_READ_REPLICAS and every write to the primary ('default'). Without
+    replicas configured it routes nothing, which is Django's single database.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = read_replicas()
+        if replicas and _read_intent.get():
+            return random.choice(replicas)
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Also for objects read from a replica, which Django would otherwise save back there
+        return DEFAULT_DB_ALIAS if read_replicas() else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the primary's rows, so objects may be related across them
+        databases = {DEFAULT_DB_ALIAS, *read_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def _pinned(request):
+    try:
+        return float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def replica_reads(view):
+    """
+    Marks a view that only reads: its queries may go to a replica, unless the
+    client wrote through a pins_primary view less than CBT_REPLICA_STICKY_SECONDS
+    ago. Goes below login_required, so the session and user come from the primary.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not read_replicas() or _pinned(request):
+            return view(request, *args, **kwargs)
+        token = _read_intent.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _read_intent.reset(token)
+    return wrapper
+
+
+def pins_primary(view):
+    """
+    Marks a view that writes: after a successful POST the client reads from the
+    primary for CBT_REPLICA_STICKY_SECONDS, so it sees its own writes however
+    far the replicas lag.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if read_replicas() and request.method == 'POST' and response.status_code < 400:
+            seconds = getattr(settings, 'CBT_REPLICA_STICKY_SECONDS', 10)
+            response.set_cookie(STICKY_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True,
+                                samesite='Lax')
+        return response
+    return wrapper
+
+
+@contextmanager
+def primary_reads():
+    """
+    Reads from the primary even inside a replica_reads view. For data cached
+    under a stamp that is bumped on commit (compiled keys, manifests), which a
+    lagging replica could otherwise fill with rows from before the change.
+    """
+    token = _read_intent.set(False)
+    try:
+        yield
+    finally:
+        _read_intent.reset(token)
@@ -0,0 +1,107 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .event_log import event_log_enabled, replay
+from .models import Attempt
+from .scoring_logic import score_attempts
+from .scoring_queue import async_scoring_enabled, enqueue_scoring
+from .state_buffer import discard_buffered_states, flush_buffered_states, write_behind_enabled
+from .submission import save_attempts_responses
+from .sync import deadline_grace
+
+# Expired attempts finalized per transaction by the sweeper
+FINALIZE_BATCH_SIZE = 200
+
+
+def seconds_left(attempt, now=None):
+    """
+    Whole seconds until the attempt's deadline, never negative; the exam
+    interface counts down from this rather than from the full duration.
+    """
+    if attempt.deadline is None:
+        return attempt.exam.duration_minutes * 60
+    remaining = (attempt.deadline - (now or timezone.now())).total_seconds()
+    return max(0, int(remaining))
+
+
+def begin_attempt(attempt, exam, now=None):
+    """
+    Starts the clock of an attempt pre-created by provision_candidates. The
+    UPDATE only matches a not-yet-started attempt, so a double click can't
+    restart it.
+    """
+    now = now or timezone.now()
+    deadline = now + timedelta(minutes=exam.duration_minutes)
+    if Attempt.objects.filter(id=attempt.id, started_at__isnull=True).update(started_at=now, deadline=deadline):
+        attempt.started_at, attempt.deadline = now, deadline
+
+
+def accepts_writes(attempt, now=None):
+    """
+    Whether answers may still be synced: the attempt has started, is
+    unsubmitted, and its deadline (plus CBT_DEADLINE_GRACE_SECONDS) hasn't passed.
+    """
+    if attempt.is_submitted or attempt.started_at is None:
+        return False
+    return attempt.deadline is None or (now or timezone.now()) <= attempt.deadline + deadline_grace()
+
+
+def finalize_attempts(attempt_ids):
+    """
+    Submits unsubmitted attempts from their last synced state, as completed at
+    their deadline, and scores them (or queues them for scoring). Attempts
+    another request is submitting right now are skipped.
+    Returns the ids finalized.
+    """
+    attempt_ids = list(attempt_ids)
+    if write_behind_enabled():
+        flush_buffered_states(attempt_ids)
+
+    with transaction.atomic():
+        attempts = list(
+            Attempt.objects.select_for_update(skip_locked=True)
+            .filter(id__in=attempt_ids, is_submitted=False)
+            .only('id', 'exam_id', 'current_state')
+        )
+        if not attempts:
+            return []
+        ids = [attempt.id for attempt in attempts]
+        if event_log_enabled():
+            for attempt in attempts:
+                attempt.current_state = replay(attempt)
+            Attempt.objects.bulk_update(attempts, ['current_state'])
+        save_attempts_responses(attempts)
+        Attempt.objects.filter(id__in=ids).update(is_submitted=True, completed_at=F('deadline'))
+        transaction.on_commit(lambda: discard_buffered_states(ids))
+
+        if async_scoring_enabled():
+            enqueue_scoring(ids)
+        else:
+            score_attempts(ids)
+    return ids
+
+
+def finalize_expired_attempts(now=None, batch_size=FINALIZE_BATCH_SIZE):
+    """
+    Finalizes every unsubmitted attempt whose deadline (plus grace) has passed,
+    oldest first, one batch per transaction.
+    Returns the number of attempts finalized.
+    """
+    cutoff = (now or timezone.now()) - deadline_grace()
+    finalized = 0
+    while True:
+        ids = list(
+            Attempt.objects.filter(is_submitted=False, deadline__lt=cutoff)
+            .order_by('deadline')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return finalized
+        done = finalize_attempts(ids)
+        finalized += len(done)
+        if not done:
+            # Every attempt in the batch is locked by a concurrent submit; the next sweep gets them
+            return finalized
@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Attempt, ResponseEvent
+from .state_buffer import buffered_state
+from .sync import InvalidSync, SyncClosed, SyncGap, _validate_responses, open_attempts, state_seq
+
+# Attempts compacted per transaction by compact_response_events
+COMPACT_BATCH_SIZE = 200
+
+VALUE_MAX_LENGTH = ResponseEvent._meta.get_field('value').max_length
+STATUS_MAX_LENGTH = ResponseEvent._meta.get_field('status').max_length
+
+
+def event_log_enabled():
+    return getattr(settings, 'CBT_SYNC_EVENT_LOG', False)
+
+
+def _client_ts(payload):
+    # The interface sends Date.now(), milliseconds since the epoch
+    ts = payload.get('ts')
+    if isinstance(ts, bool) or not isinstance(ts, (int, float)):
+        return None
+    try:
+        return datetime.fromtimestamp(ts / 1000, tz=dt_timezone.utc)
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+def _events(attempt_id, responses, client_ts):
+    events = []
+    for q_id, entry in _validate_responses(responses).items():
+        value, status = entry.get('value'), entry.get('status')
+        if (
+            not str(q_id).isdigit()
+            or not isinstance(value, (str, type(None))) or len(value or '') > VALUE_MAX_LENGTH
+            or not isinstance(status, (str, type(None))) or len(status or '') > STATUS_MAX_LENGTH
+        ):
+            raise InvalidSync(f"Invalid response for question {q_id!r}.")
+        events.append(ResponseEvent(
+            attempt_id=attempt_id, question_id=int(q_id), value=value, status=status, client_ts=client_ts,
+        ))
+    return events
+
+
+def _fold(state, events):
+    # events: (seq, question_id, value, status) in seq order, resets first within a seq
+    responses, seq = None, state_seq(state)
+    for seq, q_id, value, status in events:
+        if responses is None:
+            responses = dict(state.get('responses', {}))
+        if q_id is None:
+            responses = {}
+        else:
+            responses[str(q_id)] = {'value': value, 'status': status}
+    if responses is None:
+        return state
+    return {**state, 'responses': responses, 'seq': seq}
+
+
+def replay(attempt):
+    """
+    The attempt's current_state with the events logged after it applied, the
+    latest event per question winning. Reads only the covering index.
+    """
+    state = attempt.current_state if isinstance(attempt.current_state, dict) else {}
+    events = (
+        ResponseEvent.objects.filter(attempt_id=attempt.id, seq__gt=state_seq(state))
+        .order_by('seq', F('question_id').asc(nulls_first=True))
+        .values_list('seq', 'question_id', 'value', 'status')
+    )
+    return _fold(state, events)
+
+
+def latest_state(attempt):
+    """
+    Newest known state of an attempt, from the event log, the write-behind
+    buffer or current_state, whichever syncs are going to.
+    """
+    if event_log_enabled():
+        return replay(attempt)
+    return buffered_state(attempt)
+
+
+def latest_seq(attempt):
+    """
+    Seq of latest_state(attempt) without replaying: needs only the attempt's
+    current_state and sync_seq.
+    """
+    if event_log_enabled():
+        return max(attempt.sync_seq, state_seq(attempt.current_state))
+    return state_seq(buffered_state(attempt))
+
+
+def log_sync(attempt, payload):
+    """
+    Event-log counterpart of apply_sync + save: a patch is appended as one
+    event per question, after claiming the next seq with a conditional UPDATE
+    of the attempt's sync_seq (SyncGap if the base is stale). A full snapshot
+    appends a reset event followed by its responses. Either raises SyncClosed
+    if the attempt was submitted or closed in the meantime.
+    Returns the new seq, or None if a snapshot changed nothing.
+    """
+    client_ts = _client_ts(payload)
+    if 'patch' in payload:
+        events = _events(attempt.id, payload['patch'], client_ts)
+        base = payload.get('base')
+        if isinstance(base, bool) or not isinstance(base, int):
+            raise SyncGap(attempt.sync_seq)
+        with transaction.atomic():
+            if not Attempt.objects.filter(open_attempts(), id=attempt.id, sync_seq=base).update(sync_seq=base + 1):
+                current = Attempt.objects.filter(open_attempts(), id=attempt.id).values_list('sync_seq', flat=True)
+                if not current:
+                    raise SyncClosed()
+                raise SyncGap(current[0])
+            for event in events:
+                event.seq = base + 1
+            ResponseEvent.objects.bulk_create(events)
+        return base + 1
+
+    responses = payload.get('responses', {})
+    events = _events(attempt.id, responses, client_ts)
+    with transaction.atomic():
+        locked = (
+            Attempt.objects.select_for_update().filter(open_attempts(), id=attempt.id)
+            .only('id', 'sync_seq', 'current_state').first()
+        )
+        if locked is None:
+            raise SyncClosed()
+        state = replay(locked)
+        if state.get('responses', {}) == responses:
+            return None
+        # Also past seqs synced into current_state before the event log was switched on
+        seq = max(locked.sync_seq, state_seq(state)) + 1
+        Attempt.objects.filter(id=attempt.id).update(sync_seq=seq)
+        events.insert(0, ResponseEvent(attempt_id=attempt.id, question=None, client_ts=client_ts))
+        for event in events:
+            event.seq = seq
+        ResponseEvent.objects.bulk_create(events)
+    return seq
+
+
+def compact_response_events(attempt_ids=None, batch_size=COMPACT_BATCH_SIZE):
+    """
+    Folds logged events into the current_state of unsubmitted attempts, so a
+    resume replays only what was synced since, then deletes the events of
+    attempts completed more than CBT_EVENT_RETENTION_DAYS ago (None keeps them).
+    Attempts being submitted right now are skipped; submit folds them itself.
+    Returns the number of attempts compacted and of events deleted.
+    """
+    pending = Attempt.objects.filter(is_submitted=False, sync_seq__gt=0)
+    if attempt_ids is not None:
+        pending = pending.filter(id__in=list(attempt_ids))
+    attempt_ids = [
+        attempt_id for attempt_id, sync_seq, seq in pending.values_list('id', 'sync_seq', 'current_state__seq')
+        if sync_seq > (seq or 0)
+    ]
+
+    compacted = 0
+    for start in range(0, len(attempt_ids), batch_size):
+        with transaction.atomic():
+            attempts = list(
+                Attempt.objects.select_for_update(skip_locked=True)
+                .filter(id__in=attempt_ids[start:start + batch_size], is_submitted=False)
+                .only('id', 'current_state')
+            )
+            changed = []
+            for attempt in attempts:
+                state = replay(attempt)
+                if state is not attempt.current_state:
+                    attempt.current_state = state
+                    changed.append(attempt)
+            Attempt.objects.bulk_update(changed, ['current_state'])
+            compacted += len(changed)
+
+    deleted = 0
+    retention = getattr(settings, 'CBT_EVENT_RETENTION_DAYS', 30)
+    if retention is not None:
+        cutoff = timezone.now() - timedelta(days=retention)
+        deleted, _ = ResponseEvent.objects.filter(
+            attempt__is_submitted=True, attempt__completed_at__lt=cutoff
+        ).delete()
+    return compacted, deleted
+
+
+def response_history(attempt, question_id=None):
+    """
+    Every logged change of an attempt's responses (or of one question), oldest
+    first, for settling disputed answers. A question of None is a reset.
+    """
+    events = ResponseEvent.objects.filter(attempt_id=attempt.id)
+    if question_id is not None:
+        events = events.filter(Q(question_id=question_id) | Q(question__isnull=True))
+    return events.order_by('seq', F('question_id').asc(nulls_first=True)).values(
+        'seq', 'question_id', 'value', 'status', 'client_ts', 'created_at'
+    )
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.urls import reverse
+
+from .db_router import primary_reads
+from .models import QuestionMeta
+from .page_images import page_manifest
+from .versions import cbt_cache
+
+
+class ExamManifest:
+    """
+    Everything the exam interface needs to know about an exam that is the same
+    for every candidate: exam config, sections, questions and the page index.
+    Serialized once, with a content ETag, so it can be served as-is.
+    """
+
+    def __init__(self, stamp, data):
+        self.stamp = stamp
+        self.json = json.dumps(data, separators=(',', ':'))
+        self.etag = hashlib.sha256(self.json.encode()).hexdigest()[:32]
+
+    @classmethod
+    def build(cls, exam, stamp):
+        # One query: section names come along with the questions
+        rows = (
+            QuestionMeta.objects.filter(exam_id=exam.id)
+            .order_by('question_number')
+            .values_list('id', 'question_number', 'question_type', 'section__name', 'section__order',
+                         'pdf_page_number', 'pdf_page_offset')
+        )
+        questions, sections = [], {}
+        for q_id, number, q_type, section, order, page, offset in rows:
+            questions.append({
+                'id': q_id,
+                'number': number,
+                'type': q_type,
+                'section': section or '',
+                # Offset is null until the paper's text layer has been indexed
+                'page': page,
+                'offset': offset,
+            })
+            if section is not None:
+                sections.setdefault(section, order)
+
+        page_images = None
+        pages = page_manifest(exam.paper_digest)
+        if pages:
+            page_images = {
+                'widths': pages['widths'],
+                'sizes': pages['sizes'],
+                'url': reverse('paper_page', args=[exam.paper_digest, 0, 0]),
+            }
+
+        return cls(stamp, {
+            'exam': {
+                'slug': exam.slug,
+                'title': exam.title,
+                'duration_minutes': exam.duration_minutes,
+                'total_marks': str(exam.total_marks),
+                'paper_url': reverse('question_paper', args=[exam.slug, exam.paper_digest]),
+            },
+            'sections': sorted(sections, key=sections.get),
+            'questions': questions,
+            'page_images': page_images,
+        })
+
+
+def _stamp(exam):
+    # Page images appear without an exam change, so whether they exist is part of the stamp
+    rendered = page_manifest(exam.paper_digest) is not None
+    return f'{exam.version}-{int(rendered)}'
+
+
+def _shared_key(exam_id, stamp):
+    return f'cbt:exam-manifest:{exam_id}:{stamp}'
+
+
+# Process-local LRU of manifests: exam_id -> ExamManifest
+_manifests = OrderedDict()
+_manifests_lock = threading.Lock()
+
+
+def get_exam_manifest(exam):
+    """
+    Returns the manifest of an exam, building it at most once per exam version
+    across all workers when CBT_CACHE is a cache they share. The version is
+    read from the exam as loaded, so this costs no queries while it is unchanged.
+    """
+    exam.ensure_paper_digest()
+    stamp = _stamp(exam)
+    with _manifests_lock:
+        manifest = _manifests.get(exam.id)
+        if manifest is not None and manifest.stamp == stamp:
+            _manifests.move_to_end(exam.id)
+            return manifest
+
+    manifest = cbt_cache().get(_shared_key(exam.id, stamp))
+    if manifest is None:
+        with primary_reads():
+            manifest = ExamManifest.build(exam, stamp)
+        cbt_cache().set(_shared_key(exam.id, stamp), manifest)
+
+    with _manifests_lock:
+        _manifests[exam.id] = manifest
+        _manifests.move_to_end(exam.id)
+        while len(_manifests) > getattr(settings, 'CBT_MANIFEST_LRU_SIZE', 64):
+            _manifests.popitem(last=False)
+    return manifest
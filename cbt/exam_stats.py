@@ -0,0 +1,304 @@
+from collections import Counter
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.utils import timezone
+
+from .answer_key import MCQ, from_cents, get_compiled_key, to_cents
+from .models import Attempt, Exam, ExamStats, QuestionStats, Response, ScoreNode, StatsDelta
+
+# Bins of the score histogram shown with results
+HISTOGRAM_BINS = 10
+
+# Columns of outcome_counts()
+OUTCOMES = ('correct', 'incorrect', 'unattempted')
+
+# Statistics deltas folded per transaction by fold_exam_stats
+FOLD_BATCH_SIZE = 1000
+
+
+def score_bounds(key):
+    # Lowest and highest possible totals in hundredths; only attempted MCQs lose marks
+    return -int(key.negative[key.qtype == MCQ].sum()), int(key.positive.sum())
+
+
+def _update_path(index, size):
+    # Nodes whose range covers index, for adding to it
+    while index <= size:
+        yield index
+        index += index & -index
+
+
+def _prefix_path(index):
+    # Nodes that together cover 1..index, for summing it
+    while index > 0:
+        yield index
+        index -= index & -index
+
+
+def _build_tree(counts):
+    # O(n) Fenwick construction from 1-based bucket counts (counts[0] is unused)
+    tree = counts.copy()
+    for index in range(1, len(tree)):
+        parent = index + (index & -index)
+        if parent < len(tree):
+            tree[parent] += tree[index]
+    return tree
+
+
+def outcome_counts(key, q_pos, user_values, is_correct):
+    """
+    Per-question (correct, incorrect, unattempted) counts of response columns,
+    as an int array of shape (questions, 3).
+    """
+    is_correct = np.asarray(is_correct, dtype=bool)
+    attempted = np.array([bool(v) for v in user_values], dtype=bool)
+    outcome = np.where(is_correct, 0, np.where(attempted, 1, 2))
+    counts = np.zeros((len(key.question_ids), 3), dtype=np.int64)
+    np.add.at(counts, (np.asarray(q_pos, dtype=np.int64), outcome), 1)
+    return counts
+
+
+def rebuild_exam_stats(exam_id):
+    """
+    Recomputes an exam's statistics from its scored attempts and responses,
+    taking in the deltas not folded yet. Needed after anything that changes
+    totals in bulk, like a key revision.
+    """
+    key = get_compiled_key(exam_id)
+    with transaction.atomic():
+        # The exam row serializes rebuilds, including two first ones that would both create the
+        # stats row. It also waits out scoring transactions in flight: the foreign key check of
+        # their StatsDelta insert share-locks the exam row until they commit, so every delta
+        # visible here belongs to scores counted below, and later ones to scores that aren't
+        list(Exam.objects.select_for_update().filter(id=exam_id).values_list('id', flat=True))
+        # Locking the stats row keeps folds out while the tree is replaced
+        stats = ExamStats.objects.select_for_update().filter(exam_id=exam_id).first()
+        StatsDelta.objects.filter(exam_id=exam_id).delete()
+
+        totals = [
+            (to_cents(total), n) for total, n in
+            Attempt.objects.filter(exam_id=exam_id, total_score__isnull=False)
+            .values_list('total_score').annotate(n=Count('id')).order_by()
+        ]
+        low, high = score_bounds(key)
+        # Totals outside the key's range (e.g. adjusted by hand) still get counted
+        low = min([low] + [cents for cents, _ in totals])
+        high = max([high] + [cents for cents, _ in totals])
+
+        counts = np.zeros(high - low + 2, dtype=np.int64)
+        for cents, n in totals:
+            counts[cents - low + 1] += n
+        tree = _build_tree(counts)
+
+        fields = {
+            'attempts': sum(n for _, n in totals),
+            'score_sum_cents': sum(cents * n for cents, n in totals),
+            'min_score_cents': low,
+            'size': high - low + 1,
+        }
+        if stats is None:
+            stats = ExamStats.objects.create(exam_id=exam_id, **fields)
+        else:
+            for name, value in fields.items():
+                setattr(stats, name, value)
+            stats.save()
+
+        ScoreNode.objects.filter(exam_id=exam_id).delete()
+        ScoreNode.objects.bulk_create(
+            [ScoreNode(exam_id=exam_id, index=i, count=int(tree[i])) for i in np.flatnonzero(tree)],
+            batch_size=1000,
+        )
+
+        outcomes = {
+            q_id: (correct, total - correct - unattempted, unattempted)
+            for q_id, correct, unattempted, total in
+            Response.objects.filter(attempt__exam_id=exam_id, attempt__total_score__isnull=False)
+            .values('question_id').order_by()
+            .annotate(
+                correct=Count('id', filter=Q(is_correct=True)),
+                unattempted=Count('id', filter=~Q(is_correct=True) & (Q(user_input__isnull=True) | Q(user_input=''))),
+                total=Count('id'),
+            ).values_list('question_id', 'correct', 'unattempted', 'total')
+        }
+        QuestionStats.objects.filter(question__exam_id=exam_id).delete()
+        QuestionStats.objects.bulk_create([
+            QuestionStats(question_id=int(q_id), **dict(zip(OUTCOMES, outcomes.get(q_id, (0, 0, 0)))))
+            for q_id in key.question_ids
+        ], batch_size=1000)
+    return stats
+
+
+def record_scores(key, previous, totals, outcomes):
+    """
+    Appends the change freshly scored attempts make to their exam's statistics
+    as a StatsDelta, for fold_exam_stats. previous maps attempt id -> total
+    before scoring (None if it wasn't scored), totals maps it to the new total
+    and outcomes is outcome_counts() of the new results minus those of
+    re-scored attempts. Runs in the scoring transaction; takes no locks.
+    """
+    if not totals:
+        return
+    scores = Counter()
+    for attempt_id, total in totals.items():
+        scores[to_cents(total)] += 1
+        if previous.get(attempt_id) is not None:
+            scores[to_cents(previous[attempt_id])] -= 1
+    rescored = [attempt_id for attempt_id in totals if previous.get(attempt_id) is not None]
+    StatsDelta.objects.create(
+        exam_id=key.exam_id,
+        attempts=len(totals) - len(rescored),
+        score_sum_cents=sum(map(to_cents, totals.values())) - sum(to_cents(previous[a]) for a in rescored),
+        scores={cents: n for cents, n in scores.items() if n},
+        outcomes={
+            int(key.question_ids[pos]): [int(n) for n in outcomes[pos]]
+            for pos in np.flatnonzero(outcomes.any(axis=1))
+        },
+    )
+
+
+def _fold_batch(exam_id, batch_size):
+    # Folds up to batch_size of the exam's deltas and returns how many, or None if it needs a rebuild instead
+    with transaction.atomic():
+        # The stats row lock serializes folds and rebuilds of an exam
+        stats = ExamStats.objects.select_for_update().filter(exam_id=exam_id).first()
+        deltas = list(StatsDelta.objects.filter(exam_id=exam_id).order_by('id')[:batch_size])
+        if not deltas:
+            return 0
+
+        scores, outcomes = Counter(), {}
+        for delta in deltas:
+            scores.update({int(cents): n for cents, n in delta.scores.items()})
+            for q_id, counts in delta.outcomes.items():
+                outcomes[int(q_id)] = [a + b for a, b in zip(outcomes.get(int(q_id), (0, 0, 0)), counts)]
+        if stats is None or not all(
+            stats.min_score_cents <= cents < stats.min_score_cents + stats.size for cents, n in scores.items() if n
+        ):
+            # First scores of the exam, or a total the tree can't hold: count everything afresh
+            return None
+
+        node_deltas = Counter()
+        for cents, n in scores.items():
+            if n:
+                for index in _update_path(cents - stats.min_score_cents + 1, stats.size):
+                    node_deltas[index] += n
+        node_deltas = {index: n for index, n in node_deltas.items() if n}
+
+        ExamStats.objects.filter(id=stats.id).update(
+            updated_at=timezone.now(),
+            attempts=F('attempts') + sum(delta.attempts for delta in deltas),
+            score_sum_cents=F('score_sum_cents') + sum(delta.score_sum_cents for delta in deltas),
+        )
+        # The stats row lock serializes these updates per exam, so missing rows can simply be created
+        if node_deltas:
+            nodes = ScoreNode.objects.filter(exam_id=exam_id, index__in=node_deltas)
+            updated = nodes.update(
+                count=F('count') + Case(*[When(index=index, then=Value(n)) for index, n in node_deltas.items()])
+            )
+            if updated < len(node_deltas):
+                existing = set(nodes.values_list('index', flat=True))
+                ScoreNode.objects.bulk_create([
+                    ScoreNode(exam_id=exam_id, index=index, count=n)
+                    for index, n in node_deltas.items() if index not in existing
+                ])
+
+        changed = {q_id: counts for q_id, counts in outcomes.items() if any(counts)}
+        if changed:
+            updated = QuestionStats.objects.bulk_update([
+                QuestionStats(question_id=q_id, **{name: F(name) + counts[i] for i, name in enumerate(OUTCOMES)})
+                for q_id, counts in changed.items()
+            ], OUTCOMES)
+            if updated < len(changed):
+                # Questions added since the last rebuild
+                existing = set(
+                    QuestionStats.objects.filter(question_id__in=changed).values_list('question_id', flat=True)
+                )
+                QuestionStats.objects.bulk_create([
+                    QuestionStats(question_id=q_id, **dict(zip(OUTCOMES, counts)))
+                    for q_id, counts in changed.items() if q_id not in existing
+                ])
+
+        StatsDelta.objects.filter(id__in=[delta.id for delta in deltas]).delete()
+        return len(deltas)
+
+
+def fold_exam_stats(exam_ids=None, batch_size=FOLD_BATCH_SIZE):
+    """
+    Folds the statistics deltas appended by scoring into ExamStats, ScoreNode
+    and QuestionStats, in batches per exam. An exam without statistics yet, or
+    with a total outside its tree's range, is rebuilt instead. Run by the
+    scoring worker and `manage.py fold_exam_stats`, never in a request.
+    Returns the ids of the exams whose statistics changed.
+    """
+    pending = StatsDelta.objects.order_by()
+    if exam_ids is not None:
+        pending = pending.filter(exam_id__in=list(exam_ids))
+    changed = []
+    for exam_id in sorted(set(pending.values_list('exam_id', flat=True))):
+        while True:
+            folded = _fold_batch(exam_id, batch_size)
+            if folded is None:
+                # Outside the fold's transaction, since a rebuild locks the exam row first
+                rebuild_exam_stats(exam_id)
+            if not folded or folded < batch_size:
+                break
+        changed.append(exam_id)
+    return changed
+
+
+def _node_sums(exam_id, indices):
+    # Prefix sums for several indices, reading the union of their paths in one query
+    paths = {index: list(_prefix_path(index)) for index in indices}
+    needed = {node for path in paths.values() for node in path}
+    counts = dict(ScoreNode.objects.filter(exam_id=exam_id, index__in=needed).values_list('index', 'count'))
+    return {index: sum(counts.get(node, 0) for node in path) for index, path in paths.items()}
+
+
+def exam_standing(exam_id, score, bins=HISTOGRAM_BINS):
+    """
+    Rank, percentile and score histogram of a total among an exam's scored
+    attempts, from the materialized statistics in two queries. Returns None
+    when there are no statistics (yet) or the score lies outside them.
+    """
+    stats = ExamStats.objects.filter(exam_id=exam_id).first()
+    if stats is None or not stats.attempts:
+        return None
+    index = to_cents(score) - stats.min_score_cents + 1
+    if not 1 <= index <= stats.size:
+        return None
+
+    edges = sorted({round(stats.size * i / bins) for i in range(bins + 1)})
+    sums = _node_sums(exam_id, {index - 1, index, *edges})
+    at_or_below, below = sums[index], sums[index - 1]
+
+    histogram = [
+        {
+            'low': from_cents(stats.min_score_cents + start),
+            'high': from_cents(stats.min_score_cents + end - 1),
+            'count': sums[end] - sums[start],
+        }
+        for start, end in zip(edges, edges[1:])
+    ]
+    return {
+        'rank': stats.attempts - at_or_below + 1,
+        'attempts': stats.attempts,
+        # Share of candidates who scored lower, ties counting half
+        'percentile': round(100 * (below + (at_or_below - below) / 2) / stats.attempts, 2),
+        'average': from_cents(round(stats.score_sum_cents / stats.attempts)),
+        'histogram': histogram,
+    }
+
+
+def question_difficulty(exam_id):
+    """
+    {question id: percentage of scored attempts that got it right}.
+    """
+    difficulty = {}
+    for q_id, correct, incorrect, unattempted in QuestionStats.objects.filter(
+        question__exam_id=exam_id
+    ).values_list('question_id', 'correct', 'incorrect', 'unattempted'):
+        total = correct + incorrect + unattempted
+        if total:
+            difficulty[q_id] = round(100 * correct / total, 1)
+    return difficulty
@@ -0,0 +1,108 @@
+import re
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+# Cache-Control for URLs that embed a content digest, so they can never go stale
+IMMUTABLE = 'private, max-age=31536000, immutable'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Parses a single-range Range header into an inclusive (start, end).
+    Returns None when the whole file should be sent: no header, syntax we don't
+    handle, or several ranges (allowed by RFC 9110). Raises RangeNotSatisfiable
+    if the range lies outside the file.
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+class _RangeFile:
+    # Exposes only part of a file. It has no fileno(), so servers won't sendfile() the whole thing
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.f.read(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def serve_file(request, storage, name, content_type, etag, cache_control=IMMUTABLE):
+    """
+    Streams a stored file with a strong ETag, If-None-Match/If-Range handling and
+    single-range 206 responses. With CBT_SENDFILE_HEADER set (e.g. X-Accel-Redirect)
+    the body is left to the front-end server, which also answers ranges itself.
+    """
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = _file_response(request, storage, name, content_type, etag)
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _file_response(request, storage, name, content_type, etag):
+    sendfile_header = getattr(settings, 'CBT_SENDFILE_HEADER', None)
+    if sendfile_header:
+        response = HttpResponse(content_type=content_type)
+        response[sendfile_header] = getattr(settings, 'CBT_SENDFILE_PREFIX', '/protected-media/') + name
+        return response
+
+    try:
+        f = storage.open(name, 'rb')
+    except FileNotFoundError:
+        raise Http404("File not found.")
+    size = f.size
+    byte_range = None
+    # If-Range: only honour the range if the client's copy is still current
+    if request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except RangeNotSatisfiable:
+            f.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = str(size)
+        return response
+
+    start, end = byte_range
+    response = FileResponse(_RangeFile(f, start, end - start + 1), status=206, content_type=content_type)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(end - start + 1)
+    return response
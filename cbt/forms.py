@@ -1,5 +1,9 @@
+import os
+import zipfile
 from django import forms
 from .models import Exam
+from .image_pdf import zip_page_count
+from .parse_answer_key import AnswerKeyError, read_key_rows
 
 class ExamForm(forms.ModelForm):
     class Meta:
@@ -9,3 +13,25 @@ class ExamForm(forms.ModelForm):
             'description': forms.Textarea(attrs={'rows': 3}),
             'duration_minutes': forms.NumberInput(attrs={'min': 1}),
         }
+
+    def clean_question_paper(self):
+        # A ZIP must hold the page images; check before anything is converted
+        paper = self.cleaned_data['question_paper']
+        if paper and os.path.splitext(paper.name)[1].lower() == '.zip':
+            try:
+                pages = zip_page_count(paper)
+            except zipfile.BadZipFile:
+                raise forms.ValidationError("The question paper is not a valid ZIP archive.")
+            if not pages:
+                raise forms.ValidationError("The ZIP archive contains no JPG or PNG pages.")
+        return paper
+
+    def clean_answer_key_file(self):
+        # Reject a broken key with its line number instead of failing after the exam is saved
+        key_file = self.cleaned_data['answer_key_file']
+        try:
+            for _ in read_key_rows(key_file):
+                pass
+        except AnswerKeyError as exc:
+            raise forms.ValidationError(str(exc))
+        return key_file
@@ -0,0 +1,215 @@
+import re
+import struct
+import zipfile
+from io import BytesIO
+
+import img2pdf
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG colour types with an alpha channel (grey + alpha, RGBA)
+PNG_ALPHA_TYPES = (4, 6)
+
+# PDF colour spaces and colour counts of what img2pdf embeds as-is
+COLORSPACES = {'1': (b'/DeviceGray', 1), 'L': (b'/DeviceGray', 1), 'RGB': (b'/DeviceRGB', 3),
+               'CMYK': (b'/DeviceCMYK', 4), 'CMYK;I': (b'/DeviceCMYK', 4), 'P': (None, 1)}
+
+
+def _natural_key(name):
+    # "page2.jpg" sorts before "page10.jpg"
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name.lower())]
+
+
+def page_entries(archive):
+    """
+    Image entries of a ZIP in page order, skipping folders, hidden files and
+    the __MACOSX metadata some archivers add.
+    """
+    entries = []
+    for info in archive.infolist():
+        parts = info.filename.split('/')
+        if info.is_dir() or parts[0] == '__MACOSX' or parts[-1].startswith('.'):
+            continue
+        if info.filename.lower().endswith(IMAGE_EXTENSIONS):
+            entries.append(info)
+    return sorted(entries, key=lambda info: _natural_key(info.filename))
+
+
+def zip_page_count(fileobj):
+    # Raises zipfile.BadZipFile for anything that isn't a ZIP
+    with zipfile.ZipFile(fileobj) as archive:
+        return len(page_entries(archive))
+
+
+def _png_chunks(data):
+    # Types of the chunks before the image data
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        yield kind
+        if kind == b'IDAT':
+            return
+        offset += 12 + length
+
+
+def needs_decoding(data):
+    """
+    Whether an image has to be decoded before img2pdf can take it. JPEGs and
+    plain 8-bit PNGs are embedded as they are; PNGs with transparency or 16-bit
+    channels are not.
+    """
+    if not data.startswith(PNG_SIGNATURE) or len(data) < 26:
+        return False
+    depth, color_type = data[24], data[25]
+    if color_type in PNG_ALPHA_TYPES or depth > 8:
+        return True
+    return b'tRNS' in _png_chunks(data)
+
+
+def flatten_image(data):
+    """
+    Decodes an image img2pdf can't embed and re-encodes it as a lossless 8-bit
+    PNG, with transparency flattened onto white. Runs in a worker process.
+    """
+    image = Image.open(BytesIO(data))
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, 'white')
+        flat.paste(image, mask=image.getchannel('A'))
+        image = flat
+    elif image.mode not in ('1', 'L', 'RGB', 'P'):
+        image = image.convert('RGB')
+    out = BytesIO()
+    image.save(out, format='PNG')
+    return out.getvalue()
+
+
+def paper_images(fileobj, zipped):
+    """
+    Yields the encoded images of an uploaded paper one at a time: the entries
+    of a ZIP in page order, or the file itself.
+    """
+    fileobj.seek(0)
+    if not zipped:
+        yield fileobj.read()
+        return
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in page_entries(archive):
+            yield archive.read(info)
+
+
+def write_pdf(images, out, decode=flatten_image):
+    """
+    Streams images into a PDF on out. Images img2pdf can't embed directly go
+    through decode (e.g. flatten_image in a process pool) first.
+    """
+    writer = ImagePdfWriter(out)
+    for data in images:
+        writer.add_image(decode(data) if needs_decoding(data) else data)
+    writer.close()
+
+
+def _dict(entries):
+    return b'<< ' + b' '.join(b'/%s %s' % (key.encode(), value) for key, value in entries.items()) + b' >>'
+
+
+class ImagePdfWriter:
+    """
+    Writes a PDF with one page per image straight to a binary file, keeping only
+    the current page in memory. Images are parsed by img2pdf and embedded
+    without re-encoding: JPEG data as DCT, PNG data as Flate with predictors.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.offsets = [None, None]  # 1: catalog, 2: page tree; written last
+        self.pages = []
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self.position = out.tell()
+
+    def _reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def _write(self, number, body, stream=None):
+        self.offsets[number - 1] = self.position
+        chunks = [b'%d 0 obj\n' % number, body]
+        if stream is not None:
+            chunks += [b'\nstream\n', stream, b'\nendstream']
+        chunks.append(b'\nendobj\n')
+        for chunk in chunks:
+            self.out.write(chunk)
+            self.position += len(chunk)
+
+    def _image(self, color, imgformat, data, width, height, palette, depth, iccp):
+        name = color.name
+        if name not in COLORSPACES:
+            raise ValueError(f"Unsupported image colour space {name}.")
+        colorspace, colors = COLORSPACES[name]
+        if name == 'P':
+            colorspace = b'[/Indexed /DeviceRGB %d <%s>]' % (len(palette) // 3 - 1, bytes(palette).hex().encode())
+        if iccp is not None and name != 'P':
+            profile = self._reserve()
+            self._write(profile, _dict({'N': b'%d' % colors, 'Alternate': colorspace, 'Length': b'%d' % len(iccp)}), iccp)
+            colorspace = b'[/ICCBased %d 0 R]' % profile
+
+        entries = {'Type': b'/XObject', 'Subtype': b'/Image', 'Width': b'%d' % width, 'Height': b'%d' % height,
+                   'ColorSpace': colorspace, 'BitsPerComponent': b'%d' % depth}
+        if imgformat == img2pdf.ImageFormat.JPEG:
+            entries['Filter'] = b'/DCTDecode'
+            if name == 'CMYK;I':
+                # Adobe JPEGs store CMYK inverted
+                entries['Decode'] = b'[1 0 1 0 1 0 1 0]'
+        elif imgformat == img2pdf.ImageFormat.PNG:
+            entries['Filter'] = b'/FlateDecode'
+            entries['DecodeParms'] = _dict({'Predictor': b'15', 'Colors': b'%d' % colors,
+                                            'Columns': b'%d' % width, 'BitsPerComponent': b'%d' % depth})
+        else:
+            raise ValueError(f"Unsupported image format {imgformat.name}.")
+        entries['Length'] = b'%d' % len(data)
+
+        image = self._reserve()
+        self._write(image, _dict(entries), data)
+        return image
+
+    def add_image(self, data):
+        """
+        Appends the page(s) of one encoded image. Raises ValueError for images
+        that need flatten_image() first.
+        """
+        for (color, dpi, imgformat, imgdata, smask, width, height,
+             palette, _inverted, depth, rotation, iccp) in img2pdf.read_images(data, None):
+            if smask is not None:
+                raise ValueError("Images with transparency must be flattened first.")
+            image = self._image(color, imgformat, imgdata, width, height, palette, depth, iccp)
+
+            # Page size follows the image's resolution, like img2pdf's default layout
+            page_width, page_height = width * 72 / dpi[0], height * 72 / dpi[1]
+            content_stream = b'q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q' % (page_width, page_height)
+            content = self._reserve()
+            self._write(content, _dict({'Length': b'%d' % len(content_stream)}), content_stream)
+
+            page = self._reserve()
+            entries = {'Type': b'/Page', 'Parent': b'2 0 R',
+                       'MediaBox': b'[0 0 %.4f %.4f]' % (page_width, page_height),
+                       'Resources': b'<< /XObject << /Im0 %d 0 R >> >>' % image, 'Contents': b'%d 0 R' % content}
+            if rotation:
+                entries['Rotate'] = b'%d' % rotation
+            self._write(page, _dict(entries))
+            self.pages.append(page)
+
+    def close(self):
+        if not self.pages:
+            raise ValueError("No pages to write.")
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self._write(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.pages)))
+        self._write(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref = [b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.offsets) + 1)]
+        xref += [b'%010d 00000 n \n' % offset for offset in self.offsets]
+        xref.append(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (len(self.offsets) + 1, self.position))
+        self.out.write(b''.join(xref))
@@ -0,0 +1,157 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .answer_key import from_cents, get_compiled_key, to_cents
+from .exam_stats import rebuild_exam_stats
+from .models import Attempt, QuestionMeta, Response
+from .parse_answer_key import get_sections, read_key_rows
+from .scoring_logic import score_responses
+from .versions import bump_exam_version
+
+# Fields whose change alters the marks of existing responses
+SCORING_FIELDS = ('question_type', 'correct_answer', 'marks_positive', 'marks_negative')
+
+# Response rows re-scored per round trip
+RESCORE_CHUNK_SIZE = 2000
+
+
+def _rescore_questions(exam_id, question_ids, chunk_size):
+    """
+    Re-scores the responses of the given questions in scored attempts and returns
+    {attempt id: marks delta in hundredths}. Only rows whose result changed are written.
+    """
+    key = get_compiled_key(exam_id)
+    deltas = defaultdict(int)
+    responses = Response.objects.filter(
+        question_id__in=question_ids, attempt__total_score__isnull=False
+    ).order_by('id')
+
+    # Keyset pagination rather than an open cursor, since each chunk writes back to the table
+    rescored, last_id = 0, 0
+    while True:
+        chunk = list(responses.filter(id__gt=last_id).values_list(
+            'id', 'attempt_id', 'question_id', 'user_input', 'status', 'is_correct', 'marks_awarded'
+        )[:chunk_size])
+        if not chunk:
+            return deltas, rescored
+        rescored += _rescore_chunk(key, chunk, deltas)
+        last_id = chunk[-1][0]
+
+
+def _rescore_chunk(key, chunk, deltas):
+    response_ids, attempt_col, question_col, user_values, statuses, was_correct, old_marks = zip(*chunk)
+    is_correct, marks = score_responses(key, [key.position[q_id] for q_id in question_col], user_values, statuses)
+
+    changed = []
+    for r_id, attempt_id, ok, old_ok, new, old in zip(response_ids, attempt_col, is_correct, was_correct, marks, old_marks):
+        diff = int(new) - to_cents(old)
+        if diff or bool(ok) != old_ok:
+            changed.append(Response(id=r_id, is_correct=bool(ok), marks_awarded=from_cents(new)))
+            deltas[attempt_id] += diff
+    Response.objects.bulk_update(changed, ['is_correct', 'marks_awarded'])
+    return len(changed)
+
+
+def _add_unvisited_responses(exam_id, question_ids, chunk_size):
+    # Submitted attempts have a Response per question, so new questions start there as not visited
+    attempts = Attempt.objects.filter(exam_id=exam_id, is_submitted=True).order_by('id')
+    per_chunk = max(1, chunk_size // len(question_ids))
+    last_id = 0
+    while True:
+        attempt_ids = list(attempts.filter(id__gt=last_id).values_list('id', flat=True)[:per_chunk])
+        if not attempt_ids:
+            return
+        Response.objects.bulk_create([
+            Response(attempt_id=attempt_id, question_id=q_id, user_input=None, status='not_visited')
+            for attempt_id in attempt_ids for q_id in question_ids
+        ])
+        last_id = attempt_ids[-1]
+
+
+def _apply_deltas(deltas, chunk_size):
+    # Attempts sharing a delta are adjusted by one UPDATE, relative to whatever total is stored.
+    # Those whose marks moved without changing the total still get a new scored_at.
+    now = timezone.now()
+    by_delta = defaultdict(list)
+    for attempt_id, cents in deltas.items():
+        by_delta[cents].append(attempt_id)
+    for cents, attempt_ids in by_delta.items():
+        fields = {'scored_at': now}
+        if cents:
+            fields['total_score'] = F('total_score') + from_cents(cents)
+        for start in range(0, len(attempt_ids), chunk_size):
+            Attempt.objects.filter(id__in=attempt_ids[start:start + chunk_size]).update(**fields)
+    return sum(len(ids) for cents, ids in by_delta.items() if cents)
+
+
+def revise_answer_key(exam, key_file, chunk_size=RESCORE_CHUNK_SIZE):
+    """
+    Applies a corrected answer key to an exam that already has attempts.
+
+    Questions are matched by number and updated in place, so responses survive.
+    Only responses to questions whose scoring changed are re-scored, and each
+    scored attempt's total_score is adjusted by its marks delta. Questions missing
+    from the new key are removed, with their marks taken off the totals first;
+    new ones get a not-visited Response in every submitted attempt, scored like
+    any other. Exam statistics are rebuilt once the revision commits.
+    Returns a summary dict of what changed.
+    """
+    rows = {row['question_number']: row for row in read_key_rows(key_file)}
+
+    with transaction.atomic():
+        existing = {q.question_number: q for q in QuestionMeta.objects.filter(exam=exam).select_related('section')}
+        sections = get_sections(exam, dict.fromkeys(row['section'] for row in rows.values()))
+
+        changed, rescore, created = [], [], []
+        for number, row in rows.items():
+            section = sections[row.pop('section')]
+            question = existing.get(number)
+            if question is None:
+                created.append(QuestionMeta(exam=exam, section=section, **row))
+                continue
+            if any(getattr(question, field) != row[field] for field in SCORING_FIELDS):
+                rescore.append(question.id)
+            elif question.section_id == section.id:
+                continue
+            for field, value in row.items():
+                setattr(question, field, value)
+            question.section = section
+            changed.append(question)
+
+        removed = [q.id for number, q in existing.items() if number not in rows]
+        deltas = defaultdict(int)
+        for attempt_id, marks in Response.objects.filter(
+            question_id__in=removed, attempt__total_score__isnull=False
+        ).exclude(marks_awarded=0).values_list('attempt_id', 'marks_awarded'):
+            deltas[attempt_id] -= to_cents(marks)
+        QuestionMeta.objects.filter(id__in=removed).delete()
+
+        QuestionMeta.objects.bulk_update(changed, ('section',) + SCORING_FIELDS)
+        QuestionMeta.objects.bulk_create(created)
+        if created:
+            new_ids = [q.id for q in created]
+            _add_unvisited_responses(exam.id, new_ids, chunk_size)
+            rescore += new_ids
+        # Bulk writes skip post_save, so invalidate compiled keys before re-scoring
+        bump_exam_version(exam.id)
+
+        rescored = 0
+        if rescore:
+            question_deltas, rescored = _rescore_questions(exam.id, rescore, chunk_size)
+            for attempt_id, cents in question_deltas.items():
+                deltas[attempt_id] += cents
+        adjusted = _apply_deltas(deltas, chunk_size)
+        # Totals moved in bulk, so rank and difficulty are recounted, outside this
+        # transaction so submits aren't held behind the recount
+        transaction.on_commit(lambda: rebuild_exam_stats(exam.id))
+
+    return {
+        'updated': len(changed),
+        'created': len(created),
+        'removed': len(removed),
+        'rescored_responses': rescored,
+        'adjusted_attempts': adjusted,
+    }
@@ -0,0 +1,96 @@
+import json
+import logging
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from cbt.benchmark.candidate import Candidate
+from cbt.benchmark.metrics import Recorder
+from cbt.benchmark.provision import provision
+from cbt.benchmark.server import BenchmarkServer
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Provisions candidates and an exam, drives concurrent exam sessions against the real URLs "
+            "and reports throughput, latency percentiles, queries and errors per endpoint as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--candidates', type=int, default=50, help="Concurrent candidates (default: 50).")
+        parser.add_argument('--questions', type=int, default=65, help="Questions in the generated exam (default: 65).")
+        parser.add_argument('--duration', type=float, default=60,
+                            help="Seconds from the first start to the shared submit deadline (default: 60).")
+        parser.add_argument('--sync-interval', type=float, default=10, help="Seconds between syncs (default: 10).")
+        parser.add_argument('--ramp', type=float, default=5, help="Seconds over which candidates start (default: 5).")
+        parser.add_argument('--url', help="Benchmark a running server instead of an in-process one. It must use "
+                                          "the same database; queries and lock errors are then not reported.")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--label', help="Free-form label stored in the report (default: git revision).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for candidate behaviour.")
+        parser.add_argument('--keep', action='store_true', help="Keep the provisioned exam, users and attempts.")
+
+    def handle(self, *args, **options):
+        if options['candidates'] < 1:
+            raise CommandError("--candidates must be at least 1.")
+        self.stderr.write(f"Provisioning {options['candidates']} candidate(s)...")
+        fixture = provision(options['candidates'], options['questions'])
+        recorder = Recorder()
+        recorder.server_side = not options['url']
+        if recorder.server_side:
+            # Failed requests are counted in the report; their tracebacks would drown the progress output
+            logging.getLogger('django.request').setLevel(logging.CRITICAL)
+
+        try:
+            with (BenchmarkServer(recorder) if recorder.server_side else nullcontext()) as server:
+                base_url = server.url if server else options['url']
+                self.stderr.write(f"Running against {base_url} for {options['duration']:.0f}s...")
+
+                recorder.start()
+                start = time.time() + 1
+                submit_at = start + options['duration']
+                candidates = [
+                    Candidate(base_url, key, fixture.exam.slug, recorder, seed=options['seed'] * 100003 + i)
+                    for i, key in enumerate(fixture.session_keys)
+                ]
+                with ThreadPoolExecutor(len(candidates)) as pool:
+                    futures = [
+                        pool.submit(c.run, start + options['ramp'] * i / len(candidates), submit_at,
+                                    options['sync_interval'])
+                        for i, c in enumerate(candidates)
+                    ]
+                    for future in futures:
+                        future.result()
+                recorder.finish()
+        finally:
+            if not options['keep']:
+                fixture.delete()
+
+        report = {
+            'label': options['label'] or _git_revision(),
+            'finished_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': sys.version.split()[0],
+            'config': {name: options[name] for name in ('candidates', 'questions', 'duration', 'sync_interval',
+                                                        'ramp', 'seed')},
+            **recorder.report(),
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(output)
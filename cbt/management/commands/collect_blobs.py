@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from cbt.blobs import BLOB_GRACE, adopt_exam_files, collect_blobs
+
+
+class Command(BaseCommand):
+    help = ("Deletes question papers and answer keys no exam references any more, with the page images "
+            "and question labels derived from them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=BLOB_GRACE.total_seconds() / 60,
+                            help="Minutes a file must have been unreferenced (default: %(default)s).")
+        parser.add_argument('--adopt', action='store_true',
+                            help="First move files stored under upload names into content-addressed storage, "
+                                 "collapsing duplicate copies.")
+
+    def handle(self, *args, **options):
+        if options['adopt']:
+            self.stdout.write(f"Moved {adopt_exam_files()} exam file(s) into content-addressed storage.")
+        deleted = collect_blobs(timedelta(minutes=options['min_age']))
+        self.stdout.write(f"Deleted {len(deleted)} unreferenced file(s).")
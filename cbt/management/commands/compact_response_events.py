@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from cbt.event_log import compact_response_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Folds logged response events into attempt states and deletes expired events "
+        "(once, or every --interval seconds)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and compact every N seconds.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            compacted, deleted = compact_response_events()
+            self.stdout.write(f"Compacted {compacted} attempt(s), deleted {deleted} expired event(s).")
+            if not interval:
+                return
+            close_old_connections()
+            time.sleep(interval)
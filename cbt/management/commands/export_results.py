@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cbt.models import Exam
+from cbt.results_export import LAYOUTS, csv_chunks, long_rows, parquet_available, parquet_chunks, wide_rows
+
+
+class Command(BaseCommand):
+    help = "Streams every submitted attempt's responses and marks for an exam as CSV (or Parquet)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help="Exam slug.")
+        parser.add_argument('--layout', choices=LAYOUTS, default='wide',
+                            help="wide: one row per attempt; long: one row per response (default: wide).")
+        parser.add_argument('--format', choices=('csv', 'parquet'), default='csv',
+                            help="parquet needs pyarrow and is always in the long layout.")
+        parser.add_argument('--output', help="File to write instead of stdout.")
+
+    def handle(self, *args, **options):
+        try:
+            exam = Exam.objects.get(slug=options['slug'])
+        except Exam.DoesNotExist:
+            raise CommandError(f"No exam with slug {options['slug']!r}.")
+
+        if options['format'] == 'parquet':
+            if not parquet_available():
+                raise CommandError("Parquet export needs pyarrow (pip install pyarrow).")
+            if not options['output']:
+                raise CommandError("Parquet export needs --output.")
+            with open(options['output'], 'wb') as f:
+                for chunk in parquet_chunks(exam):
+                    f.write(chunk)
+            return
+
+        rows = wide_rows(exam) if options['layout'] == 'wide' else long_rows(exam)
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                f.writelines(csv_chunks(rows))
+        else:
+            for chunk in csv_chunks(rows):
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from cbt.deadlines import finalize_expired_attempts
+
+
+class Command(BaseCommand):
+    help = ("Submits and scores unsubmitted attempts whose deadline has passed "
+            "(once, or every --interval seconds).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and sweep every N seconds.")
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Attempts finalized per transaction (default: 200).")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            finalized = finalize_expired_attempts(batch_size=options['batch_size'])
+            self.stdout.write(f"Finalized {finalized} expired attempt(s).")
+            if not interval:
+                return
+            close_old_connections()
+            time.sleep(interval)
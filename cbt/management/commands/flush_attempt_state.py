@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from cbt.state_buffer import flush_buffered_states
+
+
+class Command(BaseCommand):
+    help = "Flushes write-behind attempt states to the database (once, or every --interval seconds)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and sweep every N seconds.")
+        parser.add_argument('--overdue', action='store_true',
+                            help="Only flush states older than CBT_SYNC_MAX_UNFLUSHED_AGE.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        max_age = getattr(settings, 'CBT_SYNC_MAX_UNFLUSHED_AGE', 30) if options['overdue'] else None
+        while True:
+            written = flush_buffered_states(max_age=max_age)
+            self.stdout.write(f"Flushed {written} attempt state(s).")
+            if not interval:
+                return
+            close_old_connections()
+            time.sleep(interval)
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from cbt.exam_stats import fold_exam_stats
+
+
+class Command(BaseCommand):
+    help = "Folds scoring's statistics deltas into rank and difficulty statistics (once, or every --interval seconds)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and fold every N seconds.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            changed = fold_exam_stats()
+            self.stdout.write(f"Folded statistics of {len(changed)} exam(s).")
+            if not interval:
+                return
+            close_old_connections()
+            time.sleep(interval)
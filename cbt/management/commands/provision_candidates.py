@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cbt.models import Exam
+from cbt.roster import RosterError, provision_candidates, read_roster
+
+
+class Command(BaseCommand):
+    help = ("Creates candidate users from a roster CSV (username, password, email, first_name, last_name) "
+            "and optionally pre-creates their attempts for the given exams.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('roster', help="Path to the roster CSV.")
+        parser.add_argument('--exam', action='append', default=[], metavar='SLUG',
+                            help="Pre-create an attempt on this exam for every candidate (repeatable).")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Processes hashing passwords (default: one per CPU).")
+
+    def handle(self, *args, **options):
+        exams = list(Exam.objects.filter(slug__in=options['exam']))
+        missing = set(options['exam']) - {exam.slug for exam in exams}
+        if missing:
+            raise CommandError(f"No exam with slug {', '.join(sorted(missing))}.")
+
+        with open(options['roster'], 'rb') as f:
+            try:
+                candidates = read_roster(f)
+            except RosterError as exc:
+                raise CommandError(str(exc))
+        summary = provision_candidates(candidates, exams, processes=options['processes'])
+        self.stdout.write(", ".join(f"{name.replace('_', ' ')}: {count}" for name, count in summary.items()))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from cbt.exam_stats import rebuild_exam_stats
+from cbt.models import Exam
+
+
+class Command(BaseCommand):
+    help = "Recomputes rank, percentile and question difficulty statistics from scored attempts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help="Exams to rebuild (default: all).")
+
+    def handle(self, *args, **options):
+        exams = Exam.objects.all()
+        if options['slugs']:
+            exams = exams.filter(slug__in=options['slugs'])
+        for exam in exams:
+            stats = rebuild_exam_stats(exam.id)
+            self.stdout.write(f"{exam.slug}: {stats.attempts} scored attempt(s)")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from cbt.models import Exam
+from cbt.page_images import page_manifest, schedule_page_render
+from cbt.question_index import index_exam_questions
+
+
+class Command(BaseCommand):
+    help = "Renders question paper page images and indexes question pages for exams that don't have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help="Exams to render (default: all).")
+
+    def handle(self, *args, **options):
+        exams = Exam.objects.all()
+        if options['slugs']:
+            exams = exams.filter(slug__in=options['slugs'])
+        for exam in exams:
+            exam.ensure_paper_digest()
+            schedule_page_render(exam, wait=True)
+            indexed = index_exam_questions(exam, wait=True)
+            manifest = page_manifest(exam.paper_digest)
+            status = f"{manifest['pages']} page(s)" if manifest else "skipped"
+            if indexed is not None:
+                status += f", {indexed} question(s) re-indexed"
+            self.stdout.write(f"{exam.slug}: {status}")
@@ -0,0 +1,36 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cbt.event_log import response_history
+from cbt.models import Attempt, QuestionMeta
+
+
+class Command(BaseCommand):
+    help = "Prints every logged change of an attempt's answers as CSV, oldest first (needs CBT_SYNC_EVENT_LOG)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('attempt_id', type=int)
+        parser.add_argument('--question', type=int, help="Only this question number (resets are always shown).")
+
+    def handle(self, *args, **options):
+        try:
+            attempt = Attempt.objects.get(id=options['attempt_id'])
+        except Attempt.DoesNotExist:
+            raise CommandError(f"No attempt with id {options['attempt_id']}.")
+        numbers = dict(QuestionMeta.objects.filter(exam_id=attempt.exam_id).values_list('id', 'question_number'))
+
+        question_id = None
+        if options['question'] is not None:
+            question_id = next((q_id for q_id, number in numbers.items() if number == options['question']), None)
+            if question_id is None:
+                raise CommandError(f"The exam has no question {options['question']}.")
+
+        writer = csv.writer(self.stdout)
+        writer.writerow(['seq', 'question_number', 'value', 'status', 'client_ts', 'created_at'])
+        for event in response_history(attempt, question_id):
+            number = 'reset' if event['question_id'] is None else numbers.get(event['question_id'], '')
+            writer.writerow([
+                event['seq'], number, event['value'] or '', event['status'] or '',
+                event['client_ts'].isoformat() if event['client_ts'] else '', event['created_at'].isoformat(),
+            ])
@@ -0,0 +1,27 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from cbt.key_revision import revise_answer_key
+from cbt.models import Exam
+
+
+class Command(BaseCommand):
+    help = "Applies a corrected answer key to an exam and re-scores only the affected responses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help="Slug of the exam to revise.")
+        parser.add_argument('key_file', help="Path to the corrected answer key CSV.")
+
+    def handle(self, *args, **options):
+        try:
+            exam = Exam.objects.get(slug=options['slug'])
+        except Exam.DoesNotExist:
+            raise CommandError(f"Exam '{options['slug']}' does not exist.")
+
+        with open(options['key_file'], 'rb') as f:
+            summary = revise_answer_key(exam, File(f))
+            # Keep the stored key in line with the questions
+            exam.answer_key_file.save(os.path.basename(options['key_file']), File(f))
+        self.stdout.write(", ".join(f"{name.replace('_', ' ')}: {count}" for name, count in summary.items()))
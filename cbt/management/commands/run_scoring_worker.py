@@ -0,0 +1,84 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from cbt.exam_stats import fold_exam_stats
+from cbt.scoring_queue import claim_jobs, run_claimed, run_pending_jobs
+
+
+def _init_process():
+    # Spawned children start from a clean interpreter; manage.py already set DJANGO_SETTINGS_MODULE
+    django.setup()
+
+
+def _score_chunk(token, attempt_ids):
+    try:
+        return run_claimed(token, attempt_ids)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = ("Drains the scoring queue, scoring claimed batches in a process pool, and folds the "
+            "resulting statistics deltas.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                            help="Scoring processes (1 scores in this process).")
+        parser.add_argument('--batch-size', type=int, default=200, help="Attempts per scoring batch.")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        processes, batch_size = options['processes'], options['batch_size']
+        if processes <= 1:
+            while True:
+                scored = run_pending_jobs(batch_size)
+                fold_exam_stats()
+                self._report(scored)
+                if options['once']:
+                    return
+                close_old_connections()
+                time.sleep(options['poll_interval'])
+
+        pool = self._pool(processes)
+        try:
+            while True:
+                # One claim per pool slot keeps every process busy while the queue is deep
+                claims = [claim_jobs(batch_size) for _ in range(processes)]
+                claims = [(token, ids) for token, ids in claims if ids]
+                if not claims:
+                    # Statistics are folded here, once, rather than by every scoring process
+                    fold_exam_stats()
+                    if options['once']:
+                        return
+                    close_old_connections()
+                    time.sleep(options['poll_interval'])
+                    continue
+                try:
+                    scored = sum(pool.map(_score_chunk, *zip(*claims)))
+                except BrokenProcessPool:
+                    # Unfinished claims are picked up again when their lease expires
+                    self.stderr.write("Scoring process died; restarting the pool.")
+                    pool.shutdown(cancel_futures=True)
+                    pool = self._pool(processes)
+                    continue
+                self._report(scored)
+        finally:
+            pool.shutdown()
+
+    def _pool(self, processes):
+        # Connections must not be shared with child processes
+        connections.close_all()
+        return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_process)
+
+    def _report(self, scored):
+        if scored:
+            self.stdout.write(f"Scored {scored} attempt(s).")
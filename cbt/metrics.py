@@ -0,0 +1,317 @@
+import functools
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+# Upper bounds of the latency histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+FAMILIES = {
+    'cbt_request_duration_seconds': ('histogram', "Request latency by URL name."),
+    'cbt_responses_total': ('counter', "Responses by URL name and status class."),
+    'cbt_response_bytes_total': ('counter', "Response body bytes by URL name."),
+    'cbt_db_queries_total': ('counter', "SQL queries run while serving requests, by URL name."),
+    'cbt_db_query_seconds_total': ('counter', "Time spent in SQL queries while serving requests, by URL name."),
+    'cbt_operation_duration_seconds': ('histogram', "Duration of scoring and answer key imports."),
+}
+
+# Sample suffixes in exposition order
+SUFFIXES = ('_bucket', '_sum', '_count', '')
+
+
+def metrics_enabled():
+    return getattr(settings, 'CBT_METRICS', False)
+
+
+class MemoryValues:
+    """
+    Sample values of this process only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+_HEADER = struct.Struct('<Q')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+def _entry_size(encoded_key):
+    # Key padded so the value after it is 8-byte aligned
+    return _KEY_LENGTH.size + len(encoded_key) + (-(_KEY_LENGTH.size + len(encoded_key)) % 8) + _VALUE.size
+
+
+def _entries(buffer):
+    """
+    (key, value offset) of each entry committed in the header, so an append
+    in progress by the owning process is either seen whole or not at all.
+    """
+    if len(buffer) < _HEADER.size:
+        return
+    used = min(_HEADER.unpack_from(buffer)[0], len(buffer))
+    pos = _HEADER.size
+    while pos < used:
+        length = _KEY_LENGTH.unpack_from(buffer, pos)[0]
+        encoded = bytes(buffer[pos + _KEY_LENGTH.size:pos + _KEY_LENGTH.size + length])
+        size = _entry_size(encoded)
+        yield encoded.decode(), pos + size - _VALUE.size
+        pos += size
+
+
+def read_mmap_values(path):
+    """
+    (key, value) pairs of a MmapValues file, written by any process.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [(key, _VALUE.unpack_from(data, offset)[0]) for key, offset in _entries(data)]
+
+
+class MmapValues:
+    """
+    Sample values of this process in a memory-mapped file of its own, so other
+    processes (Gunicorn workers, the scoring worker) can be summed by whoever
+    serves /metrics. Updating a known key is a single 8-byte write; new keys
+    are appended and then committed by bumping the header.
+    """
+
+    def __init__(self, path, initial_size=64 * 1024):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        size = max(os.fstat(self._file.fileno()).st_size, initial_size)
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = _HEADER.unpack_from(self._map)[0] or _HEADER.size
+        # A file left by an exited process with the same pid is carried on
+        self._offsets = dict(_entries(self._map))
+
+    def _append(self, key):
+        encoded = key.encode()
+        size = _entry_size(encoded)
+        if self._used + size > len(self._map):
+            new_size = max(len(self._map) * 2, self._used + size)
+            self._map.close()
+            self._file.truncate(new_size)
+            self._map = mmap.mmap(self._file.fileno(), new_size)
+        _KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _KEY_LENGTH.size:self._used + _KEY_LENGTH.size + len(encoded)] = encoded
+        offset = self._used + size - _VALUE.size
+        _VALUE.pack_into(self._map, offset, 0.0)
+        self._used += size
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key, amount):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._append(key)
+            _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + amount)
+
+    def items(self):
+        with self._lock:
+            return [(key, _VALUE.unpack_from(self._map, offset)[0]) for key, offset in self._offsets.items()]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _store():
+    # Keyed by pid so a worker forked from a preloaded master gets its own file
+    directory = getattr(settings, 'CBT_METRICS_DIR', None)
+    key = (os.getpid(), directory)
+    store = _stores.get(key)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                    store = MmapValues(os.path.join(directory, f'metrics-{os.getpid()}.db'))
+                else:
+                    store = MemoryValues()
+                _stores[key] = store
+    return store
+
+
+def _key(family, suffix, labels):
+    return json.dumps([family, suffix, sorted(labels.items())], separators=(',', ':'))
+
+
+def inc(family, amount=1, **labels):
+    _store().inc(_key(family, '', labels), amount)
+
+
+def observe(family, value, buckets=DURATION_BUCKETS, **labels):
+    store = _store()
+    # Buckets are stored cumulatively, as they are exposed
+    for bound in buckets:
+        if value <= bound:
+            store.inc(_key(family, '_bucket', {**labels, 'le': bound}), 1)
+    store.inc(_key(family, '_bucket', {**labels, 'le': math.inf}), 1)
+    store.inc(_key(family, '_sum', labels), value)
+    store.inc(_key(family, '_count', labels), 1)
+
+
+def collect():
+    """
+    Sample values summed over every process writing to CBT_METRICS_DIR, or of
+    this process alone when it isn't set. Files of exited processes are kept
+    so counters never go backwards; clear the directory when (re)starting.
+    """
+    directory = getattr(settings, 'CBT_METRICS_DIR', None)
+    if directory:
+        paths = glob.glob(os.path.join(directory, 'metrics-*.db'))
+        items = [item for path in paths for item in read_mmap_values(path)]
+    else:
+        items = _store().items()
+    totals = {}
+    for key, value in items:
+        totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_prometheus(totals):
+    """
+    Prometheus text exposition format (version 0.0.4) of collect() output.
+    """
+    samples = {}
+    for key, value in totals.items():
+        family, suffix, labels = json.loads(key)
+        labels = dict(labels)
+        le = labels.pop('le', None)
+        group = tuple(sorted(labels.items()))
+        sort_key = (group, SUFFIXES.index(suffix), math.inf if le is None else le)
+        samples.setdefault(family, []).append((sort_key, suffix, labels, le, value))
+
+    lines = []
+    for family in sorted(samples):
+        kind, help_text = FAMILIES.get(family, ('untyped', ''))
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        for _, suffix, labels, le, value in sorted(samples[family], key=lambda sample: sample[0]):
+            if le is not None:
+                labels['le'] = _format_value(le)
+            label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+            lines.append(f'{family}{suffix}{{{label_text}}} {_format_value(value)}' if label_text
+                         else f'{family}{suffix} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def timed(operation):
+    """
+    Records how long the decorated function takes as
+    cbt_operation_duration_seconds{operation=...}, when metrics are enabled.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled():
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe('cbt_operation_duration_seconds', time.perf_counter() - started, operation=operation)
+        return wrapper
+    return decorator
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - started
+
+
+@contextmanager
+def counting_queries(request):
+    """
+    Counts the SQL queries of a request and the time spent in them (a
+    _QueryCounter). The outermost caller installs the execute_wrapper; nested
+    ones share it, so each query is wrapped once however many middlewares
+    want the count. The counter covers the whole request, so nested callers
+    take the difference over their part.
+    """
+    counter = getattr(request, '_cbt_query_counter', None)
+    if counter is not None:
+        yield counter
+        return
+    counter = request._cbt_query_counter = _QueryCounter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            yield counter
+    finally:
+        del request._cbt_query_counter
+
+
+class MetricsMiddleware:
+    """
+    Records latency, response size and SQL queries of each request by URL name.
+    Enabled with CBT_METRICS; it should come first in MIDDLEWARE so the whole
+    request is timed.
+    """
+
+    def __init__(self, get_response):
+        if not metrics_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with counting_queries(request) as counter:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        observe('cbt_request_duration_seconds', elapsed, view=view)
+        inc('cbt_responses_total', view=view, status=f'{response.status_code // 100}xx')
+        inc('cbt_db_queries_total', counter.queries, view=view)
+        inc('cbt_db_query_seconds_total', counter.seconds, view=view)
+        if response.has_header('Content-Length'):
+            inc('cbt_response_bytes_total', int(response['Content-Length']), view=view)
+        elif not response.streaming:
+            inc('cbt_response_bytes_total', len(response.content), view=view)
+        return response
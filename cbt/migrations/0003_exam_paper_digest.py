@@ -0,0 +1,20 @@
+# Generated by Django 6.0.1 on 2026-10-17 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0002_scoringjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="exam",
+            name="paper_digest",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=64
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 17:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0003_exam_paper_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="questionmeta",
+            name="pdf_page_offset",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 6.0.1 on 2026-10-17 17:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0004_questionmeta_pdf_page_offset"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuestionStats",
+            fields=[
+                (
+                    "question",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to="cbt.questionmeta",
+                    ),
+                ),
+                ("correct", models.IntegerField(default=0)),
+                ("incorrect", models.IntegerField(default=0)),
+                ("unattempted", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ExamStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("score_sum_cents", models.BigIntegerField(default=0)),
+                ("min_score_cents", models.BigIntegerField()),
+                ("size", models.PositiveIntegerField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "exam",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stats",
+                        to="cbt.exam",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ScoreNode",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("index", models.PositiveIntegerField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "exam",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="score_nodes",
+                        to="cbt.exam",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("exam", "index")},
+            },
+        ),
+    ]
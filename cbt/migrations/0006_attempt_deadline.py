@@ -0,0 +1,52 @@
+# Generated by Django 6.0.1 on 2026-10-17 17:45
+
+from datetime import timedelta
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_deadlines(apps, schema_editor):
+    Attempt = apps.get_model("cbt", "Attempt")
+    attempts = list(
+        Attempt.objects.filter(deadline__isnull=True)
+        .select_related("exam")
+        .only("id", "started_at", "exam__duration_minutes")
+    )
+    for attempt in attempts:
+        attempt.deadline = attempt.started_at + timedelta(
+            minutes=attempt.exam.duration_minutes
+        )
+    Attempt.objects.bulk_update(attempts, ["deadline"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0005_exam_stats"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="attempt",
+            name="deadline",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="attempt",
+            name="started_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="attempt",
+            index=models.Index(
+                fields=["is_submitted", "deadline"],
+                name="cbt_attempt_is_subm_01f246_idx",
+            ),
+        ),
+        migrations.RunPython(set_deadlines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 6.0.1 on 2026-10-17 17:52
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0006_attempt_deadline"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="attempt",
+            name="started_at",
+            field=models.DateTimeField(
+                blank=True, default=django.utils.timezone.now, editable=False, null=True
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="attempt",
+            index=models.Index(
+                fields=["user", "exam", "is_submitted"],
+                name="cbt_attempt_user_id_87ae4e_idx",
+            ),
+        ),
+    ]
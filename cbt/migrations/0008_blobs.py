@@ -0,0 +1,66 @@
+# Generated by Django 6.0.1 on 2026-10-17 18:04
+
+from collections import Counter
+
+import cbt.storage
+import django.core.validators
+from django.db import migrations, models
+
+
+def count_refs(apps, schema_editor):
+    Exam = apps.get_model("cbt", "Exam")
+    Blob = apps.get_model("cbt", "Blob")
+    refs = Counter()
+    for names in Exam.objects.values_list("question_paper", "answer_key_file"):
+        refs.update(name for name in names if name)
+    Blob.objects.bulk_create(
+        [Blob(name=name, refs=count) for name, count in refs.items()], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0007_attempt_pending_start"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Blob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("refs", models.PositiveIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="exam",
+            name="answer_key_file",
+            field=models.FileField(
+                storage=cbt.storage.blob_storage, upload_to="exams/keys/"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="exam",
+            name="question_paper",
+            field=models.FileField(
+                storage=cbt.storage.blob_storage,
+                upload_to="exams/pdfs/",
+                validators=[
+                    django.core.validators.FileExtensionValidator(
+                        allowed_extensions=["pdf", "jpg", "png", "zip"]
+                    )
+                ],
+            ),
+        ),
+        migrations.RunPython(count_refs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 6.0.1 on 2026-10-17 18:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_sync_seq(apps, schema_editor):
+    # Syncs before the event log kept their seq in current_state only
+    Attempt = apps.get_model("cbt", "Attempt")
+    attempts = []
+    for attempt in (
+        Attempt.objects.filter(is_submitted=False)
+        .only("id", "current_state")
+        .iterator()
+    ):
+        state = attempt.current_state
+        seq = state.get("seq", 0) if isinstance(state, dict) else 0
+        if seq:
+            attempt.sync_seq = seq
+            attempts.append(attempt)
+    Attempt.objects.bulk_update(attempts, ["sync_seq"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0008_blobs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="attempt",
+            name="sync_seq",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="ResponseEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("seq", models.PositiveIntegerField()),
+                ("value", models.CharField(blank=True, max_length=255, null=True)),
+                ("status", models.CharField(blank=True, max_length=50, null=True)),
+                ("client_ts", models.DateTimeField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "attempt",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="events",
+                        to="cbt.attempt",
+                    ),
+                ),
+                (
+                    "question",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="cbt.questionmeta",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["attempt", "seq", "question", "status", "value"],
+                        name="cbt_respons_attempt_57a016_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_sync_seq, migrations.RunPython.noop),
+    ]
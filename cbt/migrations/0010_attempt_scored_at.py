@@ -0,0 +1,27 @@
+# Generated by Django 6.0.1 on 2026-10-17 18:47
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_scored_at(apps, schema_editor):
+    Attempt = apps.get_model("cbt", "Attempt")
+    Attempt.objects.filter(total_score__isnull=False).update(
+        scored_at=F("completed_at")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0009_response_events"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="attempt",
+            name="scored_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_scored_at, migrations.RunPython.noop),
+    ]
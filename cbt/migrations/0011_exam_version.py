@@ -0,0 +1,21 @@
+# Generated by Django 6.0.1 on 2026-10-17 19:05
+
+import cbt.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0010_attempt_scored_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="exam",
+            name="version",
+            field=models.CharField(
+                default=cbt.models.new_exam_version, editable=False, max_length=32
+            ),
+        ),
+    ]
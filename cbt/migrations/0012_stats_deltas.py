@@ -0,0 +1,41 @@
+# Generated by Django 6.0.1 on 2026-10-17 20:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cbt", "0011_exam_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatsDelta",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("attempts", models.IntegerField()),
+                ("score_sum_cents", models.BigIntegerField()),
+                ("scores", models.JSONField()),
+                ("outcomes", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "exam",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stats_deltas",
+                        to="cbt.exam",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -1,11 +1,39 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator
 import os
-import img2pdf
-from PIL import Image
-from io import BytesIO
-from django.core.files.base import ContentFile
+import tempfile
+from django.core.files import File
+import hashlib
+import uuid
+from datetime import timedelta
+from .image_pdf import flatten_image, paper_images, write_pdf
+from .page_images import render_pool
+from .storage import blob_storage, digest_from_name
+
+
+def file_digest(field_file):
+    # Hash in chunks so large papers are never read into memory at once
+    digest = hashlib.sha256()
+    field_file.open('rb')
+    for chunk in field_file.chunks():
+        digest.update(chunk)
+    field_file.seek(0)
+    return digest.hexdigest()
+
+
+def new_exam_version():
+    return uuid.uuid4().hex
+
+
+def _flatten_in_pool(data):
+    # Decoding is CPU-bound, so keep it off the request thread
+    return render_pool().submit(flatten_image, data).result()
+
+
+# Exam fields kept in content-addressed storage and reference-counted through Blob
+FILE_FIELDS = ('question_paper', 'answer_key_file')
 
 
 class Exam(models.Model):
@@ -19,6 +47,7 @@ class Exam(models.Model):
     # The static artifact
     question_paper = models.FileField(
         upload_to='exams/pdfs/',
+        storage=blob_storage,
         validators=[FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'png', 'zip'])]
     )
 
@@ -27,32 +56,53 @@ class Exam(models.Model):
     total_marks = models.DecimalField(max_digits=6, decimal_places=2, default=100.00)
 
     # The Answer Key File (CSV/JSON) acts as the blueprint
-    answer_key_file = models.FileField(upload_to='exams/keys/')
+    answer_key_file = models.FileField(upload_to='exams/keys/', storage=blob_storage)
+
+    # SHA-256 of the question paper; derived artefacts (page images, ...) are stored under it
+    paper_digest = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+
+    # Replaced whenever the exam or its questions change; what is derived from them is cached under it
+    version = models.CharField(max_length=32, default=new_exam_version, editable=False)
 
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
 
     def save(self, *args, **kwargs):
-        # Convert image to PDF if uploaded
+        # Convert an image, or a ZIP of page images, to PDF if uploaded
         if self.question_paper:
             ext = os.path.splitext(self.question_paper.name)[1].lower()
-            if ext in ['.jpg', '.jpeg', '.png']:
-                image = Image.open(self.question_paper)
-                if image.mode == 'RGBA':
-                    image = image.convert('RGB')
+            if ext in ['.jpg', '.jpeg', '.png', '.zip'] and not self.question_paper._committed:
+                # Pages are streamed through a temporary file, so only one is in memory at a time
+                with tempfile.TemporaryFile() as pdf:
+                    write_pdf(paper_images(self.question_paper, ext == '.zip'), pdf, decode=_flatten_in_pool)
+                    pdf.seek(0)
+                    new_filename = os.path.splitext(self.question_paper.name)[0] + '.pdf'
+                    self.question_paper.save(new_filename, File(pdf), save=False)
+
+            if not self.question_paper._committed:
+                # Store it now rather than in pre_save: the stored name is the content digest
+                self.question_paper.save(self.question_paper.name, self.question_paper.file, save=False)
+            stored = getattr(self, '_stored_files', {})
+            if not self.paper_digest or self.question_paper.name != stored.get('question_paper'):
+                self.paper_digest = digest_from_name(self.question_paper.name) or file_digest(self.question_paper)
+                if kwargs.get('update_fields') is not None:
+                    kwargs['update_fields'] = {*kwargs['update_fields'], 'paper_digest'}
 
-                # We need to pass bytes or a file-like object to img2pdf if we don't have a filesystem path
-                # Since image is open, we can save it to bytes
-                img_byte_arr = BytesIO()
-                image.save(img_byte_arr, format=image.format)
-                img_byte_arr = img_byte_arr.getvalue()
-
-                pdf_bytes = img2pdf.convert(img_byte_arr)
-                new_filename = os.path.splitext(self.question_paper.name)[0] + '.pdf'
+        super().save(*args, **kwargs)
 
-                self.question_paper.save(new_filename, ContentFile(pdf_bytes), save=False)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        exam = super().from_db(db, field_names, values)
+        # Blob references are counted from what was loaded to what gets saved
+        exam._stored_files = {name: exam.__dict__[name] for name in FILE_FIELDS if name in exam.__dict__}
+        return exam
 
-        super().save(*args, **kwargs)
+    def ensure_paper_digest(self):
+        # Exams uploaded before digests were recorded get one on first use
+        if not self.paper_digest and self.question_paper:
+            self.paper_digest = digest_from_name(self.question_paper.name) or file_digest(self.question_paper)
+            Exam.objects.filter(pk=self.pk).update(paper_digest=self.paper_digest)
+        return self.paper_digest
 
     def __str__(self):
         return self.title
@@ -99,6 +149,8 @@ class QuestionMeta(models.Model):
 
     # Optional: If you want to map Q5 to Page 3 of the PDF
     pdf_page_number = models.PositiveIntegerField(default=1)
+    # Where the question label sits on that page (0 = top, 1 = bottom); null until indexed
+    pdf_page_offset = models.FloatField(null=True, blank=True)
 
     class Meta:
         unique_together = ('exam', 'question_number')
@@ -112,11 +164,16 @@ class Attempt(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attempts')
     exam = models.ForeignKey(Exam, on_delete=models.CASCADE)
 
-    started_at = models.DateTimeField(auto_now_add=True)
+    # None for attempts pre-created by provision_candidates until the candidate starts
+    started_at = models.DateTimeField(default=timezone.now, null=True, blank=True, editable=False)
     completed_at = models.DateTimeField(null=True, blank=True)
+    # started_at + the exam's duration, fixed when the attempt starts
+    deadline = models.DateTimeField(null=True, blank=True)
 
     # Score is nullable until calculated
     total_score = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+    # Set whenever the score is (re)computed; cached result pages are keyed by it
+    scored_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     # Status tracking
     is_submitted = models.BooleanField(default=False)
@@ -124,6 +181,21 @@ class Attempt(models.Model):
     # JSONField to store the 'State' of the exam (timer remaining, palette status)
     # This allows resuming an exam if the browser crashes.
     current_state = models.JSONField(default=dict, blank=True)
+    # Last seq handed out by the response event log (CBT_SYNC_EVENT_LOG)
+    sync_seq = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Finds expired, unsubmitted attempts for the sweeper
+            models.Index(fields=['is_submitted', 'deadline']),
+            # Finds the attempt start_attempt resumes
+            models.Index(fields=['user', 'exam', 'is_submitted']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.deadline is None and self.started_at is not None:
+            self.deadline = self.started_at + timedelta(minutes=self.exam.duration_minutes)
+        super().save(*args, **kwargs)
 
 
 class Response(models.Model):
@@ -146,4 +218,125 @@ class Response(models.Model):
     marks_awarded = models.DecimalField(max_digits=5, decimal_places=2, default=0.0)
 
     class Meta:
-        unique_together = ('attempt', 'question')
\ No newline at end of file
+        unique_together = ('attempt', 'question')
+
+
+class ResponseEvent(models.Model):
+    """
+    One answer change synced by the exam interface, appended when
+    CBT_SYNC_EVENT_LOG is on. Events newer than the attempt's current_state are
+    replayed on top of it; `manage.py compact_response_events` folds them in.
+    An event without a question clears every response (a full snapshot follows).
+    """
+    attempt = models.ForeignKey(Attempt, on_delete=models.CASCADE, related_name='events')
+    # No constraint: inserting events must not look up the question row
+    question = models.ForeignKey(
+        QuestionMeta, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+'
+    )
+    seq = models.PositiveIntegerField()
+    value = models.CharField(max_length=255, blank=True, null=True)
+    status = models.CharField(max_length=50, blank=True, null=True)
+    # When the browser made the change, as far as its clock knows
+    client_ts = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Covers replay, which reads only these columns of an attempt's newest events
+            models.Index(fields=['attempt', 'seq', 'question', 'status', 'value']),
+        ]
+
+
+class ScoringJob(models.Model):
+    """
+    Queued scoring of a submitted attempt, drained by `manage.py run_scoring_worker`.
+    A worker owns a job while its lease (locked_until) is valid; expired leases are
+    picked up again, so a crashed worker only delays scoring.
+    """
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    attempt = models.OneToOneField(Attempt, on_delete=models.CASCADE, related_name='scoring_job')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+
+    # Claim token of the worker batch that owns the job, and its lease
+    token = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+
+    tries = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'available_at'])]
+
+
+class ExamStats(models.Model):
+    """
+    Materialized statistics of an exam's scored attempts, folded in from the
+    StatsDelta rows scoring appends and rebuilt by `manage.py rebuild_exam_stats`.
+    Scores are counted in hundredths of a mark from min_score_cents in a Fenwick
+    tree of ScoreNode rows, so rank and percentile read O(log n) rows.
+    """
+    exam = models.OneToOneField(Exam, on_delete=models.CASCADE, related_name='stats')
+    attempts = models.PositiveIntegerField(default=0)
+    score_sum_cents = models.BigIntegerField(default=0)
+
+    # Score range covered by the tree: node i counts scores from min_score_cents + i - 1
+    min_score_cents = models.BigIntegerField()
+    size = models.PositiveIntegerField()
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class StatsDelta(models.Model):
+    """
+    Change to an exam's statistics made by one scoring transaction, appended
+    rather than applied so concurrent submits don't queue on the exam's stats
+    row. `manage.py fold_exam_stats` (and the scoring worker) fold them in.
+    """
+    exam = models.ForeignKey(Exam, on_delete=models.CASCADE, related_name='stats_deltas')
+    attempts = models.IntegerField()
+    score_sum_cents = models.BigIntegerField()
+    # {score in hundredths: change in count}, {question id: changes of [correct, incorrect, unattempted]}
+    scores = models.JSONField()
+    outcomes = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class ScoreNode(models.Model):
+    """
+    One node of an exam's score Fenwick tree. Nodes are created on first use,
+    so a missing node counts zero.
+    """
+    exam = models.ForeignKey(Exam, on_delete=models.CASCADE, related_name='score_nodes')
+    index = models.PositiveIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('exam', 'index')
+
+
+class QuestionStats(models.Model):
+    """
+    How scored attempts fared on a question, for difficulty.
+    """
+    question = models.OneToOneField(QuestionMeta, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    correct = models.IntegerField(default=0)
+    incorrect = models.IntegerField(default=0)
+    unattempted = models.IntegerField(default=0)
+
+
+class Blob(models.Model):
+    """
+    A file in content-addressed storage and how many exam file fields point at
+    it. Unreferenced blobs are deleted by `manage.py collect_blobs`.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    refs = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,152 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+logger = logging.getLogger(__name__)
+
+PAGES_ROOT = 'exams/pages'
+
+MANIFEST_NAME = 'manifest.json'
+
+CONTENT_TYPES = {'webp': 'image/webp', 'png': 'image/png'}
+
+
+def page_widths():
+    return tuple(getattr(settings, 'CBT_PAGE_WIDTHS', (640, 1024, 1600)))
+
+
+def page_format():
+    return getattr(settings, 'CBT_PAGE_FORMAT', 'webp')
+
+
+# Pages are stored under the paper's digest, so identical papers share their
+# images and a finished directory never changes
+def pages_dir(digest):
+    return Path(settings.MEDIA_ROOT) / PAGES_ROOT / digest
+
+
+def page_file_name(page, width, fmt):
+    return f'{page}-{width}.{fmt}'
+
+
+def page_storage_name(digest, page, width, fmt):
+    # Path relative to MEDIA_ROOT
+    return f'{PAGES_ROOT}/{digest}/{page_file_name(page, width, fmt)}'
+
+
+def render_pages(pdf_path, out_dir, widths, fmt):
+    """
+    Renders every page of a PDF at each width and writes them with a manifest.
+    Output goes to a temporary sibling directory that is renamed into place, so
+    readers see either no directory or a complete one. Runs in a worker process.
+    """
+    out_dir = Path(out_dir)
+    if (out_dir / MANIFEST_NAME).exists():
+        return str(out_dir)
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f'.{out_dir.name}-', dir=out_dir.parent))
+    try:
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        sizes = []
+        for index in range(len(pdf)):
+            page = pdf[index]
+            page_width, page_height = page.get_size()
+            sizes.append([page_width, page_height])
+            for width in widths:
+                image = page.render(scale=width / page_width).to_pil()
+                image.save(tmp_dir / page_file_name(index + 1, width, fmt), format=fmt.upper())
+            page.close()
+        pdf.close()
+
+        manifest = {'pages': len(sizes), 'widths': list(widths), 'format': fmt, 'sizes': sizes}
+        (tmp_dir / MANIFEST_NAME).write_text(json.dumps(manifest))
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            # Another worker finished the same paper first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return str(out_dir)
+
+
+# A finished manifest doesn't change while its pages exist, so it is kept once read
+_manifests = {}
+
+
+def page_manifest(digest):
+    """
+    Manifest of the rendered pages of a paper ({pages, widths, format, sizes}),
+    or None while it hasn't been rendered.
+    """
+    if not digest:
+        return None
+    manifest = _manifests.get(digest)
+    if manifest is not None and not pages_dir(digest).is_dir():
+        # Deleted by collect_blobs (in any process) since it was read; a re-upload renders it again
+        _manifests.pop(digest, None)
+        manifest = None
+    if manifest is None:
+        try:
+            manifest = json.loads((pages_dir(digest) / MANIFEST_NAME).read_text())
+        except FileNotFoundError:
+            return None
+        _manifests[digest] = manifest
+    return manifest
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def render_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                getattr(settings, 'CBT_PAGE_RENDER_PROCESSES', 2),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executor
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("Rendering question paper pages failed", exc_info=future.exception())
+
+
+def schedule_page_render(exam, wait=False):
+    """
+    Queues rendering of an exam's question paper in the background process pool.
+    Does nothing if rendering is disabled, pypdfium2 is missing, the paper is
+    already rendered or the storage has no local paths.
+    """
+    if pdfium is None or not getattr(settings, 'CBT_PAGE_RENDER', True):
+        return None
+    if not exam.paper_digest or page_manifest(exam.paper_digest) is not None:
+        return None
+    try:
+        pdf_path = exam.question_paper.path
+    except NotImplementedError:
+        return None
+
+    args = (pdf_path, str(pages_dir(exam.paper_digest)), page_widths(), page_format())
+    if wait:
+        return render_pages(*args)
+    future = render_pool().submit(render_pages, *args)
+    future.add_done_callback(_log_failure)
+    return future
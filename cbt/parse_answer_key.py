@@ -1,61 +1,243 @@
 import csv
+import io
+import json
+import math
+import os
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
 from .models import Section, QuestionMeta
+from .answer_key import TYPE_CODES, is_bonus_key, parse_nat_key
+from .versions import bump_exam_version
+from .metrics import timed
 
-def process_answer_key(exam_instance):
-    exam_instance.answer_key_file.open()
-    # Handle UTF-8 decoding properly
-    decoded_file = exam_instance.answer_key_file.read().decode('utf-8').splitlines()
-    reader = csv.DictReader(decoded_file)
+# Questions upserted per INSERT ... ON CONFLICT statement
+IMPORT_BATCH_SIZE = 500
 
-    # Strip whitespace from headers
-    reader.fieldnames = [name.strip() for name in reader.fieldnames]
+# Characters read per chunk when streaming a JSON key
+JSON_CHUNK_SIZE = 64 * 1024
 
-    questions_to_create = []
+# Column / field name aliases, after lower-casing and turning ' ' and '/' into '_'
+FIELD_ALIASES = {
+    'section': 'section',
+    'question_no': 'number',
+    'question_number': 'number',
+    'number': 'number',
+    'type': 'type',
+    'key': 'key',
+    'key_range': 'key',
+    'marks': 'marks',
+    'negative': 'negative',
+}
 
-    # Track existing sections to assign order
-    existing_sections = {}
-    current_order = 1
+UPDATE_FIELDS = ['section', 'question_type', 'correct_answer', 'marks_positive', 'marks_negative']
 
-    for row in reader:
-        # Skip empty rows
-        if not row or not row.get('Section'):
+
+class AnswerKeyError(ValueError):
+    def __init__(self, line, message):
+        self.line = line
+        super().__init__(f"Line {line}: {message}")
+
+
+def _normalise(record):
+    fields = {}
+    for name, value in record.items():
+        alias = FIELD_ALIASES.get(str(name).strip().lower().replace(' ', '_').replace('/', '_'))
+        if alias:
+            fields[alias] = value.strip() if isinstance(value, str) else value
+    return fields
+
+
+def _marks(line, name, value):
+    try:
+        marks = Decimal(str(value))
+    except InvalidOperation:
+        raise AnswerKeyError(line, f"{name} must be a number, got {value!r}.")
+    # QuestionMeta stores marks as DecimalField(max_digits=4, decimal_places=2)
+    if not marks.is_finite() or marks < 0 or marks >= 100 or marks != marks.quantize(Decimal('0.01')):
+        raise AnswerKeyError(line, f"{name} must be between 0 and 99.99 with at most 2 decimals, got {value!r}.")
+    return marks
+
+
+def _question(line, record):
+    """
+    Validates one key record and returns it as QuestionMeta field values plus 'section',
+    or None for a row without a section (notes, totals), which is skipped.
+    """
+    fields = _normalise(record)
+    if fields.get('section') in (None, ''):
+        return None
+    for name in ('number', 'key', 'marks', 'negative'):
+        if fields.get(name) in (None, ''):
+            raise AnswerKeyError(line, f"missing {name}.")
+
+    try:
+        number = int(fields['number'])
+    except (TypeError, ValueError):
+        number = 0
+    if number < 1:
+        raise AnswerKeyError(line, f"question number must be a positive integer, got {fields['number']!r}.")
+
+    q_type = str(fields.get('type') or 'MCQ').upper()
+    if q_type not in TYPE_CODES:
+        raise AnswerKeyError(line, f"unknown question type {q_type!r}.")
+
+    key = str(fields['key'])
+    if q_type == 'NAT' and not is_bonus_key(key) and math.isnan(parse_nat_key(key)[0]):
+        raise AnswerKeyError(line, f"NAT key must be a number or a min:max range, got {key!r}.")
+
+    return {
+        'section': str(fields['section']),
+        'question_number': number,
+        'question_type': q_type,
+        'correct_answer': key,
+        'marks_positive': _marks(line, 'marks', fields['marks']),
+        'marks_negative': _marks(line, 'negative', fields['negative']),
+    }
+
+
+def _csv_records(text):
+    reader = csv.DictReader(text)
+    for record in reader:
+        # Skip rows that are empty apart from separators
+        if not any(v and v.strip() for v in record.values() if isinstance(v, str)):
+            continue
+        yield reader.line_num, record
+
+
+def _json_records(text):
+    """
+    Yields the objects of a JSON array (or of JSON Lines) one at a time, reading
+    the stream in chunks so only the current object is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, line, eof, started = '', 1, False, False
+
+    while True:
+        # Drop whitespace, separators and the opening bracket
+        i = 0
+        while i < len(buffer) and (buffer[i].isspace() or buffer[i] == ',' or (buffer[i] == '[' and not started)):
+            if buffer[i] == '[':
+                started = True
+            i += 1
+        line += buffer.count('\n', 0, i)
+        buffer = buffer[i:]
+
+        if not buffer:
+            if eof:
+                return
+            buffer = text.read(JSON_CHUNK_SIZE)
+            eof = not buffer
+            continue
+        if buffer[0] == ']':
+            return
+        started = True
+
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError as exc:
+            if eof:
+                raise AnswerKeyError(line + buffer.count('\n', 0, exc.pos), f"invalid JSON ({exc.msg}).")
+            # The object runs past this chunk: read more and decode it again
+            more = text.read(JSON_CHUNK_SIZE)
+            eof = not more
+            buffer += more
             continue
 
-        # Clean data
-        section_name = row['Section'].strip()
-        q_type = row['Type'].strip().upper() if row.get('Type') else 'MCQ'
-        # Handle 'Key' or 'Key/Range' column name variation
-        key_col = 'Key' if 'Key' in row else 'Key/Range'
-        correct_answer = row[key_col].strip()
-
-        # Handle Section Logic
-        if section_name not in existing_sections:
-            section, created = Section.objects.get_or_create(
-                exam=exam_instance,
-                name=section_name,
-                defaults={'order': current_order}
-            )
-            if not created:
-                # If section existed (e.g. from previous run), use its order
-                current_order = section.order
-            else:
-                current_order += 1
-            existing_sections[section_name] = section
-
-        section = existing_sections[section_name]
-
-        # Create Question Object
-        q = QuestionMeta(
-            exam=exam_instance,
-            section=section,
-            question_number=int(row['Question No']),
-            question_type=q_type,
-            correct_answer=correct_answer,
-            marks_positive=float(row['Marks']),
-            marks_negative=float(row['Negative'])
-        )
-        questions_to_create.append(q)
-
-    # Clear old questions to prevent duplicates on re-upload
-    QuestionMeta.objects.filter(exam=exam_instance).delete()
-    QuestionMeta.objects.bulk_create(questions_to_create)
+        if not isinstance(record, dict):
+            raise AnswerKeyError(line, "each question must be a JSON object.")
+        yield line, record
+        line += buffer.count('\n', 0, end)
+        buffer = buffer[end:]
+
+
+def _is_json(key_file):
+    return os.path.splitext(key_file.name or '')[1].lower() in ('.json', '.jsonl')
+
+
+def read_key_rows(key_file):
+    """
+    Streams the questions of an answer key (CSV, or a JSON array / JSON Lines of
+    objects with the same fields), validating each row as it is read.
+    Yields dicts of QuestionMeta field values plus 'section'; raises AnswerKeyError
+    with the offending line number on bad or duplicate rows.
+    """
+    key_file.open('rb')
+    key_file.seek(0)
+    # utf-8-sig drops the BOM spreadsheet exports tend to add
+    text = io.TextIOWrapper(key_file, encoding='utf-8-sig', newline='')
+    try:
+        records = _json_records(text) if _is_json(key_file) else _csv_records(text)
+        seen = set()
+        for line, record in records:
+            question = _question(line, record)
+            if question is None:
+                continue
+            if question['question_number'] in seen:
+                raise AnswerKeyError(line, f"duplicate question number {question['question_number']}.")
+            seen.add(question['question_number'])
+            yield question
+    except UnicodeDecodeError:
+        raise AnswerKeyError(1, "file is not UTF-8 encoded.")
+    finally:
+        # Don't let the wrapper close the storage file underneath its owner
+        text.detach()
+
+
+def get_sections(exam_instance, names):
+    """
+    Returns {name: Section} for the given names, creating missing sections in
+    first-seen order after the exam's existing ones.
+    """
+    sections = {s.name: s for s in Section.objects.filter(exam=exam_instance)}
+    return _add_sections(exam_instance, sections, names)
+
+
+def _add_sections(exam_instance, sections, names):
+    current_order = max((s.order for s in sections.values()), default=0) + 1
+    new = []
+    for name in names:
+        if name not in sections:
+            sections[name] = Section(exam=exam_instance, name=name, order=current_order)
+            new.append(sections[name])
+            current_order += 1
+    Section.objects.bulk_create(new)
+    return sections
+
+
+def _upsert_batch(exam_instance, sections, batch):
+    _add_sections(exam_instance, sections, dict.fromkeys(row['section'] for row in batch))
+    QuestionMeta.objects.bulk_create(
+        [QuestionMeta(exam=exam_instance, section=sections[row.pop('section')], **row) for row in batch],
+        update_conflicts=True,
+        unique_fields=['exam', 'question_number'],
+        update_fields=UPDATE_FIELDS,
+    )
+
+
+@timed('process_answer_key')
+def process_answer_key(exam_instance, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Imports an exam's answer key in batches, upserting questions by number so
+    existing rows (and the responses pointing at them) are kept; questions no
+    longer in the key are removed. Raises AnswerKeyError on invalid rows, in
+    which case nothing is imported.
+    """
+    with transaction.atomic():
+        sections = get_sections(exam_instance, [])
+        existing = set(QuestionMeta.objects.filter(exam=exam_instance).values_list('question_number', flat=True))
+
+        batch = []
+        for row in read_key_rows(exam_instance.answer_key_file):
+            existing.discard(row['question_number'])
+            batch.append(row)
+            if len(batch) == batch_size:
+                _upsert_batch(exam_instance, sections, batch)
+                batch = []
+        if batch:
+            _upsert_batch(exam_instance, sections, batch)
+
+        removed = sorted(existing)
+        for start in range(0, len(removed), batch_size):
+            QuestionMeta.objects.filter(exam=exam_instance, question_number__in=removed[start:start + batch_size]).delete()
+        # Bulk writes skip post_save, so invalidate compiled keys explicitly
+        bump_exam_version(exam_instance.id)
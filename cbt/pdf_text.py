@@ -0,0 +1,95 @@
+import json
+import re
+from pathlib import Path
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+# "Q.5", "Q 5", "Q5:", "Question 5", "Question No. 5" ...
+EXPLICIT_LABEL_RE = re.compile(r'^\s*Q(?:uestion)?\s*(?:No\.?)?\s*[.:\-]?\s*(\d{1,4})\b', re.IGNORECASE)
+# ... or a bare "5." / "5)" at the start of a line (but not "5.2")
+BARE_LABEL_RE = re.compile(r'^\s*(\d{1,4})\s*[.)](?!\d)')
+
+# A label may skip this many question numbers (unlabelled or unreadable questions)
+MAX_LABEL_GAP = 3
+
+
+def _mult(m, n):
+    # Product of two PDF transformation matrices [a b c d e f]
+    return [
+        m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5],
+    ]
+
+
+def _page_lines(page):
+    """
+    Text lines of a page as (offset from top, text), top to bottom.
+    Chunks on the same baseline are joined left to right.
+    """
+    chunks = []
+
+    def visit(text, cm, tm, font_dict, font_size):
+        if text.strip():
+            x, y = _mult(tm, cm)[4:6]
+            chunks.append((round(y, 1), x, text))
+
+    page.extract_text(visitor_text=visit)
+    box = page.mediabox
+    height = float(box.height) or 1.0
+    lines = {}
+    for y, x, text in sorted(chunks, key=lambda c: (-c[0], c[1])):
+        lines.setdefault(y, []).append(text)
+    return [
+        (min(max((float(box.top) - y) / height, 0.0), 1.0), ''.join(parts))
+        for y, parts in lines.items()
+    ]
+
+
+def extract_labels(pdf_path):
+    """
+    Finds question label candidates in a PDF's text layer.
+    Returns [page, offset, number, explicit] lists in reading order; pure Python
+    and free of Django, so it can run in a worker process.
+    """
+    labels = []
+    for page_number, page in enumerate(PdfReader(pdf_path).pages, start=1):
+        for offset, text in _page_lines(page):
+            match = EXPLICIT_LABEL_RE.match(text)
+            explicit = match is not None
+            match = match or BARE_LABEL_RE.match(text)
+            if match:
+                labels.append([page_number, round(offset, 4), int(match.group(1)), explicit])
+    return labels
+
+
+def assign_pages(labels, numbers):
+    """
+    Maps question numbers to (page, offset). Explicit labels win over bare
+    numbers if the paper has any; a label only counts if it continues the
+    sequence of questions found so far, which skips stray numbered lines.
+    """
+    if any(explicit for *_, explicit in labels):
+        labels = [label for label in labels if label[3]]
+
+    expected = sorted(numbers)
+    found, position = {}, 0
+    for page, offset, number, _ in labels:
+        window = expected[position:position + MAX_LABEL_GAP + 1]
+        if number in window:
+            found[number] = (page, offset)
+            position += window.index(number) + 1
+    return found
+
+
+def extract_and_store_labels(pdf_path, out_path):
+    labels = extract_labels(pdf_path)
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(labels))
+    tmp_path.replace(out_path)
+    return labels
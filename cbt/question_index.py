@@ -0,0 +1,86 @@
+import json
+import logging
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+from .models import QuestionMeta
+from .page_images import render_pool
+from .pdf_text import PdfReader, assign_pages, extract_and_store_labels
+from .versions import bump_exam_version
+
+logger = logging.getLogger(__name__)
+
+def apply_question_index(exam_id, labels):
+    """
+    Writes pdf_page_number/pdf_page_offset for the exam's questions from label
+    candidates, touching only rows that change. Returns the number updated.
+    """
+    questions = list(QuestionMeta.objects.filter(exam_id=exam_id).only('id', 'question_number', 'pdf_page_number', 'pdf_page_offset'))
+    pages = assign_pages(labels, [q.question_number for q in questions])
+
+    changed = []
+    for question in questions:
+        page, offset = pages.get(question.question_number, (question.pdf_page_number, question.pdf_page_offset))
+        if (page, offset) != (question.pdf_page_number, question.pdf_page_offset):
+            question.pdf_page_number, question.pdf_page_offset = page, offset
+            changed.append(question)
+    if changed:
+        QuestionMeta.objects.bulk_update(changed, ['pdf_page_number', 'pdf_page_offset'])
+        # bulk_update skips post_save, and the page index is part of what clients cache
+        bump_exam_version(exam_id)
+    return len(changed)
+
+
+def labels_path(digest):
+    # Keyed by paper digest like the page images, but outside their directory,
+    # which only ever appears complete
+    return Path(settings.MEDIA_ROOT) / 'exams' / 'index' / f'{digest}.json'
+
+
+def _apply_index(exam_id, labels):
+    try:
+        apply_question_index(exam_id, labels)
+    except Exception:
+        logger.exception("Indexing questions of exam %s failed", exam_id)
+    finally:
+        # The connection this thread opened; nothing else uses it
+        connections.close_all()
+
+
+def _apply_when_done(exam_id):
+    # Callbacks run on the executor's thread, or on the caller's if the future is already done,
+    # so the write gets a short-lived thread of its own rather than either one's connection
+    def callback(future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error("Indexing questions of exam %s failed", exam_id, exc_info=future.exception())
+            return
+        threading.Thread(target=_apply_index, args=(exam_id, future.result()), name='cbt-question-index').start()
+    return callback
+
+
+def index_exam_questions(exam, wait=False):
+    """
+    Fills the question-to-page index of an exam from its paper's text layer.
+    Labels are extracted once per paper digest (in the background process pool
+    unless wait=True) and then applied to the exam's current questions.
+    """
+    if PdfReader is None or not exam.paper_digest:
+        return None
+    path = labels_path(exam.paper_digest)
+    if path.exists():
+        return apply_question_index(exam.id, json.loads(path.read_text()))
+    try:
+        pdf_path = exam.question_paper.path
+    except NotImplementedError:
+        return None
+
+    if wait:
+        return apply_question_index(exam.id, extract_and_store_labels(pdf_path, path))
+    future = render_pool().submit(extract_and_store_labels, pdf_path, str(path))
+    future.add_done_callback(_apply_when_done(exam.id))
+    return future
@@ -0,0 +1,46 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Exam
+
+
+def result_cache():
+    return caches[getattr(settings, 'CBT_RESULT_CACHE', getattr(settings, 'CBT_CACHE', 'default'))]
+
+
+def result_stamp(attempt):
+    """
+    (stamp, last_modified) of a scored attempt's result page. Besides the
+    attempt's own scored_at, the page shows the exam's questions and the
+    rank and difficulty statistics, so their versions are part of the stamp.
+    One query, for the exam's version and the statistics' updated_at.
+    """
+    version, stats_updated = Exam.objects.values_list('version', 'stats__updated_at').get(id=attempt.exam_id)
+    scored_at = attempt.scored_at or attempt.completed_at
+    parts = (
+        attempt.id,
+        scored_at.timestamp() if scored_at else '',
+        stats_updated.timestamp() if stats_updated else '',
+        version,
+    )
+    stamp = hashlib.sha256('|'.join(map(str, parts)).encode()).hexdigest()[:32]
+    return stamp, max(filter(None, (scored_at, stats_updated)), default=None)
+
+
+def cached_result(attempt, stamp, variant, build):
+    """
+    The rendered result (bytes) of an attempt for variant ('html' or 'json'),
+    built at most once per stamp and shared through CBT_RESULT_CACHE. Bodies
+    over CBT_RESULT_CACHE_MAX_BYTES are served but not stored.
+    """
+    cache = result_cache()
+    key = f'cbt:result:{variant}:{attempt.id}:{stamp}'
+    body = cache.get(key)
+    if body is None:
+        body = build()
+        if len(body) <= getattr(settings, 'CBT_RESULT_CACHE_MAX_BYTES', 256 * 1024):
+            # Older stamps of the page are never read again; the timeout lets them go
+            cache.set(key, body, getattr(settings, 'CBT_RESULT_CACHE_TIMEOUT', 60 * 60))
+    return body
@@ -0,0 +1,181 @@
+import csv
+from itertools import groupby
+
+from .models import QuestionMeta, Response
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Rows fetched per database round trip; memory use is bounded by this, not the exam size
+EXPORT_CHUNK_SIZE = 2000
+
+# Characters of CSV gathered before a chunk is handed to the response
+CSV_BUFFER_SIZE = 64 * 1024
+
+LAYOUTS = ('wide', 'long')
+
+LONG_HEADER = (
+    'attempt_id', 'username', 'question_number', 'section', 'type',
+    'user_input', 'status', 'is_correct', 'marks_awarded',
+)
+
+
+def _questions(exam):
+    """
+    question id -> (number, section, type), ordered by question number. Small
+    next to the responses, so it is loaded up front instead of joined per row.
+    """
+    return {
+        q_id: (number, section or '', q_type)
+        for q_id, number, section, q_type in QuestionMeta.objects.filter(exam=exam)
+        .order_by('question_number')
+        .values_list('id', 'question_number', 'section__name', 'question_type')
+    }
+
+
+def _responses(exam, *fields):
+    # Ordered by the (attempt, question) unique index, so the database streams rather than sorts
+    return (
+        Response.objects.filter(attempt__exam=exam, attempt__is_submitted=True)
+        .order_by('attempt_id', 'question_id')
+        .values_list(*fields)
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+
+
+def _bool(value):
+    return '' if value is None else str(value).lower()
+
+
+def _long_records(exam):
+    # One tuple per response, in LONG_HEADER order
+    questions = _questions(exam)
+    for attempt_id, username, q_id, user_input, status, is_correct, marks in _responses(
+        exam, 'attempt_id', 'attempt__user__username', 'question_id', 'user_input', 'status', 'is_correct',
+        'marks_awarded',
+    ):
+        yield (attempt_id, username, *questions[q_id], user_input, status, is_correct, marks)
+
+
+def long_rows(exam):
+    """
+    Header, then one row per response of every submitted attempt.
+    """
+    yield LONG_HEADER
+    for *record, user_input, status, is_correct, marks in _long_records(exam):
+        yield *record, user_input or '', status, _bool(is_correct), marks
+
+
+def wide_rows(exam):
+    """
+    Header, then one row per submitted attempt: its totals followed by the
+    response and marks for each question, in question order.
+    """
+    questions = _questions(exam)
+    column = {q_id: i for i, q_id in enumerate(questions)}
+    header = ['attempt_id', 'username', 'started_at', 'completed_at', 'total_score']
+    for number, _, _ in questions.values():
+        header += [f'Q{number}', f'Q{number} marks']
+    yield header
+
+    rows = _responses(
+        exam, 'attempt_id', 'attempt__user__username', 'attempt__started_at', 'attempt__completed_at',
+        'attempt__total_score', 'question_id', 'user_input', 'marks_awarded',
+    )
+    for attempt_id, responses in groupby(rows, key=lambda row: row[0]):
+        cells = [''] * (2 * len(column))
+        for _, username, started_at, completed_at, total_score, q_id, user_input, marks in responses:
+            pos = column[q_id] * 2
+            cells[pos], cells[pos + 1] = user_input or '', marks
+        yield [
+            attempt_id, username, started_at.isoformat() if started_at else '',
+            completed_at.isoformat() if completed_at else '',
+            '' if total_score is None else total_score, *cells,
+        ]
+
+
+class _Echo:
+    # csv.writer target that hands each formatted row straight back
+    def write(self, value):
+        return value
+
+
+def csv_chunks(rows):
+    """
+    CSV text of rows in chunks of roughly CSV_BUFFER_SIZE characters. The
+    header goes out on its own, before the first query has returned.
+    """
+    writer = csv.writer(_Echo())
+    rows = iter(rows)
+    yield writer.writerow(next(rows))
+    buffer, size = [], 0
+    for row in rows:
+        line = writer.writerow(row)
+        buffer.append(line)
+        size += len(line)
+        if size >= CSV_BUFFER_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+class _ByteChunks:
+    """
+    Write-only file that keeps what was written until it is taken, so a
+    Parquet file can be streamed while it is being written.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def parquet_available():
+    return pq is not None
+
+
+def parquet_chunks(exam, row_group_size=EXPORT_CHUNK_SIZE * 10):
+    """
+    The long layout as a Parquet file, streamed one row group at a time.
+    Needs pyarrow.
+    """
+    if pq is None:
+        raise RuntimeError("Parquet export needs pyarrow.")
+    schema = pa.schema([
+        ('attempt_id', pa.int64()), ('username', pa.string()), ('question_number', pa.int32()),
+        ('section', pa.string()), ('type', pa.string()), ('user_input', pa.string()), ('status', pa.string()),
+        ('is_correct', pa.bool_()), ('marks_awarded', pa.float64()),
+    ])
+    sink = _ByteChunks()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema) as writer:
+        yield sink.take()
+        columns = [[] for _ in schema]
+        for i, (*record, marks) in enumerate(_long_records(exam), 1):
+            for values, value in zip(columns, (*record, float(marks))):
+                values.append(value)
+            if i % row_group_size == 0:
+                writer.write_table(pa.Table.from_pydict(dict(zip(schema.names, columns)), schema=schema))
+                columns = [[] for _ in schema]
+                yield sink.take()
+        if columns[0]:
+            writer.write_table(pa.Table.from_pydict(dict(zip(schema.names, columns)), schema=schema))
+    yield sink.take()
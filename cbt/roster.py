@@ -0,0 +1,141 @@
+import csv
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import Attempt
+
+# Users / attempts looked up and inserted per statement
+PROVISION_BATCH_SIZE = 500
+
+# Column name aliases, after lower-casing and turning ' ' into '_'
+FIELD_ALIASES = {
+    'username': 'username',
+    'user': 'username',
+    'login': 'username',
+    'roll_no': 'username',
+    'roll_number': 'username',
+    'password': 'password',
+    'email': 'email',
+    'first_name': 'first_name',
+    'last_name': 'last_name',
+}
+
+
+class RosterError(ValueError):
+    def __init__(self, line, message):
+        self.line = line
+        super().__init__(f"Line {line}: {message}")
+
+
+def read_roster(roster_file):
+    """
+    Reads a candidate roster CSV (a binary file) with a username column and
+    optional password, email, first_name and last_name columns.
+    Returns a list of dicts; raises RosterError on invalid or duplicate usernames.
+    """
+    # utf-8-sig drops the BOM spreadsheet exports tend to add
+    reader = csv.DictReader(io.TextIOWrapper(roster_file, encoding='utf-8-sig', newline=''))
+    username_field = User._meta.get_field('username')
+    candidates, seen = [], set()
+    for record in reader:
+        line = reader.line_num
+        fields = {}
+        for name, value in record.items():
+            alias = FIELD_ALIASES.get(str(name).strip().lower().replace(' ', '_'))
+            if alias:
+                fields[alias] = (value or '').strip()
+        username = fields.get('username')
+        if not username:
+            raise RosterError(line, "missing username.")
+        try:
+            username_field.clean(username, None)
+        except ValidationError as exc:
+            raise RosterError(line, f"invalid username {username!r}: {' '.join(exc.messages)}")
+        if username in seen:
+            raise RosterError(line, f"duplicate username {username!r}.")
+        seen.add(username)
+        candidates.append(fields)
+    return candidates
+
+
+def hash_passwords(passwords, processes=None):
+    """
+    make_password for each password, spread over a process pool since PBKDF2
+    is what dominates provisioning. Blank passwords give unusable ones.
+    """
+    hashed = [None if password else make_password(None) for password in passwords]
+    todo = [i for i, password in enumerate(passwords) if password]
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(todo) < 2:
+        results = [make_password(passwords[i]) for i in todo]
+    else:
+        # make_password needs settings but no models, so spawned workers don't set up Django
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            chunksize = max(1, len(todo) // (processes * 4))
+            results = list(pool.map(make_password, [passwords[i] for i in todo], chunksize=chunksize))
+    for i, result in zip(todo, results):
+        hashed[i] = result
+    return hashed
+
+
+def provision_candidates(candidates, exams=(), processes=None, batch_size=PROVISION_BATCH_SIZE):
+    """
+    Creates the roster's users that don't exist yet (existing ones are left
+    as they are) and, for each given exam, a not-yet-started Attempt for every
+    candidate without an open one, so start_attempt only has to resume it.
+    Returns counts of users created, users already existing and attempts created.
+    """
+    usernames = [candidate['username'] for candidate in candidates]
+    existing = set()
+    for start in range(0, len(usernames), batch_size):
+        existing.update(
+            User.objects.filter(username__in=usernames[start:start + batch_size]).values_list('username', flat=True)
+        )
+    new = [candidate for candidate in candidates if candidate['username'] not in existing]
+    # Hashing happens before the transaction, which then only holds fast inserts
+    hashed = hash_passwords([candidate.get('password', '') for candidate in new], processes)
+
+    attempts = 0
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [
+                User(
+                    username=candidate['username'],
+                    password=password,
+                    email=candidate.get('email', ''),
+                    first_name=candidate.get('first_name', ''),
+                    last_name=candidate.get('last_name', ''),
+                )
+                for candidate, password in zip(new, hashed)
+            ],
+            batch_size=batch_size,
+        )
+
+        if exams:
+            user_ids = []
+            for start in range(0, len(usernames), batch_size):
+                user_ids += User.objects.filter(username__in=usernames[start:start + batch_size]).values_list(
+                    'id', flat=True
+                )
+            for exam in exams:
+                for start in range(0, len(user_ids), batch_size):
+                    chunk = user_ids[start:start + batch_size]
+                    has_open = set(
+                        Attempt.objects.filter(exam=exam, user_id__in=chunk, is_submitted=False).values_list(
+                            'user_id', flat=True
+                        )
+                    )
+                    created = Attempt.objects.bulk_create(
+                        [Attempt(user_id=user_id, exam=exam, started_at=None) for user_id in chunk
+                         if user_id not in has_open]
+                    )
+                    attempts += len(created)
+
+    return {'users_created': len(new), 'users_existing': len(existing), 'attempts_created': attempts}
@@ -1,76 +1,141 @@
-from .models import Attempt
+import logging
 
-def calculate_score(attempt_id):
-    attempt = Attempt.objects.get(id=attempt_id)
-    responses = attempt.responses.all()
-    total_score = 0
-
-    for response in responses:
-        q_meta = response.question
-        user_val = response.user_input
-        correct_val = q_meta.correct_answer
-
-        is_correct = False
-
-        if not user_val:
-            # Not answered
-            pass
-
-        # MCQ Logic: Exact Match
-        elif q_meta.question_type == 'MCQ':
-            if user_val.strip().upper() == correct_val.strip().upper():
-                is_correct = True
-
-        # MSQ Logic: Set Comparison (Order independent)
-        elif q_meta.question_type == 'MSQ':
-            # Assuming user_val and correct_val are sorted strings like "A,C"
-            # Split, sort, and compare lists
-            u_set = set(x.strip().upper() for x in user_val.split(','))
-            c_set = set(x.strip().upper() for x in correct_val.split(',')) # Assuming Answer Key uses comma or semicolon? Blueprint said "A;C" in one place, "A,B,D" in another.
-            # Blueprint example: "Core, 3, MSQ, A;C, 2, 0"
-            # Blueprint text: "For MSQ: 'A,B,D' (sorted string)"
-            # I will handle both comma and semicolon
-
-            c_vals = correct_val.replace(';', ',').split(',')
-            c_set = set(x.strip().upper() for x in c_vals)
-
-            if u_set == c_set:
-                is_correct = True
-
-        # NAT Logic: Range Comparison
-        elif q_meta.question_type == 'NAT':
-            try:
-                u_float = float(user_val)
-                # correct_val format "min:max" e.g., "5.1:5.3"
-                if ':' in correct_val:
-                    min_val, max_val = map(float, correct_val.split(':'))
-                    # Inclusive comparison with tolerance
-                    if min_val <= u_float <= max_val:
-                        is_correct = True
-                else:
-                    # Exact match (single value)
-                    if abs(u_float - float(correct_val)) < 1e-6:
-                        is_correct = True
-            except (ValueError, AttributeError):
-                is_correct = False
-
-        # Apply Marks
-        if is_correct:
-            marks = q_meta.marks_positive
-            total_score += marks
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .answer_key import MCQ, MSQ, NAT, from_cents, get_compiled_key, mask_array
+from .exam_stats import outcome_counts, record_scores
+from .metrics import timed
+from .models import Attempt, Response
+
+logger = logging.getLogger(__name__)
+
+# Tolerance used when a NAT key is a single value instead of a min:max range
+NAT_EXACT_TOLERANCE = 1e-6
+
+# Attempts scored per round trip when a large batch is passed in
+SCORING_BATCH_SIZE = 500
+
+
+def score_responses(key, q_pos, user_values, statuses):
+    """
+    Scores parallel response columns against a key.
+    Returns (is_correct bool array, marks array in hundredths).
+    """
+    q_pos = np.asarray(q_pos, dtype=np.int64)
+    answered_input = np.array([bool(v) for v in user_values], dtype=bool)
+
+    masks, floats = [], []
+    for pos, val, has_input in zip(q_pos, user_values, answered_input):
+        if has_input:
+            mask, value = key.encode(pos, val)
         else:
-            # Negative marking only applies if attempted (status!= not_answered)
-            # And typically only for MCQs in GATE
-            if response.status == 'answered' and q_meta.question_type == 'MCQ':
-                marks = -q_meta.marks_negative
-                total_score += marks
-            else:
-                marks = 0
-
-        # Save per-question result
-        response.is_correct = is_correct
-        response.marks_awarded = marks
-        response.save()
-
-    attempt.total_score = total_score
-    attempt.save()
+            mask, value = 0, np.nan
+        masks.append(mask)
+        floats.append(value)
+    user_mask = mask_array(masks)
+    user_float = np.array(floats, dtype=np.float64)
+
+    qtype = key.qtype[q_pos]
+    is_option = (qtype == MCQ) | (qtype == MSQ)
+    is_nat = qtype == NAT
+
+    option_ok = user_mask == key.mask[q_pos]
+    low, high = key.nat_low[q_pos], key.nat_high[q_pos]
+    with np.errstate(invalid='ignore'):
+        nat_ok = np.where(
+            key.nat_is_range[q_pos],
+            (low <= user_float) & (user_float <= high),
+            np.abs(user_float - low) < NAT_EXACT_TOLERANCE,
+        )
+
+    is_correct = (answered_input & ((is_option & option_ok) | (is_nat & nat_ok))) | key.bonus[q_pos]
+
+    # Negative marking only applies to attempted MCQs (GATE rule)
+    answered = np.array([s == 'answered' for s in statuses], dtype=bool)
+    penalised = ~is_correct & answered & (qtype == MCQ)
+    marks = np.where(is_correct, key.positive[q_pos], 0)
+    marks = np.where(penalised, -key.negative[q_pos], marks)
+    return is_correct, marks.astype(np.int64)
+
+
+def _score_chunk(key, chunk, batch_size):
+    with transaction.atomic():
+        # The attempts are locked before their totals and marks are read, so a job run twice (its
+        # lease expired and another worker reclaimed it) sees the first run's results and is
+        # counted in the statistics as a re-score rather than a second attempt
+        previous = dict(
+            Attempt.objects.select_for_update().filter(id__in=chunk).order_by('id').values_list('id', 'total_score')
+        )
+        chunk = [attempt_id for attempt_id in chunk if attempt_id in previous]
+        rows = list(
+            Response.objects.filter(attempt_id__in=chunk).values_list(
+                'id', 'attempt_id', 'question_id', 'user_input', 'status', 'is_correct'
+            )
+        )
+        foreign = sum(1 for row in rows if row[2] not in key.position)
+        if foreign:
+            # Written by something other than submit, which only stores the exam's own questions
+            logger.warning("Skipping %d response(s) to questions outside the key of exam %s", foreign, key.exam_id)
+            rows = [row for row in rows if row[2] in key.position]
+
+        chunk_pos = {attempt_id: i for i, attempt_id in enumerate(chunk)}
+        chunk_totals = np.zeros(len(chunk), dtype=np.int64)
+        updated = []
+        outcomes = np.zeros((len(key.question_ids), 3), dtype=np.int64)
+
+        if rows:
+            response_ids, attempt_col, question_col, user_values, statuses, was_correct = zip(*rows)
+            q_pos = [key.position[q_id] for q_id in question_col]
+            is_correct, marks = score_responses(key, q_pos, user_values, statuses)
+            np.add.at(chunk_totals, [chunk_pos[a] for a in attempt_col], marks)
+
+            # Question statistics: add the new outcomes, take back those of attempts scored before
+            outcomes = outcome_counts(key, q_pos, user_values, is_correct)
+            rescored = [i for i, a in enumerate(attempt_col) if previous.get(a) is not None]
+            if rescored:
+                outcomes -= outcome_counts(key, [q_pos[i] for i in rescored], [user_values[i] for i in rescored],
+                                           [bool(was_correct[i]) for i in rescored])
+
+            updated = [
+                Response(id=r_id, is_correct=bool(ok), marks_awarded=from_cents(m))
+                for r_id, ok, m in zip(response_ids, is_correct, marks)
+            ]
+
+        totals = {attempt_id: from_cents(cents) for attempt_id, cents in zip(chunk, chunk_totals)}
+        now = timezone.now()
+        scored = [Attempt(id=attempt_id, total_score=total, scored_at=now) for attempt_id, total in totals.items()]
+
+        Response.objects.bulk_update(updated, ['is_correct', 'marks_awarded'], batch_size=batch_size)
+        Attempt.objects.bulk_update(scored, ['total_score', 'scored_at'], batch_size=batch_size)
+        record_scores(key, previous, totals, outcomes)
+    return totals
+
+
+@timed('score_attempts')
+def score_attempts(attempt_ids, batch_size=SCORING_BATCH_SIZE):
+    """
+    Scores any number of attempts in bulk.
+    Writes per-response marks with bulk_update and one total_score per attempt,
+    and folds the results into the exam's statistics.
+    Returns a dict of attempt id -> total score.
+    """
+    by_exam = {}
+    for attempt_id, exam_id in Attempt.objects.filter(id__in=list(attempt_ids)).values_list('id', 'exam_id'):
+        by_exam.setdefault(exam_id, []).append(attempt_id)
+
+    totals = {}
+    for exam_id, ids in by_exam.items():
+        key = get_compiled_key(exam_id)
+        for start in range(0, len(ids), batch_size):
+            totals.update(_score_chunk(key, ids[start:start + batch_size], batch_size))
+    return totals
+
+
+@timed('calculate_score')
+def calculate_score(attempt_id):
+    totals = score_attempts([attempt_id])
+    if attempt_id not in totals:
+        raise Attempt.DoesNotExist(f"Attempt {attempt_id} does not exist.")
+    return totals[attempt_id]
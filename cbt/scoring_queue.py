@@ -0,0 +1,128 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import ScoringJob
+from .scoring_logic import score_attempts
+
+logger = logging.getLogger(__name__)
+
+
+def async_scoring_enabled():
+    return getattr(settings, 'CBT_ASYNC_SCORING', False)
+
+
+def _lease():
+    return timedelta(seconds=getattr(settings, 'CBT_SCORING_LEASE_SECONDS', 300))
+
+
+def _max_tries():
+    return getattr(settings, 'CBT_SCORING_MAX_TRIES', 5)
+
+
+def enqueue_scoring(attempt_ids):
+    """
+    Queues attempts for scoring. Re-queuing an attempt resets its job, and takes
+    it away from any worker still holding the old claim.
+    """
+    now = timezone.now()
+    ScoringJob.objects.bulk_create(
+        [ScoringJob(attempt_id=attempt_id, available_at=now) for attempt_id in attempt_ids],
+        update_conflicts=True,
+        unique_fields=['attempt'],
+        update_fields=['status', 'token', 'locked_until', 'tries', 'available_at', 'last_error'],
+    )
+
+
+def _claimable(now):
+    return Q(status=ScoringJob.PENDING, available_at__lte=now) | Q(status=ScoringJob.RUNNING, locked_until__lt=now)
+
+
+def claim_jobs(limit):
+    """
+    Claims up to `limit` due jobs (including ones whose worker lease expired).
+    Returns (token, attempt ids); the token must be passed back to complete them.
+    """
+    now = timezone.now()
+    # Jobs that keep killing their worker are given up on instead of reclaimed forever
+    ScoringJob.objects.filter(status=ScoringJob.RUNNING, locked_until__lt=now, tries__gte=_max_tries()).update(
+        status=ScoringJob.FAILED, token='', last_error='Worker lease expired.'
+    )
+
+    token = uuid.uuid4().hex
+    with transaction.atomic():
+        ids = list(
+            ScoringJob.objects.select_for_update(skip_locked=True)
+            .filter(_claimable(now))
+            .order_by('available_at', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+        # Re-check the claim condition in the UPDATE so concurrent workers on
+        # backends without row locks (SQLite) can't both take the same job
+        ScoringJob.objects.filter(_claimable(now), id__in=ids).update(
+            status=ScoringJob.RUNNING, token=token, locked_until=now + _lease(), tries=F('tries') + 1
+        )
+    attempt_ids = list(ScoringJob.objects.filter(token=token).values_list('attempt_id', flat=True))
+    return token, attempt_ids
+
+
+def _complete(token, attempt_ids):
+    ScoringJob.objects.filter(token=token, attempt_id__in=attempt_ids).update(
+        status=ScoringJob.DONE, token='', locked_until=None, last_error=''
+    )
+
+
+def _fail(token, attempt_id, error):
+    jobs = ScoringJob.objects.filter(token=token, attempt_id=attempt_id)
+    retry_at = timezone.now() + timedelta(seconds=getattr(settings, 'CBT_SCORING_RETRY_DELAY', 30))
+    jobs.filter(tries__lt=_max_tries()).update(
+        status=ScoringJob.PENDING, token='', locked_until=None, available_at=retry_at, last_error=error
+    )
+    jobs.filter(tries__gte=_max_tries()).update(
+        status=ScoringJob.FAILED, token='', locked_until=None, last_error=error
+    )
+
+
+def run_claimed(token, attempt_ids):
+    """
+    Scores one claimed batch. If the batch fails, attempts are retried one by
+    one so a single bad attempt doesn't hold back the rest.
+    Scoring writes absolute marks, so a job that is run twice after a lost lease
+    ends in the same result. Returns the number of attempts scored.
+    """
+    try:
+        score_attempts(attempt_ids)
+    except Exception:
+        logger.exception("Scoring batch of %d attempts failed, retrying individually", len(attempt_ids))
+    else:
+        _complete(token, attempt_ids)
+        return len(attempt_ids)
+
+    scored = 0
+    for attempt_id in attempt_ids:
+        try:
+            score_attempts([attempt_id])
+        except Exception as exc:
+            logger.exception("Scoring attempt %s failed", attempt_id)
+            _fail(token, attempt_id, repr(exc))
+        else:
+            _complete(token, [attempt_id])
+            scored += 1
+    return scored
+
+
+def run_pending_jobs(batch_size=500):
+    """
+    Drains the queue in this process. Returns the number of attempts scored.
+    """
+    scored = 0
+    while True:
+        token, attempt_ids = claim_jobs(batch_size)
+        if not attempt_ids:
+            return scored
+        scored += run_claimed(token, attempt_ids)
@@ -1,9 +1,31 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
 from .parse_answer_key import process_answer_key
-from .models import Exam
+from .models import Exam, QuestionMeta
+from .versions import bump_exam_version
+from .page_images import schedule_page_render
+from .question_index import index_exam_questions
+from .blobs import update_blob_refs
 
 @receiver(post_save, sender=Exam)
 def exam_post_save(sender, instance, created, **kwargs):
     if created and instance.answer_key_file:
         process_answer_key(instance)
+    bump_exam_version(instance.id)
+    update_blob_refs(instance)
+    # Render page images and index question pages in the background once the paper is safely stored
+    transaction.on_commit(lambda: schedule_page_render(instance))
+    transaction.on_commit(lambda: index_exam_questions(instance))
+
+@receiver(post_delete, sender=Exam)
+def exam_post_delete(sender, instance, **kwargs):
+    bump_exam_version(instance.id)
+    # The files stay until `manage.py collect_blobs` finds them unreferenced
+    update_blob_refs(instance, deleted=True)
+
+# Compiled answer keys are keyed by the exam version, so any question change invalidates them
+@receiver(post_save, sender=QuestionMeta)
+@receiver(post_delete, sender=QuestionMeta)
+def question_changed(sender, instance, **kwargs):
+    bump_exam_version(instance.exam_id)
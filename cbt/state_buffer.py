@@ -0,0 +1,195 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.db.models import Case, JSONField, Q, Value, When
+
+from .models import Attempt
+from .sync import SyncBusy, apply_sync, state_seq
+
+logger = logging.getLogger(__name__)
+
+# Attempts written per UPDATE batch when flushing buffered states
+FLUSH_BATCH_SIZE = 500
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CBT_SYNC_WRITE_BEHIND', False)
+
+
+def buffer_cache():
+    return caches[getattr(settings, 'CBT_SYNC_BUFFER_CACHE', getattr(settings, 'CBT_CACHE', 'default'))]
+
+
+def _state_key(attempt_id):
+    return f'cbt:attempt-state:{attempt_id}'
+
+
+def _lock_key(attempt_id):
+    return f'cbt:attempt-state-lock:{attempt_id}'
+
+
+def _buffer_ttl():
+    return getattr(settings, 'CBT_SYNC_BUFFER_TTL', 6 * 60 * 60)
+
+
+@contextmanager
+def _attempt_lock(attempt_id, timeout=5):
+    # cache.add is atomic on every backend we support; the TTL frees locks of dead workers.
+    # SyncBusy if the lock isn't free within timeout, rather than going ahead without it
+    cache = buffer_cache()
+    key, token = _lock_key(attempt_id), uuid.uuid4().hex
+    deadline = time.time() + timeout
+    while not cache.add(key, token, timeout):
+        if time.time() >= deadline:
+            raise SyncBusy()
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        # Past its TTL the lock may be another writer's by now
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def buffered_state(attempt):
+    """
+    Newest known state of an attempt: the buffered copy if it is ahead of the
+    database, otherwise attempt.current_state.
+    """
+    if not write_behind_enabled():
+        return attempt.current_state
+    entry = buffer_cache().get(_state_key(attempt.id))
+    if entry is not None and state_seq(entry['state']) > state_seq(attempt.current_state):
+        return entry['state']
+    return attempt.current_state
+
+
+def buffered_sync(attempt, payload):
+    """
+    Write-behind counterpart of apply_sync + save: the new state goes to the
+    buffer and is flushed later. Once the oldest unflushed change of the attempt
+    is CBT_SYNC_MAX_UNFLUSHED_AGE seconds old, the state is written through instead,
+    which bounds what a lost buffer can cost.
+    Returns the new state, or None if nothing changed. Raises SyncBusy if another
+    sync of the attempt holds it for too long.
+    """
+    cache = buffer_cache()
+    with _attempt_lock(attempt.id):
+        entry = cache.get(_state_key(attempt.id))
+        pending = entry is not None and state_seq(entry['state']) > state_seq(attempt.current_state)
+        state = apply_sync(entry['state'] if pending else attempt.current_state, payload)
+        if state is None:
+            return None
+
+        now = time.time()
+        pending_since = entry['pending_since'] if pending and entry['pending_since'] else now
+        if now - pending_since >= getattr(settings, 'CBT_SYNC_MAX_UNFLUSHED_AGE', 30):
+            attempt.current_state = state
+            attempt.save(update_fields=['current_state'])
+            pending_since = None
+        cache.set(_state_key(attempt.id), {'state': state, 'pending_since': pending_since}, _buffer_ttl())
+
+    if pending_since is not None:
+        _mark_dirty(attempt.id)
+    return state
+
+
+def discard_buffered_state(attempt_id):
+    buffer_cache().delete(_state_key(attempt_id))
+
+
+def discard_buffered_states(attempt_ids):
+    buffer_cache().delete_many([_state_key(attempt_id) for attempt_id in attempt_ids])
+
+
+def flush_buffered_states(attempt_ids=None, batch_size=FLUSH_BATCH_SIZE, max_age=None):
+    """
+    Writes every buffered state that is ahead of the database, in batches of
+    one conditional UPDATE, so a state written through (or submitted) since
+    the buffer was read is never overwritten by an older one.
+    Without attempt_ids all unsubmitted attempts are swept, which also recovers
+    states buffered by workers that died before flushing. With max_age, only
+    states whose oldest unflushed change is at least max_age seconds old.
+    Returns the number of attempts written.
+    """
+    if attempt_ids is None:
+        attempt_ids = Attempt.objects.filter(is_submitted=False).values_list('id', flat=True)
+    attempt_ids = list(attempt_ids)
+    cutoff = time.time() - max_age if max_age is not None else None
+
+    written = 0
+    for start in range(0, len(attempt_ids), batch_size):
+        chunk = attempt_ids[start:start + batch_size]
+        entries = buffer_cache().get_many([_state_key(a) for a in chunk])
+        buffered = {}
+        for attempt_id in chunk:
+            entry = entries.get(_state_key(attempt_id))
+            if entry is None:
+                continue
+            if cutoff is not None and (entry['pending_since'] is None or entry['pending_since'] > cutoff):
+                continue
+            buffered[attempt_id] = entry['state']
+        if not buffered:
+            continue
+
+        behind = Q()
+        for attempt_id, state in buffered.items():
+            behind |= Q(id=attempt_id) & (
+                Q(current_state__seq__lt=state_seq(state)) | Q(current_state__seq__isnull=True)
+            )
+        written += Attempt.objects.filter(behind, is_submitted=False).update(current_state=Case(
+            *(When(id=attempt_id, then=Value(state, JSONField())) for attempt_id, state in buffered.items()),
+            output_field=JSONField(),
+        ))
+    return written
+
+
+# Attempts this process buffered since its last flush. Other processes keep their
+# own set; the flush_attempt_state command sweeps everything regardless.
+_dirty = set()
+_dirty_lock = threading.Lock()
+_flusher = None
+
+
+def _mark_dirty(attempt_id):
+    global _flusher
+    interval = getattr(settings, 'CBT_SYNC_FLUSH_INTERVAL', 5)
+    with _dirty_lock:
+        _dirty.add(attempt_id)
+        if interval and (_flusher is None or not _flusher.is_alive()):
+            if _flusher is None:
+                atexit.register(flush_dirty)
+            _flusher = threading.Thread(target=_flush_loop, args=(interval,), name='cbt-state-flusher', daemon=True)
+            _flusher.start()
+
+
+def flush_dirty():
+    with _dirty_lock:
+        attempt_ids = list(_dirty)
+        _dirty.clear()
+    if not attempt_ids:
+        return 0
+    try:
+        return flush_buffered_states(attempt_ids)
+    except Exception:
+        logger.exception("Flushing %d buffered attempt states failed", len(attempt_ids))
+        with _dirty_lock:
+            _dirty.update(attempt_ids)
+        return 0
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush_dirty()
+        finally:
+            connections.close_all()
+
@@ -0,0 +1,79 @@
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+
+DIGEST_NAME_RE = re.compile(r'^([0-9a-f]{64})(\.[0-9a-z]+)?$')
+
+
+def digest_from_name(name):
+    """
+    SHA-256 of a file stored by ContentAddressedStorage, read off its name;
+    None for files stored under any other name.
+    """
+    match = DIGEST_NAME_RE.match(posixpath.basename(name or ''))
+    return match.group(1) if match else None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores each distinct file once per directory, as <directory>/<sha256><ext>,
+    whatever name it was uploaded under. The content is hashed while it is
+    streamed to a temporary file; if that digest is already stored the copy is
+    dropped, the existing blob's grace period restarted and its name returned.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # _save names the file after its content, so the upload name can't collide
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        ext = os.path.splitext(name)[1].lower()
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=full_directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    tmp.write(chunk)
+
+            stored_name = posixpath.join(directory, digest.hexdigest() + ext)
+            if self.exists(stored_name):
+                os.remove(tmp_path)
+                # An unreferenced blob counts its grace from now, so collect_blobs leaves it to the
+                # exam about to be saved with it (the model is looked up late: models imports this)
+                apps.get_model('cbt', 'Blob').objects.filter(name=stored_name).update(updated_at=timezone.now())
+            else:
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                # Atomic, so a concurrent upload of the same content just replaces it with identical bytes
+                os.replace(tmp_path, self.path(stored_name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return stored_name
+
+
+_storage = None
+
+
+def blob_storage():
+    # Callable storage for the exam file fields, so migrations reference it by path
+    global _storage
+    if _storage is None:
+        _storage = ContentAddressedStorage()
+    return _storage
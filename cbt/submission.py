@@ -0,0 +1,81 @@
+from django.http import Http404
+from django.utils import timezone
+
+from .models import QuestionMeta, Response
+
+
+def _response_rows(attempt, responses_data, exam_questions):
+    rows = [
+        Response(
+            attempt=attempt,
+            question_id=q_id,
+            user_input=r_data.get('value'),
+            status=r_data.get('status', 'not_answered'),
+        )
+        for q_id, r_data in responses_data.items()
+    ]
+    rows += [
+        Response(attempt=attempt, question_id=q_id, user_input=None, status='not_visited')
+        for q_id in exam_questions.difference(responses_data)
+    ]
+    return rows
+
+
+def _upsert_responses(rows):
+    Response.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=['attempt', 'question'],
+        update_fields=['user_input', 'status'],
+    )
+
+
+def save_responses(attempt, responses_data):
+    """
+    Upserts a Response for every question of the attempt's exam in one statement;
+    questions missing from the synced state are stored as not visited.
+    Raises Http404 if the state references a question outside the attempt's exam.
+    """
+    try:
+        responses_data = {int(q_id): r_data for q_id, r_data in responses_data.items()}
+    except (TypeError, ValueError):
+        raise Http404("Unknown question in responses.")
+
+    exam_questions = set(QuestionMeta.objects.filter(exam_id=attempt.exam_id).values_list('id', flat=True))
+    if not exam_questions.issuperset(responses_data):
+        raise Http404("Unknown question in responses.")
+    _upsert_responses(_response_rows(attempt, responses_data, exam_questions))
+
+
+def save_attempts_responses(attempts):
+    """
+    save_responses for several attempts, from their current_state, in one
+    statement. Nobody is waiting on an error here, so questions the exam no
+    longer has are dropped instead of rejected.
+    """
+    exam_ids = {attempt.exam_id for attempt in attempts}
+    questions = {exam_id: set() for exam_id in exam_ids}
+    for q_id, exam_id in QuestionMeta.objects.filter(exam_id__in=exam_ids).values_list('id', 'exam_id'):
+        questions[exam_id].add(q_id)
+
+    rows = []
+    for attempt in attempts:
+        exam_questions = questions[attempt.exam_id]
+        responses_data = {}
+        for q_id, r_data in (attempt.current_state or {}).get('responses', {}).items():
+            if str(q_id).isdigit() and int(q_id) in exam_questions and isinstance(r_data, dict):
+                responses_data[int(q_id)] = r_data
+        rows += _response_rows(attempt, responses_data, exam_questions)
+    _upsert_responses(rows)
+
+
+def mark_submitted(attempt, state=None):
+    # A submit arriving within the grace period still completes the attempt at its deadline
+    now = timezone.now()
+    attempt.completed_at = min(now, attempt.deadline) if attempt.deadline else now
+    attempt.is_submitted = True
+    fields = ['completed_at', 'is_submitted']
+    if state is not None and state is not attempt.current_state:
+        attempt.current_state = state
+        fields.append('current_state')
+    attempt.save(update_fields=fields)
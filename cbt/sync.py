@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+
+class SyncGap(Exception):
+    """
+    The client's patch is based on a sequence number the server no longer has,
+    so it must resend a full snapshot.
+    """
+
+
+class SyncClosed(Exception):
+    """
+    The attempt was submitted, or its deadline passed, while the sync was on
+    its way; nothing was written.
+    """
+
+
+class SyncBusy(Exception):
+    """
+    Another request holds the attempt's state; the client should retry the
+    same sync shortly.
+    """
+
+
+class InvalidSync(ValueError):
+    pass
+
+
+def deadline_grace():
+    # Covers the final sync and submit the browser sends when its timer runs out
+    return timedelta(seconds=getattr(settings, 'CBT_DEADLINE_GRACE_SECONDS', 30))
+
+
+def open_attempts(now=None):
+    """
+    Filter for the attempts that still accept syncs (see accepts_writes), for
+    writes that must not land once an attempt is submitted or closed.
+    """
+    cutoff = (now or timezone.now()) - deadline_grace()
+    return Q(is_submitted=False, started_at__isnull=False) & (Q(deadline__isnull=True) | Q(deadline__gte=cutoff))
+
+
+def state_seq(state):
+    return state.get('seq', 0) if isinstance(state, dict) else 0
+
+
+def _validate_responses(responses):
+    if not isinstance(responses, dict) or not all(isinstance(r, dict) for r in responses.values()):
+        raise InvalidSync("responses must map question ids to {value, status} objects.")
+    return responses
+
+
+def is_empty_patch(payload):
+    return 'patch' in payload and payload['patch'] == {}
+
+
+def apply_sync(state, payload):
+    """
+    Applies one sync payload to an attempt's current_state.
+
+    A patch ({"base": seq, "patch": {q_id: {...}}}) is merged into the stored
+    responses and must be based on the last acknowledged seq, otherwise SyncGap
+    is raised. Anything else ({"responses": {...}}) is a full snapshot that
+    replaces them. Returns the new state, or None if nothing changed.
+    """
+    state = state if isinstance(state, dict) else {}
+    seq = state_seq(state)
+    current = state.get('responses', {})
+
+    if 'patch' in payload:
+        patch = _validate_responses(payload['patch'])
+        if payload.get('base') != seq:
+            raise SyncGap(seq)
+        if all(current.get(q_id) == entry for q_id, entry in patch.items()):
+            return None
+        responses = {**current, **patch}
+    else:
+        responses = _validate_responses(payload.get('responses', {}))
+        if responses == current:
+            return None
+
+    return {**state, 'responses': responses, 'seq': seq + 1}
@@ -0,0 +1,149 @@
+import functools
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+
+from .metrics import counting_queries
+
+# Seconds of samples current_load averages over, and how often each process adds its
+# own to the shared counters and re-reads their total
+LOAD_WINDOW = 10
+PUBLISH_INTERVAL = 1.0
+
+# Shared per-second counters: milliseconds spent in requests, queries, microseconds in queries
+_FIELDS = ('busy_ms', 'queries', 'query_us')
+
+# This process's counts not yet published, and the last total it read
+_pending = dict.fromkeys(_FIELDS, 0)
+_published_at = 0.0
+_load = 0.0
+_load_read_at = 0.0
+_lock = threading.Lock()
+
+
+def pacing_enabled():
+    return getattr(settings, 'CBT_SYNC_PACING', False)
+
+
+def load_cache():
+    return caches[getattr(settings, 'CBT_SYNC_LOAD_CACHE', getattr(settings, 'CBT_CACHE', 'default'))]
+
+
+def _load_key(second, field):
+    return f'cbt:load:{second}:{field}'
+
+
+class LoadMiddleware:
+    """
+    Times each request and its queries into the counters current_load reads.
+    Enabled with CBT_SYNC_PACING.
+    """
+
+    def __init__(self, get_response):
+        if not pacing_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        # Shares MetricsMiddleware's query counter when both are installed
+        with counting_queries(request) as counter:
+            queries, seconds = counter.queries, counter.seconds
+            try:
+                return self.get_response(request)
+            finally:
+                record_request(time.perf_counter() - started, counter.queries - queries, counter.seconds - seconds)
+
+
+def record_request(seconds, queries, query_seconds, now=None):
+    """
+    Adds a finished request to this process's counts, publishing them to
+    CBT_SYNC_LOAD_CACHE at most every PUBLISH_INTERVAL seconds.
+    """
+    global _published_at
+    now = time.time() if now is None else now
+    with _lock:
+        _pending['busy_ms'] += round(seconds * 1000)
+        _pending['queries'] += queries
+        _pending['query_us'] += round(query_seconds * 1_000_000)
+        if now - _published_at < PUBLISH_INTERVAL:
+            return
+        pending = {field: value for field, value in _pending.items() if value}
+        _pending.update(dict.fromkeys(_FIELDS, 0))
+        _published_at = now
+    cache = load_cache()
+    for field, value in pending.items():
+        key = _load_key(int(now), field)
+        cache.add(key, 0, LOAD_WINDOW * 2)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            # Expired between add and incr
+            cache.add(key, value, LOAD_WINDOW * 2)
+
+
+def current_load(now=None):
+    """
+    How loaded all workers together are relative to CBT_SYNC_TARGET_IN_FLIGHT
+    (average concurrent requests over the last LOAD_WINDOW seconds) and
+    CBT_SYNC_TARGET_QUERY_SECONDS (average query time), whichever is further
+    along; 1.0 is at target. Requests count once they finish.
+    """
+    global _load, _load_read_at
+    now = time.time() if now is None else now
+    with _lock:
+        if 0 <= now - _load_read_at < PUBLISH_INTERVAL:
+            return _load
+    seconds = range(int(now) - LOAD_WINDOW, int(now))
+    counts = load_cache().get_many([_load_key(second, field) for second in seconds for field in _FIELDS])
+    busy_ms, queries, query_us = (
+        sum(counts.get(_load_key(second, field), 0) for second in seconds) for field in _FIELDS
+    )
+    latency = query_us / queries / 1_000_000 if queries else 0.0
+    load = max(
+        busy_ms / (LOAD_WINDOW * 1000) / getattr(settings, 'CBT_SYNC_TARGET_IN_FLIGHT', 16),
+        latency / getattr(settings, 'CBT_SYNC_TARGET_QUERY_SECONDS', 0.05),
+    )
+    with _lock:
+        _load, _load_read_at = load, now
+    return load
+
+
+def sync_pacing(load):
+    """
+    (interval, jitter) in seconds for the next sync: CBT_SYNC_INTERVAL while
+    load is at or below target, stretched in proportion above it up to
+    CBT_SYNC_MAX_INTERVAL. Clients pick a random point within ± jitter.
+    """
+    interval = getattr(settings, 'CBT_SYNC_INTERVAL', 10)
+    interval = min(interval * max(1.0, load), getattr(settings, 'CBT_SYNC_MAX_INTERVAL', 60))
+    return round(interval, 1), round(interval / 2, 1)
+
+
+def paced(view):
+    """
+    Tells the client when to sync next (X-Sync-Interval and X-Sync-Jitter
+    headers). With CBT_SYNC_PACING, once load reaches CBT_SYNC_SHED_LOAD, POSTs
+    get a 503 before the view runs; the client keeps its changes and retries
+    later. Flushes (X-Sync-Flush: on submit or when the page is closed) are
+    never shed.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        load = current_load() if pacing_enabled() else 0.0
+        interval, jitter = sync_pacing(load)
+        shed_load = getattr(settings, 'CBT_SYNC_SHED_LOAD', 4)
+        if request.method == 'POST' and shed_load and load >= shed_load and not request.headers.get('X-Sync-Flush'):
+            response = JsonResponse({'status': 'busy'}, status=503)
+            response['Retry-After'] = str(math.ceil(interval))
+        else:
+            response = view(request, *args, **kwargs)
+        response['X-Sync-Interval'] = f'{interval:g}'
+        response['X-Sync-Jitter'] = f'{jitter:g}'
+        return response
+    return wrapper
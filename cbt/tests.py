@@ -1,9 +1,86 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command, CommandError
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from django.urls import reverse
+from django.db import connection, router, OperationalError
+from django.http import HttpResponse
 from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
-from cbt.models import Exam, Section, QuestionMeta, Attempt, Response
-from cbt.scoring_logic import calculate_score
+from cbt.models import (
+    Exam, Section, QuestionMeta, Attempt, Response, ResponseEvent, ScoringJob, ExamStats, QuestionStats, StatsDelta, Blob,
+)
+from cbt.blobs import collect_blobs
+from cbt.exam_manifest import get_exam_manifest
+from cbt.storage import blob_storage
+from cbt.checks import check_sync_buffer_cache, check_sync_load_cache
+from cbt.scoring_logic import calculate_score, score_attempts
+from cbt.answer_key import get_compiled_key
+from cbt.key_revision import revise_answer_key
+from cbt.versions import bump_exam_version, cbt_cache, exam_version
+from cbt.db_router import STICKY_COOKIE, pins_primary, primary_reads, replica_reads
+from cbt.deadlines import finalize_expired_attempts
+from cbt.exam_stats import exam_standing, fold_exam_stats, question_difficulty, rebuild_exam_stats
+from cbt.parse_answer_key import process_answer_key
+from cbt.forms import ExamForm
+from cbt.page_images import MANIFEST_NAME, page_manifest, page_storage_name, pages_dir, schedule_page_render
+from cbt.file_serving import RangeNotSatisfiable, parse_range
+from cbt.pdf_text import assign_pages, extract_labels
+from cbt.question_index import _apply_when_done, index_exam_questions, labels_path
+from cbt.state_buffer import buffer_cache, flush_buffered_states
+from cbt.submission import save_responses
+from cbt.sync_pacing import LoadMiddleware, current_load, load_cache, sync_pacing
+from cbt.sync import SyncClosed
+from cbt.event_log import compact_response_events, log_sync, response_history
+from cbt.benchmark.metrics import Recorder
+from cbt.metrics import MmapValues
+from cbt.benchmark.provision import provision
+from cbt.scoring_queue import claim_jobs, enqueue_scoring, run_claimed, run_pending_jobs
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from PIL import Image
+import img2pdf
+import tempfile
+from unittest import mock
+import csv
+import hashlib
 import json
+import os
+import itertools
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+
+
+def text_pdf(pages):
+    """
+    Minimal PDF with one Helvetica text line per (y, text) pair on each 600x800 page.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        stream = b"".join(b"BT /F1 12 Tf 50 %d Td (%s) Tj ET\n" % (y, text.encode()) for y, text in lines)
+        objects.append(b"<< /Length %d >>stream\n%sendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 600 800] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
 
 class CBTTestCase(TestCase):
     def setUp(self):
@@ -82,6 +159,10 @@ Section B, 3, NAT, 5.0:5.2, 2, 0
         # Total = 5
         self.assertEqual(attempt.total_score, 5.0)
 
+        response = self.client.get(f'{url}result/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '5.0:5.2')
+
     def test_scoring_logic_details(self):
         # Create attempt
         attempt = Attempt.objects.create(user=self.user, exam=self.exam)
@@ -105,3 +186,1036 @@ Section B, 3, NAT, 5.0:5.2, 2, 0
         # Q3: 0
         # Total: -0.33
         self.assertAlmostEqual(float(attempt.total_score), -0.33)
+
+    def test_batch_scoring_many_attempts(self):
+        q1 = QuestionMeta.objects.get(question_number=1)
+        q2 = QuestionMeta.objects.get(question_number=2)
+        q3 = QuestionMeta.objects.get(question_number=3)
+
+        answers = [
+            # (q1, q2, q3, expected total)
+            (('A', 'answered'), ('b, a', 'answered'), ('5.2', 'answered'), '5.00'),
+            (('C', 'answered'), ('A;B', 'answered'), ('abc', 'answered'), '-0.33'),
+            ((None, 'answered'), ('A,B,C', 'answered'), ('4.99', 'answered'), '-0.33'),
+            (('B', 'marked_for_review'), (None, 'not_answered'), ('5.0', 'answered'), '2.00'),
+        ]
+        attempts = []
+        for a1, a2, a3, _ in answers:
+            attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+            for q, (val, status) in zip((q1, q2, q3), (a1, a2, a3)):
+                Response.objects.create(attempt=attempt, question=q, user_input=val, status=status)
+            attempts.append(attempt)
+        empty = Attempt.objects.create(user=self.user, exam=self.exam)
+        rebuild_exam_stats(self.exam.id)
+
+        # exams, key version, savepoint, attempt locks, responses, 2 bulk updates, statistics delta, release
+        with self.assertNumQueries(9):
+            totals = score_attempts([a.id for a in attempts] + [empty.id])
+
+        for attempt, (_, _, _, expected) in zip(attempts, answers):
+            attempt.refresh_from_db()
+            self.assertEqual(attempt.total_score, Decimal(expected))
+            self.assertEqual(totals[attempt.id], Decimal(expected))
+        empty.refresh_from_db()
+        self.assertEqual(empty.total_score, 0)
+
+        r = Response.objects.get(attempt=attempts[1], question=q1)
+        self.assertFalse(r.is_correct)
+        self.assertEqual(r.marks_awarded, Decimal('-0.33'))
+
+    def test_compiled_key_cache_and_invalidation(self):
+        key = get_compiled_key(self.exam.id)
+        self.assertEqual(len(key), 3)
+        self.assertEqual(key.marks_negative(0), Decimal('0.33'))
+
+        # Served from the process-local cache while the exam is unchanged, after reading its version
+        with self.assertNumQueries(1):
+            self.assertIs(get_compiled_key(self.exam.id), key)
+
+        q3 = QuestionMeta.objects.get(question_number=3)
+        q3.correct_answer = '6.0:6.5'
+        q3.save()
+
+        new_key = get_compiled_key(self.exam.id)
+        self.assertIsNot(new_key, key)
+        self.assertEqual(new_key.nat_low[new_key.position[q3.id]], 6.0)
+
+        # The stamp is kept on the exam row, so a process with its own (here: emptied) cache sees the same one
+        cbt_cache().clear()
+        self.assertEqual(exam_version(self.exam.id), new_key.version)
+        self.assertIs(get_compiled_key(self.exam.id), new_key)
+
+    def test_exam_manifest_cached_per_version(self):
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+        url = f'/cbt/exam/{self.exam.slug}/manifest.json'
+        response = self.client.get(url)
+        manifest = response.json()
+        self.assertEqual([q['number'] for q in manifest['questions']], [1, 2, 3])
+        self.assertEqual(manifest['questions'][0]['section'], 'Section A')
+        self.assertEqual(manifest['exam']['duration_minutes'], 60)
+
+        # Revalidation by ETag; the manifest itself costs no queries while the exam is unchanged
+        etag = response['ETag']
+        with self.assertNumQueries(3):
+            # session, user, exam
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.assertNumQueries(3):
+            # session, user, attempt with its exam
+            self.assertEqual(self.client.get(f'/cbt/attempt/{attempt.id}/').status_code, 200)
+
+        q3 = QuestionMeta.objects.get(question_number=3)
+        q3.question_type = 'MSQ'
+        q3.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['questions'][2]['type'], 'MSQ')
+
+    def test_exam_stats_rank_and_difficulty(self):
+        # Q1 MCQ A (1, -0.33), Q2 MSQ A;B (2), Q3 NAT 5.0:5.5 (2)
+        answers = [('A', 'A,B', '5.2'), ('A', None, '5.0'), ('B', 'A,B', None), (None, None, None), ('A', 'A,B', '9')]
+        attempts = []
+        for values in answers:
+            attempt = Attempt.objects.create(user=self.user, exam=self.exam, is_submitted=True)
+            for q, value in zip(self.exam.questions.order_by('question_number'), values):
+                Response.objects.create(attempt=attempt, question=q, user_input=value,
+                                        status='answered' if value else 'not_answered')
+            attempts.append(attempt)
+
+        # Scored one by one, as submissions arrive; the totals are 5, 3, 1.67, 0 and 3
+        for attempt in attempts:
+            calculate_score(attempt.id)
+        # Submits only append deltas, which the worker folds in (the first time by rebuilding)
+        self.assertIsNone(exam_standing(self.exam.id, Decimal('3.00')))
+        self.assertEqual(fold_exam_stats(), [self.exam.id])
+        self.assertFalse(StatsDelta.objects.exists())
+        standing = exam_standing(self.exam.id, Decimal('3.00'))
+        self.assertEqual((standing['rank'], standing['attempts'], standing['percentile']), (2, 5, 60.0))
+        self.assertEqual(exam_standing(self.exam.id, Decimal('5.00'))['rank'], 1)
+        self.assertEqual(sum(b['count'] for b in standing['histogram']), 5)
+
+        # Re-scoring doesn't count an attempt twice
+        calculate_score(attempts[0].id)
+        calculate_score(attempts[3].id)
+        self.assertEqual(fold_exam_stats(batch_size=1), [self.exam.id])
+        incremental = (exam_standing(self.exam.id, Decimal('1.67')), question_difficulty(self.exam.id))
+        self.assertEqual(incremental[0]['rank'], 4)
+        self.assertEqual(incremental[0]['average'], Decimal('2.53'))
+        q1, q2, q3 = self.exam.questions.order_by('question_number')
+        self.assertEqual(incremental[1], {q1.id: 60.0, q2.id: 60.0, q3.id: 40.0})
+        self.assertEqual(QuestionStats.objects.get(question=q1).unattempted, 1)
+
+        call_command('rebuild_exam_stats', self.exam.slug, stdout=StringIO())
+        self.assertEqual((exam_standing(self.exam.id, Decimal('1.67')), question_difficulty(self.exam.id)), incremental)
+
+        # The result page shows rank and difficulty without scanning the exam's attempts
+        self.client.get(f'/cbt/attempt/{attempts[1].id}/result/')
+        # A statistics change makes the cached page stale
+        ExamStats.objects.filter(exam=self.exam).update(updated_at=timezone.now())
+        with self.assertNumQueries(9):
+            # session, user, attempt with its exam, stamp, key version, difficulty, responses, stats, tree nodes
+            response = self.client.get(f'/cbt/attempt/{attempts[1].id}/result/')
+        self.assertEqual(response.context['standing']['rank'], 2)
+        self.assertContains(response, 'Rank: 2 of 5')
+
+        # A key revision moves totals in bulk and recounts
+        revised = "Section, Question No, Type, Key, Marks, Negative\nSection A, 1, MCQ, B, 1, 0.33\n" \
+                  "Section A, 2, MSQ, A;B, 2, 0\nSection B, 3, NAT, 5.0:5.5, 2, 0\n"
+        with self.captureOnCommitCallbacks(execute=True):
+            revise_answer_key(self.exam, SimpleUploadedFile("key.csv", revised.encode()))
+        # Totals are now 3.67, 1.67, 3, 0 and 1.67
+        standing = exam_standing(self.exam.id, Decimal('1.67'))
+        self.assertEqual((standing['rank'], standing['percentile']), (3, 40.0))
+
+    def _make_exam(self, slug, num_questions):
+        rows = ["Section, Question No, Type, Key, Marks, Negative"]
+        rows += [f"Section A, {n}, MCQ, A, 1, 0.33" for n in range(1, num_questions + 1)]
+        return Exam.objects.create(
+            title=slug, slug=slug, duration_minutes=60,
+            question_paper=SimpleUploadedFile("test.pdf", self.pdf_content, content_type="application/pdf"),
+            answer_key_file=SimpleUploadedFile("key.csv", "\n".join(rows).encode(), content_type="text/csv"),
+        )
+
+    def _saved_state(self, url):
+        # The state the exam interface resumes from, as its JSON script element holds it
+        content = self.client.get(url).content.decode()
+        return json.loads(re.search(r'<script id="saved-state" type="application/json">(.*?)</script>', content, re.S)[1])
+
+    def test_result_page_cached_per_score_version(self):
+        q1 = QuestionMeta.objects.get(question_number=1)
+        state = {'responses': {str(q1.id): {'value': 'A', 'status': 'answered'}}}
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, current_state=state)
+        url = f'/cbt/attempt/{attempt.id}/'
+        self.assertEqual(self.client.get(f'{url}result.json').json(), {'status': 'in_progress'})
+        self.client.post(f'{url}submit/')
+
+        first = self.client.get(f'{url}result/')
+        self.assertContains(first, 'Score: 1.00')
+        etag = first['ETag']
+        self.assertEqual(first['Cache-Control'], 'private, no-cache')
+
+        # Served from the cache without touching responses, then not at all once the browser has it
+        with CaptureQueriesContext(connection) as ctx:
+            again = self.client.get(f'{url}result/')
+        self.assertEqual(again.content, first.content)
+        self.assertFalse(any('cbt_response' in q['sql'] for q in ctx.captured_queries))
+        self.assertEqual(self.client.get(f'{url}result/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(
+            self.client.get(f'{url}result/', HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304
+        )
+
+        data = self.client.get(f'{url}result.json').json()
+        self.assertEqual((data['status'], data['total_score'], data['responses'][0]['user_input']), ('scored', '1.00', 'A'))
+
+        # Re-scoring (here after the key is edited) gives a new stamp
+        QuestionMeta.objects.filter(id=q1.id).update(correct_answer='B')
+        bump_exam_version(self.exam.id)
+        calculate_score(attempt.id)
+        rescored = self.client.get(f'{url}result/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rescored.status_code, 200)
+        self.assertNotEqual(rescored['ETag'], etag)
+        self.assertContains(rescored, 'Score: -0.33')
+
+    @override_settings(CBT_READ_REPLICAS=['replica'], CBT_REPLICA_STICKY_SECONDS=10)
+    def test_replica_routing_and_stickiness(self):
+        factory = RequestFactory()
+        seen = []
+
+        @replica_reads
+        def read_view(request):
+            seen.append(router.db_for_read(Exam))
+            with primary_reads():
+                seen.append(router.db_for_read(Exam))
+            return HttpResponse()
+
+        @pins_primary
+        def write_view(request):
+            return HttpResponse()
+
+        # Only views marked as read-only read from a replica, and nothing is written there
+        self.assertEqual(router.db_for_read(Exam), 'default')
+        read_view(factory.get('/'))
+        self.assertEqual(seen, ['replica', 'default'])
+        replica_exam = Exam.objects.get(id=self.exam.id)
+        replica_exam._state.db = 'replica'
+        self.assertEqual(router.db_for_write(Exam, instance=replica_exam), 'default')
+
+        # A client that just wrote reads its own writes from the primary until the pin expires
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+        pin = self.client.post(f'/cbt/attempt/{attempt.id}/submit/').cookies[STICKY_COOKIE]
+        self.assertEqual(pin['max-age'], 10)
+        request = factory.get('/')
+        request.COOKIES[STICKY_COOKIE] = pin.value
+        seen.clear()
+        read_view(request)
+        self.assertEqual(seen, ['default', 'default'])
+        with mock.patch('cbt.db_router.time.time', return_value=time.time() + 11):
+            seen.clear()
+            read_view(request)
+        self.assertEqual(seen[0], 'replica')
+
+        # Without replicas everything stays on the single database
+        with override_settings(CBT_READ_REPLICAS=[]):
+            seen.clear()
+            read_view(factory.get('/'))
+            self.assertEqual(seen, ['default', 'default'])
+            self.assertNotIn(STICKY_COOKIE, write_view(factory.post('/')).cookies)
+
+    def test_submit_query_count_is_constant(self):
+        counts = []
+        for num_questions in (3, 65):
+            exam = self._make_exam(f'paper-{num_questions}', num_questions)
+            state = {'responses': {
+                str(q.id): {'value': 'A', 'status': 'answered'} for q in exam.questions.all()
+            }}
+            attempt = Attempt.objects.create(user=self.user, exam=exam, current_state=state)
+            get_compiled_key(exam.id)
+            rebuild_exam_stats(exam.id)
+
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post(f'/cbt/attempt/{attempt.id}/submit/')
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(ctx.captured_queries))
+
+            attempt.refresh_from_db()
+            self.assertTrue(attempt.is_submitted)
+            self.assertEqual(attempt.total_score, num_questions)
+            self.assertEqual(attempt.responses.count(), num_questions)
+
+        # session, user, savepoints, attempt lock, question check, upsert, submit flag, scoring and statistics delta
+        self.assertEqual(counts, [17, 17])
+
+    def test_submit_rejects_foreign_question(self):
+        other = self._make_exam('other-paper', 2)
+        state = {'responses': {str(other.questions.first().id): {'value': 'A', 'status': 'answered'}}}
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, current_state=state)
+
+        response = self.client.post(f'/cbt/attempt/{attempt.id}/submit/')
+        self.assertEqual(response.status_code, 404)
+        attempt.refresh_from_db()
+        self.assertFalse(attempt.is_submitted)
+        self.assertFalse(attempt.responses.exists())
+
+        # A foreign-question row written some other way is skipped by scoring and the result page
+        q1 = QuestionMeta.objects.get(exam=self.exam, question_number=1)
+        Response.objects.create(attempt=attempt, question=q1, user_input='A', status='answered')
+        Response.objects.create(attempt=attempt, question=other.questions.first(), user_input='A', status='answered')
+        Attempt.objects.filter(id=attempt.id).update(is_submitted=True, completed_at=timezone.now())
+        with self.assertLogs('cbt.scoring_logic', 'WARNING') as logs:
+            self.assertEqual(calculate_score(attempt.id), Decimal('1.00'))
+        self.assertIn('Skipping 1 response(s)', logs.output[0])
+        response = self.client.get(f'/cbt/attempt/{attempt.id}/result/')
+        self.assertEqual([row['number'] for row in response.context['responses']], [1])
+
+    def test_delta_sync_protocol(self):
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+        url = f'/cbt/attempt/{attempt.id}/sync/'
+        q1, q2 = (str(QuestionMeta.objects.get(question_number=n).id) for n in (1, 2))
+
+        def sync(payload):
+            response = self.client.post(url, data=payload, content_type='application/json')
+            return response.status_code, response.json()
+
+        self.assertEqual(sync({'base': 0, 'patch': {q1: {'value': 'A', 'status': 'answered'}}}), (200, {'status': 'ok', 'seq': 1}))
+        self.assertEqual(sync({'base': 1, 'patch': {q2: {'value': 'B', 'status': 'answered'}}}), (200, {'status': 'ok', 'seq': 2}))
+
+        # Empty and unchanged patches are acknowledged without any write
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(sync({'base': 2, 'patch': {}}), (200, {'status': 'noop', 'seq': 2}))
+        self.assertFalse(any(q['sql'].startswith('UPDATE') for q in ctx.captured_queries))
+        self.assertEqual(sync({'base': 2, 'patch': {q1: {'value': 'A', 'status': 'answered'}}}), (200, {'status': 'noop', 'seq': 2}))
+
+        # A patch on a stale base is refused; a full snapshot recovers
+        self.assertEqual(sync({'base': 1, 'patch': {q1: {'value': 'C', 'status': 'answered'}}}), (409, {'status': 'resync', 'seq': 2}))
+        self.assertEqual(sync({'full': True, 'responses': {q1: {'value': 'C', 'status': 'answered'}}}), (200, {'status': 'ok', 'seq': 3}))
+        self.assertEqual(sync({'base': 3, 'patch': ['bad']})[0], 400)
+
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state, {'responses': {q1: {'value': 'C', 'status': 'answered'}}, 'seq': 3})
+
+    @override_settings(CBT_SYNC_INTERVAL=10, CBT_SYNC_MAX_INTERVAL=60, CBT_SYNC_SHED_LOAD=4)
+    @override_settings(CBT_SYNC_PACING=True, CBT_SYNC_TARGET_IN_FLIGHT=2)
+    def test_sync_pacing_follows_load(self):
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+        url = f'/cbt/attempt/{attempt.id}/sync/'
+        q1 = str(QuestionMeta.objects.get(question_number=1).id)
+        cache = load_cache()
+        cache.clear()
+
+        def sync(base, value, headers=None):
+            payload = {'base': base, 'patch': {q1: {'value': value, 'status': 'answered'}}}
+            return self.client.post(url, data=payload, content_type='application/json', headers=headers)
+
+        def other_worker(busy_seconds):
+            # Another process's requests, published to the shared counters a second ago
+            key = f'cbt:load:{int(time.time()) - 1}:busy_ms'
+            cache.add(key, 0)
+            cache.incr(key, busy_seconds * 1000)
+
+        with self.settings(CBT_SYNC_PACING=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                LoadMiddleware(lambda request: None)
+        # Publish and re-read on every request instead of once a second
+        with mock.patch.multiple('cbt.sync_pacing', PUBLISH_INTERVAL=0, _pending=dict.fromkeys(['busy_ms', 'queries', 'query_us'], 0)):
+            response = sync(0, 'A')
+            self.assertEqual((response['X-Sync-Interval'], response['X-Sync-Jitter']), ('10', '5'))
+            # The middleware published this request's time and queries
+            self.assertTrue(0 < current_load(time.time() + 1) < 1)
+
+            # 50 request-seconds over the 10 second window: 5 in flight against a target of 2
+            other_worker(50)
+            response = sync(1, 'B')
+            self.assertEqual(response.json()['seq'], 2)
+            self.assertEqual((response['X-Sync-Interval'], response['X-Sync-Jitter']), ('25', '12.5'))
+            self.assertEqual(sync_pacing(100), (60, 30))
+
+            # Overloaded: plain syncs are refused before any query, flushes still go through
+            other_worker(40)
+            with CaptureQueriesContext(connection) as ctx:
+                response = sync(2, 'C')
+            self.assertEqual((response.status_code, response.json(), response['Retry-After']), (503, {'status': 'busy'}, '45'))
+            self.assertFalse(any('cbt_attempt' in q['sql'] for q in ctx.captured_queries))
+            self.assertEqual(sync(2, 'C', {'X-Sync-Flush': '1'}).json(), {'status': 'ok', 'seq': 3})
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state['responses'][q1]['value'], 'C')
+
+        # The tests' LocMem cache is per process, which the system checks refuse for the counters
+        self.assertEqual([error.id for error in check_sync_load_cache(None)], ['cbt.E002'])
+        cache.clear()
+
+    @override_settings(CBT_SYNC_WRITE_BEHIND=True, CBT_SYNC_FLUSH_INTERVAL=None, CBT_SYNC_MAX_UNFLUSHED_AGE=30)
+    def test_write_behind_sync(self):
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+        url = f'/cbt/attempt/{attempt.id}/'
+        q1 = str(QuestionMeta.objects.get(question_number=1).id)
+
+        def sync(base, value):
+            patch = {q1: {'value': value, 'status': 'answered'}}
+            return self.client.post(f'{url}sync/', data={'base': base, 'patch': patch}, content_type='application/json').json()
+
+        now = time.time()
+        with mock.patch('cbt.state_buffer.time.time', return_value=now):
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(sync(0, 'A'), {'status': 'ok', 'seq': 1})
+            self.assertFalse(any(q['sql'].startswith('UPDATE') for q in ctx.captured_queries))
+            attempt.refresh_from_db()
+            self.assertEqual(attempt.current_state, {})
+
+            # Resume reads through the buffer
+            self.assertEqual(self._saved_state(url)['seq'], 1)
+
+        # Past the crash-safety bound the next sync is written through
+        with mock.patch('cbt.state_buffer.time.time', return_value=now + 31):
+            self.assertEqual(sync(1, 'B'), {'status': 'ok', 'seq': 2})
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state['responses'][q1]['value'], 'B')
+
+        # The overdue sweep enforces the bound for attempts that stop syncing
+        self.assertEqual(sync(2, 'A'), {'status': 'ok', 'seq': 3})
+        out = StringIO()
+        call_command('flush_attempt_state', '--overdue', stdout=out)
+        with mock.patch('cbt.state_buffer.time.time', return_value=now + 31):
+            call_command('flush_attempt_state', '--overdue', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ["Flushed 0 attempt state(s).", "Flushed 1 attempt state(s)."])
+        self.assertEqual(flush_buffered_states(), 0)
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state['seq'], 3)
+
+        # A buffered state older than the stored one is never flushed over it
+        buffer_cache().set(f'cbt:attempt-state:{attempt.id}', {'state': {'responses': {}, 'seq': 2}, 'pending_since': 0})
+        self.assertEqual(flush_buffered_states([attempt.id]), 0)
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state['seq'], 3)
+
+        # A sync that can't get the attempt's lock in time is refused, and leaves the holder's lock alone
+        lock = f'cbt:attempt-state-lock:{attempt.id}'
+        buffer_cache().add(lock, 'other', 60)
+        with mock.patch('cbt.state_buffer.time.time', side_effect=itertools.count(now, 6).__next__):
+            busy = self.client.post(f'{url}sync/', data={'base': 3, 'patch': {q1: {'value': 'C'}}},
+                                    content_type='application/json')
+        self.assertEqual((busy.status_code, busy.json(), busy['Retry-After']), (503, {'status': 'busy'}, '1'))
+        self.assertEqual(buffer_cache().get(lock), 'other')
+        buffer_cache().delete(lock)
+
+        # The tests' LocMem cache is per process, which the system checks refuse for the buffer
+        self.assertEqual([error.id for error in check_sync_buffer_cache(None)], ['cbt.E001'])
+
+        # Submit scores the buffered state even if it was never flushed
+        sync(3, 'C')
+        self.client.post(f'{url}submit/')
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state['seq'], 4)
+        self.assertEqual(attempt.total_score, Decimal('-0.33'))
+
+    @override_settings(CBT_SYNC_EVENT_LOG=True, CBT_EVENT_RETENTION_DAYS=30)
+    def test_event_log_sync_compaction_and_history(self):
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, current_state={'responses': {}, 'seq': 2})
+        url = f'/cbt/attempt/{attempt.id}/'
+        q1, q2 = (str(QuestionMeta.objects.get(question_number=n).id) for n in (1, 2))
+
+        def sync(payload):
+            response = self.client.post(f'{url}sync/', data=payload, content_type='application/json')
+            return response.status_code, response.json()
+
+        # State synced before the log was switched on: the first patch can't claim a seq
+        answer = {'value': 'A', 'status': 'answered'}
+        self.assertEqual(sync({'base': 2, 'patch': {q1: answer}}), (409, {'status': 'resync', 'seq': 0}))
+        self.assertEqual(sync({'full': True, 'responses': {q1: answer}, 'ts': 1700000000000}), (200, {'status': 'ok', 'seq': 3}))
+
+        # A patch is plain inserts; the state blob is neither read nor rewritten
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                sync({'base': 3, 'patch': {q1: {'value': 'B', 'status': 'answered'}, q2: answer}}),
+                (200, {'status': 'ok', 'seq': 4}),
+            )
+        self.assertFalse(any('current_state' in q['sql'] for q in ctx.captured_queries))
+        self.assertEqual(ResponseEvent.objects.filter(attempt=attempt, seq=4).count(), 2)
+        self.assertEqual(sync({'base': 3, 'patch': {q1: answer}}), (409, {'status': 'resync', 'seq': 4}))
+        self.assertEqual(sync({'base': 4, 'patch': {q1: {'value': 'x' * 256}}})[0], 400)
+        self.assertEqual(sync({'base': 4, 'patch': {}}), (200, {'status': 'noop', 'seq': 4}))
+
+        # Resume replays the events on top of the stored state
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state, {'responses': {}, 'seq': 2})
+        saved = self._saved_state(url)
+        self.assertEqual((saved['seq'], saved['responses'][q1]['value']), (4, 'B'))
+
+        self.assertEqual(compact_response_events(), (1, 0))
+        self.assertEqual(compact_response_events(), (0, 0))
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.current_state['seq'], 4)
+        self.assertEqual(attempt.current_state['responses'][q1], {'value': 'B', 'status': 'answered'})
+
+        # Submit folds events logged after the last compaction
+        self.assertEqual(sync({'base': 4, 'patch': {q2: {'value': None, 'status': 'not_answered'}}})[1]['seq'], 5)
+        # Rendered as JSON, so a cleared answer resumes as null rather than breaking the page's script
+        self.assertEqual(self._saved_state(url)['responses'][q2], {'value': None, 'status': 'not_answered'})
+        self.client.post(f'{url}submit/')
+        self.assertEqual(
+            dict(attempt.responses.filter(question_id__in=[q1, q2]).values_list('question_id', 'user_input')),
+            {int(q1): 'B', int(q2): None},
+        )
+
+        # A sync that got past the view's check while the submit committed writes nothing
+        for payload in ({'base': 5, 'patch': {q1: answer}}, {'responses': {q1: answer}}):
+            with self.assertRaises(SyncClosed):
+                log_sync(attempt, payload)
+        self.assertEqual(ResponseEvent.objects.filter(attempt=attempt, seq__gt=5).count(), 0)
+
+        # The history survives compaction until retention runs out
+        history = list(response_history(attempt, int(q1)))
+        self.assertEqual([(e['seq'], e['question_id'], e['value']) for e in history],
+                         [(3, None, None), (3, int(q1), 'A'), (4, int(q1), 'B')])
+        self.assertEqual(history[1]['client_ts'].year, 2023)
+        out = StringIO()
+        call_command('response_history', attempt.id, '--question', '1', stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[1].split(',')[:2], ['3', 'reset'])
+
+        Attempt.objects.filter(id=attempt.id).update(completed_at=timezone.now() - timedelta(days=31))
+        self.assertEqual(compact_response_events(), (0, 5))
+        self.assertFalse(ResponseEvent.objects.exists())
+
+    @override_settings(CBT_ASYNC_SCORING=True)
+    def test_async_scoring_queue(self):
+        q1 = QuestionMeta.objects.get(question_number=1)
+        state = {'responses': {str(q1.id): {'value': 'A', 'status': 'answered'}}}
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, current_state=state)
+        url = f'/cbt/attempt/{attempt.id}/'
+
+        self.client.post(f'{url}submit/')
+        attempt.refresh_from_db()
+        self.assertTrue(attempt.is_submitted)
+        self.assertIsNone(attempt.total_score)
+        self.assertContains(self.client.get(f'{url}result/'), 'Scoring in progress')
+        self.assertEqual(self.client.get(f'{url}status/').json(), {'status': 'scoring', 'total_score': None})
+
+        # A worker that died mid-batch leaves its claim behind until the lease expires
+        token, claimed = claim_jobs(10)
+        self.assertEqual(claimed, [attempt.id])
+        self.assertEqual(claim_jobs(10)[1], [])
+        ScoringJob.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+
+        call_command('run_scoring_worker', processes=1, once=True, stdout=StringIO())
+        job = ScoringJob.objects.get(attempt=attempt)
+        self.assertEqual((job.status, job.tries), (ScoringJob.DONE, 2))
+        # The stale claim can no longer complete or fail the job
+        run_claimed(token, [])
+        self.assertEqual(self.client.get(f'{url}status/').json(), {'status': 'scored', 'total_score': '1.00'})
+        self.assertContains(self.client.get(f'{url}result/'), 'Score: 1.00')
+
+    @override_settings(CBT_ASYNC_SCORING=True, CBT_SCORING_MAX_TRIES=2, CBT_SCORING_RETRY_DELAY=0)
+    def test_async_scoring_retries_then_fails(self):
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, is_submitted=True)
+        enqueue_scoring([attempt.id])
+
+        with mock.patch('cbt.scoring_queue.score_attempts', side_effect=RuntimeError('boom')), \
+                self.assertLogs('cbt.scoring_queue', 'ERROR'):
+            self.assertEqual(run_pending_jobs(), 0)
+        job = ScoringJob.objects.get(attempt=attempt)
+        self.assertEqual((job.status, job.tries), (ScoringJob.FAILED, 2))
+        self.assertIn('boom', job.last_error)
+        self.assertEqual(self.client.get(f'/cbt/attempt/{attempt.id}/status/').json()['status'], 'failed')
+
+        # Re-queuing starts over
+        enqueue_scoring([attempt.id])
+        self.assertEqual(run_pending_jobs(), 1)
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.total_score, 0)
+
+    def test_scoring_job_run_twice_counts_once(self):
+        q1 = QuestionMeta.objects.get(question_number=1)
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, is_submitted=True)
+        save_responses(attempt, {str(q1.id): {'value': 'A', 'status': 'answered'}})
+        enqueue_scoring([attempt.id])
+        token, attempt_ids = claim_jobs(10)
+
+        # The lease runs out and another worker reclaims the job, finishing it while the first is still scoring
+        ScoringJob.objects.filter(attempt=attempt).update(locked_until=timezone.now() - timedelta(seconds=1))
+        real_key, reclaimed = get_compiled_key, []
+
+        def key_then_reclaim(exam_id):
+            if not reclaimed:
+                reclaimed.append(claim_jobs(10))
+                reclaimed.append(run_claimed(*reclaimed[0]))
+            return real_key(exam_id)
+
+        with mock.patch('cbt.scoring_logic.get_compiled_key', side_effect=key_then_reclaim):
+            self.assertEqual(run_claimed(token, attempt_ids), 1)
+        self.assertEqual(reclaimed[1:], [1])
+
+        def stats():
+            return (
+                ExamStats.objects.values_list('attempts', 'score_sum_cents').get(exam=self.exam),
+                list(QuestionStats.objects.filter(question__exam=self.exam).order_by('question_id')
+                     .values_list('correct', 'incorrect', 'unattempted')),
+            )
+
+        fold_exam_stats()
+        incremental = stats()
+        self.assertEqual(incremental[0], (1, 100))
+        rebuild_exam_stats(self.exam.id)
+        self.assertEqual(stats(), incremental)
+
+    def test_key_revision_rescores_only_changed_questions(self):
+        q1, q2, q3 = (QuestionMeta.objects.get(question_number=n) for n in (1, 2, 3))
+        answers = [('A', 'A,B', '5.25'), ('B', 'A', '5.1'), ('C', None, None)]
+        attempts = []
+        for values in answers:
+            state = {'responses': {str(q.id): {'value': v, 'status': 'answered' if v else 'not_answered'}
+                                   for q, v in zip((q1, q2, q3), values)}}
+            attempt = Attempt.objects.create(user=self.user, exam=self.exam, current_state=state)
+            self.client.post(f'/cbt/attempt/{attempt.id}/submit/')
+            attempts.append(attempt)
+        unsubmitted = Attempt.objects.create(user=self.user, exam=self.exam)
+        Response.objects.create(attempt=unsubmitted, question=q3, user_input='5.25', status='answered')
+
+        # Widen the NAT range and make the MCQ a bonus question
+        revised = b"""Section, Question No, Type, Key, Marks, Negative
+Section A, 1, MCQ, BONUS, 1, 0.33
+Section A, 2, MSQ, A;B, 2, 0
+Section B, 3, NAT, 5.0:5.3, 2, 0
+"""
+        summary = revise_answer_key(self.exam, SimpleUploadedFile("key.csv", revised))
+        self.assertEqual(summary, {'updated': 2, 'created': 0, 'removed': 0,
+                                   'rescored_responses': 3, 'adjusted_attempts': 3})
+
+        # Same totals as a full re-score, and the unsubmitted attempt is untouched
+        expected = {a.id: a.total_score for a in Attempt.objects.filter(id__in=[a.id for a in attempts])}
+        self.assertEqual(expected, score_attempts(list(expected)))
+        self.assertEqual([expected[a.id] for a in attempts], [Decimal('5.00'), Decimal('3.00'), Decimal('1.00')])
+        self.assertIsNone(Response.objects.get(attempt=unsubmitted).is_correct)
+        self.assertEqual(QuestionMeta.objects.get(id=q3.id).correct_answer, '5.0:5.3')
+
+        result = self.client.get(f'/cbt/attempt/{attempts[2].id}/result/')
+        self.assertContains(result, 'Not Attempted')
+
+        # A new question starts as not visited in every submitted attempt; stats recount on commit
+        fold_exam_stats()
+        with self.captureOnCommitCallbacks() as callbacks:
+            summary = revise_answer_key(self.exam, SimpleUploadedFile("key.csv", revised + b"Section B, 4, NAT, 1:2, 1, 0\n"))
+        self.assertEqual(summary, {'updated': 0, 'created': 1, 'removed': 0,
+                                   'rescored_responses': 3, 'adjusted_attempts': 0})
+        q4 = QuestionMeta.objects.get(exam=self.exam, question_number=4)
+        self.assertEqual(sorted(Response.objects.filter(question=q4).values_list('attempt_id', 'status', 'is_correct')),
+                         [(a.id, 'not_visited', False) for a in attempts])
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(ExamStats.objects.get(exam=self.exam).attempts, 3)
+        callbacks[0]()
+        self.assertEqual(QuestionStats.objects.get(question=q4).unattempted, 3)
+        self.assertContains(self.client.get(f'/cbt/attempt/{attempts[0].id}/result/'), 'Not Attempted')
+
+    def test_answer_key_import_upserts_in_batches(self):
+        q1 = QuestionMeta.objects.get(question_number=1)
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+        Response.objects.create(attempt=attempt, question=q1, user_input='A', status='answered')
+
+        # JSON key: Q1 changes in place, Q3 is dropped, Q4-Q6 are new
+        questions = [{'section': 'Section A', 'number': 1, 'type': 'MCQ', 'key': 'B', 'marks': 1, 'negative': 0.33},
+                     {'section': 'Section A', 'number': 2, 'type': 'MSQ', 'key': 'A;B', 'marks': 2, 'negative': 0}]
+        questions += [{'section': 'Section C', 'number': n, 'type': 'NAT', 'key': '1:2', 'marks': 1, 'negative': 0}
+                      for n in (4, 5, 6)]
+        self.exam.answer_key_file = SimpleUploadedFile("key.json", json.dumps(questions).encode())
+        with self.assertNumQueries(13):
+            # savepoint, sections, numbers, 2 x (new sections + upsert), delete Q3 (+ 2 cascades, version),
+            # version, release
+            process_answer_key(self.exam, batch_size=3)
+
+        self.assertEqual(QuestionMeta.objects.get(id=q1.id).correct_answer, 'B')
+        self.assertTrue(Response.objects.filter(attempt=attempt, question=q1).exists())
+        self.assertEqual(sorted(self.exam.questions.values_list('question_number', flat=True)), [1, 2, 4, 5, 6])
+        self.assertEqual(list(self.exam.sections.values_list('name', 'order')),
+                         [('Section A', 1), ('Section B', 2), ('Section C', 3)])
+
+    def test_answer_key_errors_report_line(self):
+        form = ExamForm(
+            data={'title': 'Bad', 'slug': 'bad', 'duration_minutes': 60, 'total_marks': 100},
+            files={
+                'question_paper': SimpleUploadedFile("test.pdf", self.pdf_content),
+                'answer_key_file': SimpleUploadedFile("key.csv", b"""Section, Question No, Type, Key, Marks, Negative
+Section A, 1, MCQ, A, 1, 0.33
+Section A, 2, NAT, five, 1, 0
+"""),
+            },
+        )
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['answer_key_file'],
+                         ["Line 3: NAT key must be a number or a min:max range, got 'five'."])
+
+        # Rows without a section (notes, totals) are skipped, as they always were
+        exam = Exam.objects.create(
+            title='Notes', slug='notes', duration_minutes=60,
+            question_paper=SimpleUploadedFile("test.pdf", self.pdf_content),
+            answer_key_file=SimpleUploadedFile("key.csv", b"""Section, Question No, Type, Key, Marks, Negative
+Section A, 1, MCQ, A, 1, 0.33
+, , , Total, 1,
+"""),
+        )
+        self.assertEqual(list(exam.questions.values_list('question_number', flat=True)), [1])
+
+    def test_zip_of_page_images_becomes_pdf(self):
+        def image(mode, color, fmt, size):
+            data = BytesIO()
+            Image.new(mode, size, color).save(data, format=fmt)
+            return data.getvalue()
+
+        page1, page2 = image('RGB', 'white', 'JPEG', (96, 192)), image('L', 200, 'JPEG', (96, 288))
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('scan/page10.png', image('RGBA', (0, 0, 0, 0), 'PNG', (192, 96)))
+            zf.writestr('scan/page2.jpg', page2)
+            zf.writestr('scan/page1.jpg', page1)
+            zf.writestr('__MACOSX/scan/._page1.jpg', b'resource fork')
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            exam = Exam.objects.create(title="Scan", slug="scan", duration_minutes=60,
+                                       question_paper=SimpleUploadedFile("scan.zip", archive.getvalue()))
+            self.assertTrue(exam.question_paper.name.endswith('.pdf'))
+            with exam.question_paper.open('rb') as f:
+                pdf = f.read()
+
+        # JPEG pages are embedded byte for byte, in page order; the RGBA page is flattened
+        self.assertIn(page1, pdf)
+        self.assertIn(page2, pdf)
+        self.assertEqual(re.findall(rb'/MediaBox \[0 0 (\d+)\.0+ (\d+)\.0+\]', pdf),
+                         [(b'72', b'144'), (b'72', b'216'), (b'144', b'72')])
+
+        form = ExamForm(
+            data={'title': 'Empty', 'slug': 'empty', 'duration_minutes': 60, 'total_marks': 100},
+            files={'question_paper': SimpleUploadedFile("empty.zip", b"not a zip"),
+                   'answer_key_file': SimpleUploadedFile("key.csv", b"Section, Question No, Key, Marks, Negative\n")},
+        )
+        self.assertEqual(form.errors['question_paper'], ["The question paper is not a valid ZIP archive."])
+
+    def test_page_images_rendered_and_served(self):
+        image = BytesIO()
+        Image.new('RGB', (300, 450), 'white').save(image, format='JPEG')
+        pdf = SimpleUploadedFile("scan.pdf", img2pdf.convert(image.getvalue()), content_type="application/pdf")
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root, CBT_PAGE_WIDTHS=(100, 200)):
+            exam = Exam.objects.create(title="Scan", slug="scan", duration_minutes=60, question_paper=pdf)
+            self.assertEqual(len(exam.paper_digest), 64)
+            schedule_page_render(exam, wait=True)
+
+            attempt = Attempt.objects.create(user=self.user, exam=exam)
+            page_images = self.client.get(f'/cbt/exam/{exam.slug}/manifest.json').json()['page_images']
+            self.assertEqual(page_images['widths'], [100, 200])
+
+            response = self.client.get(f'/cbt/pages/{exam.paper_digest}/1/200/')
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).width, 200)
+            self.assertEqual(self.client.get(f'/cbt/pages/{exam.paper_digest}/2/200/').status_code, 404)
+            self.assertEqual(self.client.get(f'/cbt/pages/{exam.paper_digest}/1/150/').status_code, 404)
+            # A page missing from disk is a 404, not a server error
+            os.remove(os.path.join(media_root, page_storage_name(exam.paper_digest, 1, 200, 'webp')))
+            self.assertEqual(self.client.get(f'/cbt/pages/{exam.paper_digest}/1/200/').status_code, 404)
+
+    def test_question_paper_ranges_and_etag(self):
+        url = f'/cbt/exam/{self.exam.slug}/paper/{self.exam.paper_digest}.pdf'
+        etag = f'"{self.exam.paper_digest}"'
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.pdf_content)
+        self.assertEqual((response['ETag'], response['Accept-Ranges']), (etag, 'bytes'))
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get(url, headers={'Range': 'bytes=5-7'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 5-7/{len(self.pdf_content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.pdf_content[5:8])
+        response = self.client.get(url, headers={'Range': 'bytes=-4'})
+        self.assertEqual(b''.join(response.streaming_content), self.pdf_content[-4:])
+
+        self.assertEqual(self.client.get(url, headers={'Range': 'bytes=999-'}).status_code, 416)
+        # An empty file has no last bytes to send
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=-4', 0)
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        # A stale If-Range gets the whole (new) file
+        self.assertEqual(self.client.get(url, headers={'Range': 'bytes=0-1', 'If-Range': '"old"'}).status_code, 200)
+
+        self.assertRedirects(self.client.get(f'/cbt/exam/{self.exam.slug}/paper/{"0" * 64}.pdf'),
+                             reverse('question_paper', args=[self.exam.slug, self.exam.paper_digest]),
+                             fetch_redirect_response=False)
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_question_page_index(self):
+        paper = text_pdf([
+            [(760, 'General instructions'), (700, 'Q.1 Which of the following'), (300, '2. Select all that apply')],
+            [(740, '1. Option list 2.5 and 4.'), (650, 'Question 3: Compute the value'), (200, 'Q 3 continued')],
+        ])
+        self.assertEqual(assign_pages(extract_labels(BytesIO(paper)), [1, 2, 3]), {1: (1, 0.125), 3: (2, 0.1875)})
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            self.exam.question_paper = SimpleUploadedFile("paper.pdf", paper, content_type="application/pdf")
+            self.exam.save()
+            self.assertEqual(index_exam_questions(self.exam, wait=True), 2)
+            # Labels are kept per paper, so re-indexing reads them back and changes nothing
+            self.assertEqual(index_exam_questions(self.exam), 0)
+
+            questions = self.client.get(f'/cbt/exam/{self.exam.slug}/manifest.json').json()['questions']
+        self.assertEqual([(q['page'], q['offset']) for q in questions], [(1, 0.125), (1, None), (2, 0.1875)])
+
+        # A background extraction applies its labels on a thread of its own, even when the
+        # callback runs on the caller's thread, whose connection stays open
+        future = Future()
+        future.set_result([])
+        applied = []
+        with mock.patch('cbt.question_index.apply_question_index', lambda *args: applied.append(threading.get_ident())):
+            _apply_when_done(self.exam.id)(future)
+            for thread in threading.enumerate():
+                if thread.name == 'cbt-question-index':
+                    thread.join()
+        self.assertEqual(len(applied), 1)
+        self.assertNotEqual(applied[0], threading.get_ident())
+        self.assertTrue(connection.is_usable())
+
+    def test_benchmark_fixture_and_report(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            fixture = provision(2, 7)
+            self.assertEqual(fixture.exam.questions.count(), 7)
+            # Provisioned sessions are logged in without going through the login view
+            client = Client()
+            client.cookies['sessionid'] = fixture.session_keys[1]
+            response = client.post(reverse('start_attempt', args=[fixture.exam.slug]))
+            attempt = Attempt.objects.get(user=fixture.users[1])
+            self.assertRedirects(response, reverse('exam_interface', args=[attempt.id]), fetch_redirect_response=False)
+            fixture.delete()
+        self.assertFalse(User.objects.filter(username__startswith=fixture.exam.slug).exists())
+
+        recorder = Recorder()
+        recorder.server_side = True
+        recorder.start()
+        for ms in (10, 20, 30, 40):
+            recorder.request('sync_attempt', ms / 1000, ok=ms != 40)
+        recorder.server_request('sync_attempt', 3)
+        recorder.server_request('sync_attempt', 5, OperationalError('database is locked'))
+        recorder.finish()
+        sync = recorder.report()['endpoints']['sync_attempt']
+        self.assertEqual((sync['requests'], sync['errors'], sync['error_rate']), (4, 1, 0.25))
+        self.assertEqual(sync['latency_ms']['p50'], 25.0)
+        self.assertEqual(sync['queries_per_request'], {'mean': 4.0, 'max': 5})
+        self.assertEqual(sync['lock_errors'], 1)
+
+        # No candidates is refused before anything is provisioned
+        with self.assertRaisesMessage(CommandError, "--candidates must be at least 1."):
+            call_command('benchmark', '--candidates', '0', stderr=StringIO())
+
+    def test_metrics_endpoint_aggregates_processes(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+                override_settings(CBT_METRICS=True, CBT_METRICS_DIR=metrics_dir, CBT_METRICS_TOKEN='s3cret'):
+            client = Client()
+            client.login(username='testuser', password='password')
+            attempt = Attempt.objects.create(user=self.user, exam=self.exam)
+            # The metrics and load middlewares count queries through one shared execute wrapper
+            wrappers = []
+            with mock.patch('cbt.views.get_exam_manifest', side_effect=lambda exam: (
+                wrappers.append(len(connection.execute_wrappers)) or get_exam_manifest(exam)
+            )):
+                client.get(reverse('exam_manifest', args=[self.exam.slug]))
+            self.assertEqual(wrappers, [1])
+            client.post(reverse('submit_attempt', args=[attempt.id]))
+            self.assertEqual(client.get('/metrics/').status_code, 403)
+
+            # Another worker's file is summed in
+            other = MmapValues(f'{metrics_dir}/metrics-999999.db', initial_size=16)
+            for _ in range(40):
+                other.inc(json.dumps(['cbt_responses_total', '', [['status', '2xx'], ['view', 'exam_manifest']]],
+                                     separators=(',', ':')), 1)
+
+            response = client.get('/metrics/', headers={'Authorization': 'Bearer s3cret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE cbt_request_duration_seconds histogram', text)
+        self.assertIn('cbt_responses_total{status="2xx",view="exam_manifest"} 41', text)
+        self.assertIn('cbt_request_duration_seconds_count{view="submit_attempt"} 1', text)
+        self.assertIn('cbt_request_duration_seconds_bucket{view="submit_attempt",le="+Inf"} 1', text)
+        self.assertIn('cbt_operation_duration_seconds_count{operation="calculate_score"} 1', text)
+        self.assertRegex(text, r'cbt_db_queries_total\{view="submit_attempt"\} [1-9]')
+        self.assertRegex(text, r'cbt_response_bytes_total\{view="exam_manifest"\} [1-9]')
+
+    def test_deadlines_enforced_and_expired_attempts_finalized(self):
+        q1 = QuestionMeta.objects.get(exam=self.exam, question_number=1)
+        now = timezone.now()
+        attempt = Attempt.objects.create(user=self.user, exam=self.exam, started_at=now - timedelta(minutes=59))
+        self.assertEqual(attempt.deadline, attempt.started_at + timedelta(minutes=60))
+
+        sync_url = reverse('sync_attempt', args=[attempt.id])
+        patch = {'base': 0, 'patch': {str(q1.id): {'value': 'A', 'status': 'answered'}}}
+        self.assertEqual(self.client.post(sync_url, patch, content_type='application/json').status_code, 200)
+        response = self.client.get(reverse('exam_interface', args=[attempt.id]))
+        self.assertTrue(55 <= response.context['seconds_left'] <= 60)
+
+        # Past the deadline and the grace period: further writes are refused
+        Attempt.objects.filter(id=attempt.id).update(deadline=now - timedelta(minutes=5))
+        patch = {'base': 1, 'patch': {str(q1.id): {'value': 'B', 'status': 'answered'}}}
+        response = self.client.post(sync_url, patch, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['status']), (403, 'closed'))
+
+        other = User.objects.create_user(username='other', password='password')
+        expired = [
+            Attempt.objects.create(user=other, exam=self.exam, started_at=now - timedelta(hours=2)) for _ in range(2)
+        ]
+        running = Attempt.objects.create(user=other, exam=self.exam)
+        self.assertEqual(finalize_expired_attempts(batch_size=2), 3)
+        self.assertEqual(finalize_expired_attempts(), 0)
+
+        attempt.refresh_from_db()
+        self.assertTrue(attempt.is_submitted)
+        self.assertEqual(attempt.completed_at, now - timedelta(minutes=5))
+        # Scored from the last accepted sync
+        self.assertEqual(attempt.total_score, Decimal('1.00'))
+        self.assertEqual(attempt.responses.count(), 3)
+        for abandoned in expired:
+            abandoned.refresh_from_db()
+            self.assertEqual((abandoned.is_submitted, abandoned.total_score), (True, Decimal('0.00')))
+        running.refresh_from_db()
+        self.assertFalse(running.is_submitted)
+
+        # Opening an attempt whose time ran out finalizes it and shows the result
+        Attempt.objects.filter(id=running.id).update(deadline=now - timedelta(minutes=1))
+        self.client.force_login(other)
+        with self.settings(CBT_DEADLINE_GRACE_SECONDS=0):
+            response = self.client.get(reverse('exam_interface', args=[running.id]))
+        self.assertRedirects(response, reverse('exam_result', args=[running.id]), fetch_redirect_response=False)
+        self.assertTrue(Attempt.objects.get(id=running.id).is_submitted)
+
+    def test_results_export_streams_wide_and_long(self):
+        questions = {q.question_number: q.id for q in QuestionMeta.objects.filter(exam=self.exam)}
+        for name, answers in (('alice', {1: 'A', 3: '5.1'}), ('bob', {1: 'C'})):
+            user = User.objects.create_user(username=name, password='password')
+            attempt = Attempt.objects.create(user=user, exam=self.exam, is_submitted=True)
+            Response.objects.bulk_create([
+                Response(attempt=attempt, question_id=questions[number], user_input=answers.get(number),
+                         status='answered' if number in answers else 'not_visited')
+                for number in (3, 1, 2)
+            ])
+        Attempt.objects.create(user=self.user, exam=self.exam)
+        score_attempts(Attempt.objects.filter(is_submitted=True).values_list('id', flat=True))
+
+        url = reverse('export_results', args=[self.exam.slug, 'csv'])
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0][:7], ['attempt_id', 'username', 'started_at', 'completed_at', 'total_score',
+                                       'Q1', 'Q1 marks'])
+        self.assertEqual([(r[1], r[4], r[5], r[9]) for r in rows[1:]], [('alice', '3.00', 'A', '5.1'),
+                                                                         ('bob', '-0.33', 'C', '')])
+
+        out = StringIO()
+        call_command('export_results', self.exam.slug, '--layout', 'long', stdout=out)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[1][1:], ['alice', '1', 'Section A', 'MCQ', 'A', 'answered', 'true', '1.00'])
+        self.assertEqual(rows[3][1:], ['alice', '3', 'Section B', 'NAT', '5.1', 'answered', 'true', '2.00'])
+
+        self.assertEqual(self.client.get(reverse('export_results', args=[self.exam.slug, 'xlsx'])).status_code, 404)
+
+    def test_provision_candidates_and_resume_precreated_attempt(self):
+        roster = b"\xef\xbb\xbfUsername,Password,Email\ncand-1,pass-one,c1@example.com\ncand-2,pass-two,\ncand-3,,\n"
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(roster)
+            f.flush()
+            out = StringIO()
+            call_command('provision_candidates', f.name, '--exam', self.exam.slug, '--processes', '2', stdout=out)
+            self.assertEqual(out.getvalue().strip(), "users created: 3, users existing: 0, attempts created: 3")
+            # Re-running is harmless: nothing is duplicated
+            call_command('provision_candidates', f.name, '--exam', self.exam.slug, stdout=out)
+            self.assertIn("users created: 0, users existing: 3, attempts created: 0", out.getvalue())
+
+        self.assertEqual(User.objects.get(username='cand-1').email, 'c1@example.com')
+        self.assertFalse(User.objects.get(username='cand-3').has_usable_password())
+        client = Client()
+        self.assertTrue(client.login(username='cand-2', password='pass-two'))
+
+        precreated = Attempt.objects.get(user__username='cand-2', exam=self.exam)
+        self.assertEqual((precreated.started_at, precreated.deadline), (None, None))
+        self.assertRedirects(client.get(reverse('exam_interface', args=[precreated.id])),
+                             reverse('exam_detail', args=[self.exam.slug]), fetch_redirect_response=False)
+
+        start_url = reverse('start_attempt', args=[self.exam.slug])
+        with self.assertNumQueries(5):
+            response = client.post(start_url)
+        self.assertRedirects(response, reverse('exam_interface', args=[precreated.id]), fetch_redirect_response=False)
+        precreated.refresh_from_db()
+        self.assertEqual(precreated.deadline, precreated.started_at + timedelta(minutes=60))
+        # A second start resumes the same attempt without restarting its clock
+        client.post(start_url)
+        self.assertEqual(Attempt.objects.get(id=precreated.id).started_at, precreated.started_at)
+        self.assertEqual(Attempt.objects.filter(user__username='cand-2').count(), 1)
+
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(b"username\nok-user\nbad user!\n")
+            f.flush()
+            with self.assertRaisesMessage(CommandError, "Line 3: invalid username 'bad user!'"):
+                call_command('provision_candidates', f.name)
+
+    def test_content_addressed_files_are_shared_and_collected(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            def upload(slug, paper=b'%PDF-1.4 shared paper'):
+                return Exam.objects.create(
+                    title=slug, slug=slug, duration_minutes=60,
+                    question_paper=SimpleUploadedFile("paper.pdf", paper, content_type="application/pdf"),
+                    answer_key_file=SimpleUploadedFile("key.csv", self.csv_content, content_type="text/csv"),
+                )
+
+            first, second = upload('first'), upload('second')
+            digest = hashlib.sha256(b'%PDF-1.4 shared paper').hexdigest()
+            self.assertEqual(first.question_paper.name, f'exams/pdfs/{digest}.pdf')
+            self.assertEqual(second.question_paper.name, first.question_paper.name)
+            self.assertEqual(second.paper_digest, digest)
+            self.assertEqual(os.listdir(f'{media_root}/exams/pdfs'), [f'{digest}.pdf'])
+            self.assertEqual(Blob.objects.get(name=first.question_paper.name).refs, 2)
+            # setUp's exam has the same key
+            self.assertEqual(Blob.objects.get(name=first.answer_key_file.name).refs, 3)
+
+            # Derived artefacts live under the digest and outlast either exam
+            labels = labels_path(digest)
+            labels.parent.mkdir(parents=True)
+            labels.write_text('[]')
+            pages_dir(digest).mkdir(parents=True)
+            (pages_dir(digest) / MANIFEST_NAME).write_text('{"pages": 1}')
+            self.assertEqual(page_manifest(digest), {'pages': 1})
+
+            first = Exam.objects.get(id=first.id)
+            first.question_paper = SimpleUploadedFile("new.pdf", b'%PDF-1.4 revised paper')
+            first.save()
+            self.assertEqual(Blob.objects.get(name=second.question_paper.name).refs, 1)
+            self.assertEqual(collect_blobs(grace=timedelta(0)), [])
+
+            Exam.objects.get(id=second.id).delete()
+            self.assertEqual(collect_blobs(grace=timedelta(minutes=5)), [])
+            # Uploading the same paper again restarts the unreferenced blob's grace period
+            Blob.objects.filter(name=second.question_paper.name).update(updated_at=timezone.now() - timedelta(hours=2))
+            blob_storage().save('exams/pdfs/again.pdf', BytesIO(b'%PDF-1.4 shared paper'))
+            self.assertEqual(collect_blobs(grace=timedelta(hours=1)), [])
+            self.assertEqual(collect_blobs(grace=timedelta(0)), [f'exams/pdfs/{digest}.pdf'])
+            self.assertFalse(os.path.exists(f'{media_root}/exams/pdfs/{digest}.pdf'))
+            self.assertFalse(labels.exists())
+            # The page manifest read earlier isn't trusted once its pages are gone
+            self.assertIsNone(page_manifest(digest))
+            self.assertTrue(first.question_paper.storage.exists(first.question_paper.name))
+            # The key is still used by the first exam
+            self.assertTrue(first.answer_key_file.storage.exists(first.answer_key_file.name))
+
+            # Files stored under upload names before content addressing are moved into it
+            FileSystemStorage(location=media_root).save('exams/pdfs/old_abc123.pdf', BytesIO(b'%PDF-1.4 revised paper'))
+            Exam.objects.filter(id=first.id).update(question_paper='exams/pdfs/old_abc123.pdf')
+            Blob.objects.filter(name=first.question_paper.name).update(refs=0)
+            out = StringIO()
+            call_command('collect_blobs', '--adopt', '--min-age', '0', stdout=out)
+            self.assertEqual(out.getvalue().split('\n')[:2], ["Moved 1 exam file(s) into content-addressed storage.",
+                                                             "Deleted 1 unreferenced file(s)."])
+            self.assertEqual(Exam.objects.get(id=first.id).question_paper.name, first.question_paper.name)
+            self.assertEqual(Blob.objects.get(name=first.question_paper.name).refs, 1)
+            # The old copy had no Blob row, but is collected all the same
+            self.assertFalse(os.path.exists(f'{media_root}/exams/pdfs/old_abc123.pdf'))
+            self.assertFalse(Blob.objects.filter(name='exams/pdfs/old_abc123.pdf').exists())
@@ -6,8 +6,15 @@ urlpatterns = [
     path('add/', views.add_exam, name='add_exam'),
     path('exam/<slug:slug>/', views.exam_detail, name='exam_detail'),
     path('exam/<slug:slug>/start/', views.start_attempt, name='start_attempt'),
+    path('exam/<slug:slug>/manifest.json', views.exam_manifest, name='exam_manifest'),
+    path('exam/<slug:slug>/results.<str:fmt>', views.export_results, name='export_results'),
+    path('exam/<slug:slug>/paper/<slug:digest>.pdf', views.question_paper, name='question_paper'),
     path('attempt/<int:attempt_id>/', views.exam_interface, name='exam_interface'),
     path('attempt/<int:attempt_id>/sync/', views.sync_attempt, name='sync_attempt'),
     path('attempt/<int:attempt_id>/submit/', views.submit_attempt, name='submit_attempt'),
     path('attempt/<int:attempt_id>/result/', views.exam_result, name='exam_result'),
+    path('attempt/<int:attempt_id>/result.json', views.exam_result_json, name='exam_result_json'),
+    path('attempt/<int:attempt_id>/status/', views.attempt_status, name='attempt_status'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('pages/<slug:digest>/<int:page>/<int:width>/', views.paper_page, name='paper_page'),
 ]
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Exam, new_exam_version
+
+
+def cbt_cache():
+    return caches[getattr(settings, 'CBT_CACHE', 'default')]
+
+
+def exam_version(exam_id):
+    """
+    Opaque stamp that changes whenever an exam or its questions change.
+    Anything derived from the exam (compiled keys, manifests) is keyed by it.
+    Kept on the exam row, so every process sees the same stamp, and a change
+    is seen together with the rows it describes once its transaction commits.
+    """
+    return Exam.objects.filter(id=exam_id).values_list('version', flat=True).first()
+
+
+def bump_exam_version(exam_id):
+    # A fresh value rather than a counter: a bump that is rolled back, or a stale
+    # instance saved over a newer stamp, can never bring back a stamp already cached
+    Exam.objects.filter(id=exam_id).update(version=new_exam_version())
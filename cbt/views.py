@@ -1,10 +1,35 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
-from django.utils import timezone
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
+from django.core.files.storage import FileSystemStorage
+from django.conf import settings
+from django.db import transaction
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from .models import Exam, Attempt, QuestionMeta, Response
+from django.core.exceptions import PermissionDenied
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template.loader import render_to_string
+from .models import Exam, Attempt, ScoringJob
 from .scoring_logic import calculate_score
+from .answer_key import get_compiled_key
 from .forms import ExamForm
+from .submission import save_responses, mark_submitted
+from .sync import apply_sync, is_empty_patch, state_seq, SyncBusy, SyncClosed, SyncGap, InvalidSync
+from .scoring_queue import async_scoring_enabled, enqueue_scoring
+from .page_images import CONTENT_TYPES, page_manifest, page_storage_name
+from .exam_manifest import get_exam_manifest
+from .exam_stats import exam_standing, question_difficulty
+from .file_serving import serve_file
+from .deadlines import accepts_writes, begin_attempt, finalize_attempts, seconds_left
+from .results_export import LAYOUTS, csv_chunks, long_rows, parquet_available, parquet_chunks, wide_rows
+from .metrics import collect, metrics_enabled, render_prometheus
+from .result_cache import cached_result, result_stamp
+from .db_router import pins_primary, replica_reads
+from .sync_pacing import paced
+from .state_buffer import write_behind_enabled, buffered_sync, discard_buffered_state
+from .event_log import event_log_enabled, latest_seq, latest_state, log_sync
 import json
 
 @login_required
@@ -20,107 +45,335 @@ def add_exam(request):
     return render(request, 'cbt/add_exam.html', {'form': form})
 
 @login_required
+@replica_reads
 def exam_list(request):
     exams = Exam.objects.filter(is_active=True)
     return render(request, 'cbt/exam_list.html', {'exams': exams})
 
 @login_required
+@replica_reads
 def exam_detail(request, slug):
     exam = get_object_or_404(Exam, slug=slug)
     return render(request, 'cbt/exam_detail.html', {'exam': exam})
 
 @login_required
+@pins_primary
 def start_attempt(request, slug):
     exam = get_object_or_404(Exam, slug=slug)
     if request.method == 'POST':
-        # Create attempt
-        attempt = Attempt.objects.create(user=request.user, exam=exam)
+        # Resume the candidate's open attempt (pre-created or started earlier) before creating one
+        attempt = (
+            Attempt.objects.filter(user=request.user, exam=exam, is_submitted=False)
+            .only('id', 'started_at')
+            .order_by('-id')
+            .first()
+        )
+        if attempt is None:
+            attempt = Attempt.objects.create(user=request.user, exam=exam)
+        elif attempt.started_at is None:
+            begin_attempt(attempt, exam)
         return redirect('exam_interface', attempt_id=attempt.id)
     return redirect('exam_detail', slug=slug)
 
 @login_required
 def exam_interface(request, attempt_id):
-    attempt = get_object_or_404(Attempt, id=attempt_id, user=request.user)
+    attempt = get_object_or_404(Attempt.objects.select_related('exam'), id=attempt_id, user=request.user)
     if attempt.is_submitted:
         return redirect('exam_result', attempt_id=attempt.id)
+    if attempt.started_at is None:
+        # Pre-created and not started yet: the clock starts from the exam page's start button
+        return redirect('exam_detail', slug=attempt.exam.slug)
+    if not accepts_writes(attempt):
+        # Time ran out while the candidate was away: close it now rather than waiting for the sweeper
+        finalize_attempts([attempt.id])
+        return redirect('exam_result', attempt_id=attempt.id)
 
-    questions = attempt.exam.questions.all().order_by('question_number')
+    # Questions, sections and page images come from the exam manifest, fetched separately
+    attempt.exam.ensure_paper_digest()
 
-    # Serialize questions for JS
-    questions_json = []
-    for q in questions:
-        questions_json.append({
-            'id': q.id,
-            'number': q.question_number,
-            'type': q.question_type,
-            'section': q.section.name if q.section else ''
-        })
+    # Resume from the newest state even if it hasn't been flushed or compacted yet
+    attempt.current_state = latest_state(attempt)
 
     context = {
         'exam': attempt.exam,
         'attempt': attempt,
-        'questions_json': json.dumps(questions_json)
+        'seconds_left': seconds_left(attempt),
     }
     return render(request, 'cbt/exam_interface.html', context)
 
 @login_required
+@paced
 def sync_attempt(request, attempt_id):
     if request.method == 'POST':
-        attempt = get_object_or_404(Attempt, id=attempt_id, user=request.user)
         try:
             data = json.loads(request.body)
         except json.JSONDecodeError:
             return JsonResponse({'status': 'invalid json'}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({'status': 'invalid payload'}, status=400)
 
-        # Update state
-        attempt.current_state = data
-        attempt.save()
+        # Nothing changed on the client: acknowledge without locking or writing
+        if is_empty_patch(data):
+            attempt = get_object_or_404(
+                Attempt.objects.only('current_state', 'sync_seq'), id=attempt_id, user=request.user
+            )
+            return JsonResponse({'status': 'noop', 'seq': latest_seq(attempt)})
 
-        return JsonResponse({'status': 'ok'})
+        if event_log_enabled():
+            # Appends events; the current_state blob isn't read or rewritten
+            attempt = get_object_or_404(
+                Attempt.objects.defer('current_state'), id=attempt_id, user=request.user, is_submitted=False
+            )
+            if not accepts_writes(attempt):
+                return JsonResponse({'status': 'closed'}, status=403)
+            try:
+                seq = log_sync(attempt, data)
+            except SyncClosed:
+                # Submitted or timed out since the check above
+                return JsonResponse({'status': 'closed'}, status=403)
+            except SyncGap as gap:
+                return JsonResponse({'status': 'resync', 'seq': gap.args[0]}, status=409)
+            except InvalidSync:
+                return JsonResponse({'status': 'invalid payload'}, status=400)
+            if seq is None:
+                return JsonResponse({'status': 'noop', 'seq': latest_seq(attempt)})
+            return JsonResponse({'status': 'ok', 'seq': seq})
+
+        if write_behind_enabled():
+            attempt = get_object_or_404(Attempt, id=attempt_id, user=request.user, is_submitted=False)
+            if not accepts_writes(attempt):
+                return JsonResponse({'status': 'closed'}, status=403)
+            try:
+                state = buffered_sync(attempt, data)
+            except SyncBusy:
+                # Another sync of the attempt is holding its buffered state; the client retries
+                response = JsonResponse({'status': 'busy'}, status=503)
+                response['Retry-After'] = '1'
+                return response
+            except SyncGap as gap:
+                return JsonResponse({'status': 'resync', 'seq': gap.args[0]}, status=409)
+            except InvalidSync:
+                return JsonResponse({'status': 'invalid payload'}, status=400)
+            if state is None:
+                return JsonResponse({'status': 'noop', 'seq': latest_seq(attempt)})
+            return JsonResponse({'status': 'ok', 'seq': state['seq']})
+
+        with transaction.atomic():
+            attempt = get_object_or_404(Attempt.objects.select_for_update(), id=attempt_id, user=request.user)
+            if not accepts_writes(attempt):
+                return JsonResponse({'status': 'closed'}, status=403)
+            seq = state_seq(attempt.current_state)
+            try:
+                state = apply_sync(attempt.current_state, data)
+            except SyncGap:
+                # Client missed an ack (or another tab wrote): it must resend everything
+                return JsonResponse({'status': 'resync', 'seq': seq}, status=409)
+            except InvalidSync:
+                return JsonResponse({'status': 'invalid payload'}, status=400)
+            if state is None:
+                return JsonResponse({'status': 'noop', 'seq': seq})
+
+            attempt.current_state = state
+            attempt.save(update_fields=['current_state'])
+
+        return JsonResponse({'status': 'ok', 'seq': state['seq']})
     return JsonResponse({'status': 'error'}, status=400)
 
 @login_required
+@pins_primary
 def submit_attempt(request, attempt_id):
     if request.method == 'POST':
-        attempt = get_object_or_404(Attempt, id=attempt_id, user=request.user)
-        if attempt.is_submitted:
-            return JsonResponse({'status': 'already_submitted'})
-
-        # Get final state from DB
-        state = attempt.current_state
-        responses_data = state.get('responses', {})
-
-        for q_id, r_data in responses_data.items():
-            question = get_object_or_404(QuestionMeta, id=q_id)
-            val = r_data.get('value')
-            status = r_data.get('status', 'not_answered')
-
-            # Create or update Response object
-            Response.objects.update_or_create(
-                attempt=attempt,
-                question=question,
-                defaults={
-                    'user_input': val,
-                    'status': status
-                }
-            )
+        # Persist, mark submitted and score as one unit so a crash can't leave half a submit
+        with transaction.atomic():
+            attempt = get_object_or_404(Attempt.objects.select_for_update(), id=attempt_id, user=request.user)
+            if attempt.is_submitted:
+                return JsonResponse({'status': 'already_submitted'})
+            if attempt.started_at is None:
+                return JsonResponse({'status': 'not_started'}, status=400)
 
-        attempt.completed_at = timezone.now()
-        attempt.is_submitted = True
-        attempt.save()
+            # Final state includes unflushed buffers and uncompacted events, so nothing is lost. A late
+            # submit still goes through: syncs after the deadline were rejected, so it adds nothing.
+            state = latest_state(attempt)
+            save_responses(attempt, state.get('responses', {}))
+            mark_submitted(attempt, state)
+            transaction.on_commit(lambda: discard_buffered_state(attempt.id))
 
-        # Trigger Scoring
-        calculate_score(attempt.id)
+            # Scoring either runs inline or is left to `manage.py run_scoring_worker`
+            if async_scoring_enabled():
+                enqueue_scoring([attempt.id])
+            else:
+                calculate_score(attempt.id)
 
         return JsonResponse({'status': 'ok'})
     return JsonResponse({'status': 'error'}, status=400)
 
+def _result_context(attempt):
+    # Question details come from the compiled key instead of joining QuestionMeta
+    key = get_compiled_key(attempt.exam_id)
+    difficulty = question_difficulty(attempt.exam_id)
+    responses = []
+    for r in attempt.responses.all():
+        pos = key.position.get(r.question_id)
+        if pos is None:
+            # Not a question of this exam, so scoring skipped it too
+            continue
+        responses.append({
+            'number': int(key.numbers[pos]),
+            'difficulty': difficulty.get(r.question_id),
+            'type': key.types[pos],
+            'correct_answer': key.answers[pos],
+            'user_input': r.user_input,
+            'is_correct': r.is_correct,
+            'marks_awarded': r.marks_awarded,
+        })
+    responses.sort(key=lambda row: row['number'])
+
+    return {
+        'attempt': attempt,
+        'responses': responses,
+        'standing': exam_standing(attempt.exam_id, attempt.total_score),
+    }
+
+def _result_json(context):
+    attempt = context['attempt']
+    return json.dumps({
+        'status': 'scored',
+        'attempt_id': attempt.id,
+        'exam': attempt.exam.slug,
+        'title': attempt.exam.title,
+        'total_score': attempt.total_score,
+        'total_marks': attempt.exam.total_marks,
+        'completed_at': attempt.completed_at,
+        'standing': context['standing'],
+        'responses': context['responses'],
+    }, cls=DjangoJSONEncoder).encode()
+
+def _result_response(request, attempt, variant):
+    # Built once per (attempt, score, exam, statistics) stamp; repeat views are 304s
+    stamp, last_modified = result_stamp(attempt)
+    etag = quote_etag(stamp)
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if variant == 'json':
+            body = cached_result(attempt, stamp, variant, lambda: _result_json(_result_context(attempt)))
+            response = HttpResponse(body, content_type='application/json')
+        else:
+            body = cached_result(attempt, stamp, variant, lambda: render_to_string(
+                'cbt/exam_result.html', _result_context(attempt), request).encode())
+            response = HttpResponse(body)
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Only for the candidate, and revalidated every time so a re-score shows up at once
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 @login_required
+@replica_reads
 def exam_result(request, attempt_id):
-    attempt = get_object_or_404(Attempt, id=attempt_id, user=request.user)
+    attempt = get_object_or_404(Attempt.objects.select_related('exam'), id=attempt_id, user=request.user)
     if not attempt.is_submitted:
         return redirect('exam_interface', attempt_id=attempt.id)
+    if attempt.total_score is None:
+        return render(request, 'cbt/exam_result.html', {'attempt': attempt, 'scoring': _scoring_status(attempt)})
+    return _result_response(request, attempt, 'html')
 
-    responses = attempt.responses.select_related('question').all().order_by('question__question_number')
+@login_required
+@replica_reads
+def exam_result_json(request, attempt_id):
+    attempt = get_object_or_404(Attempt.objects.select_related('exam'), id=attempt_id, user=request.user)
+    if not attempt.is_submitted:
+        return JsonResponse({'status': 'in_progress'})
+    if attempt.total_score is None:
+        return JsonResponse({'status': _scoring_status(attempt)})
+    return _result_response(request, attempt, 'json')
+
+
+def _scoring_status(attempt):
+    if attempt.total_score is not None:
+        return 'scored'
+    failed = ScoringJob.objects.filter(attempt=attempt, status=ScoringJob.FAILED).exists()
+    return 'failed' if failed else 'scoring'
+
+@login_required
+@replica_reads
+def attempt_status(request, attempt_id):
+    attempt = get_object_or_404(Attempt, id=attempt_id, user=request.user)
+    if not attempt.is_submitted:
+        return JsonResponse({'status': 'in_progress'})
+    total = attempt.total_score
+    return JsonResponse({'status': _scoring_status(attempt), 'total_score': str(total) if total is not None else None})
+
+@login_required
+def paper_page(request, digest, page, width):
+    manifest = page_manifest(digest)
+    if manifest is None or width not in manifest['widths'] or not 1 <= page <= manifest['pages']:
+        raise Http404("Page image not available.")
+    if not Exam.objects.filter(paper_digest=digest, is_active=True).exists():
+        raise Http404("Page image not available.")
+
+    fmt = manifest['format']
+    # URLs carry the paper digest, so a response can be cached forever
+    return serve_file(request, FileSystemStorage(location=settings.MEDIA_ROOT),
+                      page_storage_name(digest, page, width, fmt),
+                      CONTENT_TYPES.get(fmt, 'application/octet-stream'), etag=f'{digest}-{page}-{width}')
 
-    return render(request, 'cbt/exam_result.html', {'attempt': attempt, 'responses': responses})
+@login_required
+@replica_reads
+def exam_manifest(request, slug):
+    exam = get_object_or_404(Exam, slug=slug)
+    if not exam.is_active and not request.user.is_staff:
+        raise Http404("Exam not available.")
+    manifest = get_exam_manifest(exam)
+    etag = quote_etag(manifest.etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(manifest.json, content_type='application/json')
+    response['ETag'] = etag
+    # Same for every candidate and changes with the exam, so always revalidate
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+@login_required
+def question_paper(request, slug, digest):
+    exam = get_object_or_404(Exam, slug=slug)
+    if not exam.is_active and not request.user.is_staff:
+        raise Http404("Exam not available.")
+    if digest != exam.ensure_paper_digest():
+        # A page cached from before the paper was replaced
+        return redirect('question_paper', slug=slug, digest=exam.paper_digest)
+    paper = exam.question_paper
+    return serve_file(request, paper.storage, paper.name, 'application/pdf', etag=exam.paper_digest)
+
+def metrics(request):
+    if not metrics_enabled():
+        raise Http404("Metrics are disabled.")
+    token = getattr(settings, 'CBT_METRICS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    authorized = request.user.is_staff or (
+        token and authorization.startswith('Bearer ') and constant_time_compare(authorization[7:], token)
+    )
+    if not authorized:
+        raise PermissionDenied
+    response = HttpResponse(render_prometheus(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+@staff_member_required
+def export_results(request, slug, fmt):
+    exam = get_object_or_404(Exam, slug=slug)
+    layout = request.GET.get('layout', 'wide')
+    if fmt == 'csv' and layout in LAYOUTS:
+        rows = wide_rows(exam) if layout == 'wide' else long_rows(exam)
+        response = StreamingHttpResponse(csv_chunks(rows), content_type='text/csv; charset=utf-8')
+    elif fmt == 'parquet' and parquet_available():
+        layout = 'long'
+        response = StreamingHttpResponse(parquet_chunks(exam), content_type='application/vnd.apache.parquet')
+    else:
+        raise Http404("Export format not available.")
+    response['Content-Disposition'] = f'attachment; filename="{exam.slug}-results-{layout}.{fmt}"'
+    response['Cache-Control'] = 'no-store'
+    # Let rows through nginx as they are produced instead of buffering the whole export
+    response['X-Accel-Buffering'] = 'no'
+    return response
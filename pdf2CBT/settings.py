@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'cbt.metrics.MetricsMiddleware',
+    'cbt.sync_pacing.LoadMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -81,6 +83,9 @@ DATABASES = {
     }
 }
 
+# Routes reads of views marked read-only to CBT_READ_REPLICAS (see below); a no-op without them
+DATABASE_ROUTERS = ['cbt.db_router.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -121,3 +126,110 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+
+
+# CBT engine
+
+# Cache alias for shared derived data (compiled keys, manifests, ...); they are cached under the
+# exam's version stamp, which lives on the Exam row, so a per-process cache only costs rebuilds
+CBT_CACHE = 'default'
+
+# Compiled answer keys: process-local LRU size, and whether to also share them via CBT_CACHE
+CBT_ANSWER_KEY_LRU_SIZE = 64
+CBT_ANSWER_KEY_SHARED = False
+
+# Exam manifests (questions, sections, page index) served to the exam interface: process-local
+# LRU size; they are always shared through CBT_CACHE too
+CBT_MANIFEST_LRU_SIZE = 64
+
+# Write-behind sync: buffer attempt state in CBT_SYNC_BUFFER_CACHE and flush it to the
+# database every CBT_SYNC_FLUSH_INTERVAL seconds (None disables the in-process flusher;
+# run `manage.py flush_attempt_state` instead). A state is written through by the next sync
+# once its oldest unflushed change is CBT_SYNC_MAX_UNFLUSHED_AGE seconds old; for attempts
+# that stop syncing, and workers that die, the bound only holds with a periodic sweep such as
+# `manage.py flush_attempt_state --overdue --interval 5`. CBT_SYNC_BUFFER_CACHE
+# must be a cache every worker shares (Redis, Memcached, database); with a per-process
+# cache such as LocMem the system checks refuse to start.
+CBT_SYNC_WRITE_BEHIND = False
+CBT_SYNC_BUFFER_CACHE = CBT_CACHE
+CBT_SYNC_FLUSH_INTERVAL = 5
+CBT_SYNC_MAX_UNFLUSHED_AGE = 30
+
+# Sync pacing: every sync response tells the browser when to sync next, CBT_SYNC_INTERVAL
+# seconds (± half of it, so candidates who started together don't sync in waves). With
+# CBT_SYNC_PACING, LoadMiddleware adds each request's time and query time to counters in
+# CBT_SYNC_LOAD_CACHE, which must be shared by every worker; while all workers together
+# average within CBT_SYNC_TARGET_IN_FLIGHT concurrent requests and
+# CBT_SYNC_TARGET_QUERY_SECONDS query time over the last 10 seconds the interval stays put,
+# beyond that it grows proportionally up to CBT_SYNC_MAX_INTERVAL. At CBT_SYNC_SHED_LOAD
+# times the targets syncs are refused with a 503 (None never refuses); browsers keep the
+# answers and send them later or on submit.
+CBT_SYNC_PACING = False
+CBT_SYNC_LOAD_CACHE = CBT_CACHE
+CBT_SYNC_INTERVAL = 10
+CBT_SYNC_MAX_INTERVAL = 60
+CBT_SYNC_TARGET_IN_FLIGHT = 16
+CBT_SYNC_TARGET_QUERY_SECONDS = 0.05
+CBT_SYNC_SHED_LOAD = 4
+
+# Response event log (takes precedence over write-behind): each sync appends one ResponseEvent
+# row per changed answer instead of rewriting current_state. `manage.py compact_response_events`
+# folds them into current_state and deletes the events of attempts completed more than
+# CBT_EVENT_RETENTION_DAYS ago (None keeps them as an audit trail for good). Switch it on or off
+# between exams, not while attempts are open.
+CBT_SYNC_EVENT_LOG = False
+CBT_EVENT_RETENTION_DAYS = 30
+
+# Read replicas: DATABASES aliases that read-only views (exam list and detail, manifests,
+# results, scoring status) may read from; writes always go to 'default'. After a start or
+# submit the client reads from 'default' for CBT_REPLICA_STICKY_SECONDS, so it sees its own
+# writes. To try it with two SQLite files, copy db.sqlite3 to replica.sqlite3 and add
+#     DATABASES['replica'] = {**DATABASES['default'], 'NAME': BASE_DIR / 'replica.sqlite3'}
+# (a frozen copy, so replica lag is easy to see); with Postgres, point it at a standby.
+CBT_READ_REPLICAS = []
+CBT_REPLICA_STICKY_SECONDS = 10
+
+# Asynchronous scoring: submit only queues a ScoringJob and `manage.py run_scoring_worker`
+# scores it. Jobs are leased for CBT_SCORING_LEASE_SECONDS and retried every
+# CBT_SCORING_RETRY_DELAY seconds, up to CBT_SCORING_MAX_TRIES times. Scoring (inline or
+# queued) only appends rank and difficulty changes; the worker folds them into the statistics,
+# and without one `manage.py fold_exam_stats --interval 5` has to.
+CBT_ASYNC_SCORING = False
+CBT_SCORING_LEASE_SECONDS = 300
+CBT_SCORING_RETRY_DELAY = 30
+CBT_SCORING_MAX_TRIES = 5
+
+# Attempts end at started_at + the exam's duration. Syncs are accepted for this many seconds
+# past the deadline (the browser's final sync and submit); `manage.py finalize_expired_attempts`
+# submits and scores whatever is still open after that.
+CBT_DEADLINE_GRACE_SECONDS = 30
+
+# Result pages (HTML and JSON) of scored attempts are cached in CBT_RESULT_CACHE per score,
+# exam and statistics version, and answered with 304s when the browser's copy is current.
+# Give them their own alias to bound the memory they take (MAX_ENTRIES for locmem,
+# maxmemory with an LRU policy for Redis); pages over CBT_RESULT_CACHE_MAX_BYTES aren't stored.
+CBT_RESULT_CACHE = CBT_CACHE
+CBT_RESULT_CACHE_TIMEOUT = 60 * 60
+CBT_RESULT_CACHE_MAX_BYTES = 256 * 1024
+
+# Question paper page images (needs pypdfium2): rendered in the background at these
+# widths when a paper is uploaded, and shown before pdf.js has loaded
+CBT_PAGE_RENDER = True
+CBT_PAGE_WIDTHS = (640, 1024, 1600)
+CBT_PAGE_FORMAT = 'webp'
+CBT_PAGE_RENDER_PROCESSES = 2
+
+# Question papers are served by cbt.views.question_paper (ranges, ETags, 304s). Behind nginx
+# set CBT_SENDFILE_HEADER = 'X-Accel-Redirect' and map CBT_SENDFILE_PREFIX to MEDIA_ROOT as
+# an internal location so the file body is sent by the front-end server.
+CBT_SENDFILE_HEADER = None
+CBT_SENDFILE_PREFIX = '/protected-media/'
+
+# Request metrics: latency histograms, SQL query counts and time, and response sizes per URL
+# name, plus scoring and key import durations, served in Prometheus format at /metrics/ to
+# staff or to `Authorization: Bearer <CBT_METRICS_TOKEN>`. With several worker processes set
+# CBT_METRICS_DIR to a directory they share (emptied on each deploy); each process writes its
+# own memory-mapped file there and /metrics/ sums them.
+CBT_METRICS = False
+CBT_METRICS_TOKEN = None
+CBT_METRICS_DIR = None
@@ -16,14 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.conf import settings
-from django.conf.urls.static import static
 
+# MEDIA_ROOT holds exam papers and keys, so it is never served as static files, not even
+# with DEBUG; cbt's views check access and stream them
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('cbt/', include('cbt.urls')),
     path('', include('cbt.urls')), # Redirect root to app for convenience
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)